@@ -0,0 +1,153 @@
+"""
+Load test of the socket_server control server.
+
+Starts bind_and_listen on a local port and drives it with many concurrent asyncio clients:
+ - connect: all clients connect at once; connections per second until every connect callback has run
+ - messages: every client pipelines pickled control messages; messages per second through the message callback
+ - round trip: every client sends pings and waits for the pong sent back with send_message; requests per second and
+   p50 / p99 round-trip time
+ - isolation: one client's message callback blocks for --slow-time seconds while the others ping; their worst round
+   trip shows whether a slow handler stalls the other clients
+ - shutdown: time for stop_listening() to run every disconnect callback and return
+
+Example:
+    python bench_control_server.py --clients 500 --messages 200
+"""
+import argparse
+import asyncio
+import pickle
+import socket
+import threading
+import time
+import numpy as np
+
+import socket_server
+from socket_server import HEADER_LENGTH
+
+
+def frame(message_tuple):
+    message = pickle.dumps(message_tuple)
+    return f"{len(message):<{HEADER_LENGTH}}".encode('utf-8') + message
+
+
+class Counters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connected = 0
+        self.disconnected = 0
+        self.messages = 0
+
+    def add(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+def start_server(port, counters):
+    def on_message(connection, message):
+        counters.add('messages')
+        name, *args = pickle.loads(message['data'])
+        if name == 'ping':
+            socket_server.send_message(connection, ('pong', args[0]))
+        elif name == 'slow':
+            time.sleep(args[0])
+
+    thread = threading.Thread(target=socket_server.bind_and_listen,
+                              args=('127.0.0.1', port, lambda connection: counters.add('connected'),
+                                    lambda connection, reason: counters.add('disconnected'), on_message),
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_for(condition, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError("timed out")
+        time.sleep(0.001)
+
+
+async def read_message(reader):
+    header = await reader.readexactly(HEADER_LENGTH)
+    return pickle.loads(await reader.readexactly(int(header)))
+
+
+async def ping(reader, writer, count):
+    round_trips = []
+    for i in range(count):
+        start = time.perf_counter()
+        writer.write(frame(('ping', i)))
+        reply = await read_message(reader)
+        if reply != ('pong', i):
+            raise RuntimeError("unexpected reply {}".format(reply))
+        round_trips.append(time.perf_counter() - start)
+    return round_trips
+
+
+async def run(args, port, counters):
+    start = time.perf_counter()
+    clients = await asyncio.gather(*(asyncio.open_connection('127.0.0.1', port) for _ in range(args.clients)))
+    await asyncio.get_running_loop().run_in_executor(None, wait_for, lambda: counters.connected == args.clients)
+    elapsed = time.perf_counter() - start
+    print("connect:    {} clients in {:.3f} s, {:.0f} connections/s".format(args.clients, elapsed,
+                                                                          args.clients / elapsed))
+
+    total = args.clients * args.messages
+    batch = b''.join(frame(('frame_ack', i)) for i in range(args.messages))
+    start = time.perf_counter()
+    for _, writer in clients:
+        writer.write(batch)
+    await asyncio.gather(*(writer.drain() for _, writer in clients))
+    await asyncio.get_running_loop().run_in_executor(None, wait_for, lambda: counters.messages >= total)
+    elapsed = time.perf_counter() - start
+    print("messages:   {} messages in {:.3f} s, {:.0f} messages/s".format(total, elapsed, total / elapsed))
+
+    start = time.perf_counter()
+    round_trips = np.concatenate(await asyncio.gather(*(ping(reader, writer, args.pings)
+                                                       for reader, writer in clients)))
+    elapsed = time.perf_counter() - start
+    print("round trip: {} requests in {:.3f} s, {:.0f} requests/s, p50 {:.2f} ms, p99 {:.2f} ms".format(
+        len(round_trips), elapsed, len(round_trips) / elapsed, 1000 * np.percentile(round_trips, 50),
+        1000 * np.percentile(round_trips, 99)))
+
+    slow_reader, slow_writer = clients[0]
+    slow_writer.write(frame(('slow', args.slow_time)))
+    await slow_writer.drain()
+    start = time.perf_counter()
+    round_trips = np.concatenate(await asyncio.gather(*(ping(reader, writer, 5) for reader, writer in clients[1:])))
+    print("isolation:  callback of client 0 blocked for {:.1f} s; other clients' worst round trip {:.2f} ms "
+          "({:.3f} s for all)".format(args.slow_time, 1000 * round_trips.max(), time.perf_counter() - start))
+    return clients
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-c", "--clients", type=int, default=300, help="concurrent control clients")
+    ap.add_argument("-m", "--messages", type=int, default=100, help="pipelined messages per client")
+    ap.add_argument("-p", "--pings", type=int, default=20, help="round trips per client")
+    ap.add_argument("--slow-time", type=float, default=1.0, help="duration of the blocking callback (seconds)")
+    args = ap.parse_args()
+
+    # a free port for the server
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    counters = Counters()
+    server = start_server(port, counters)
+    time.sleep(0.2)
+
+    loop = asyncio.new_event_loop()
+    clients = loop.run_until_complete(run(args, port, counters))
+
+    start = time.perf_counter()
+    socket_server.stop_listening()
+    server.join()
+    wait_for(lambda: counters.disconnected == args.clients, timeout=10)
+    print("shutdown:   {:.3f} s, {} disconnect callbacks".format(time.perf_counter() - start, counters.disconnected))
+    for _, writer in clients:
+        writer.close()
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
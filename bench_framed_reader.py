@@ -0,0 +1,92 @@
+"""
+Throughput benchmark for socket_server.FramedReader.
+
+A writer thread sends length-prefixed messages over a loopback TCP connection, either
+ - fragmented: every message is split into small chunks sent one by one (TCP_NODELAY), or
+ - coalesced: many messages are packed into a single sendall() call,
+while the main thread reads them with select() and recv_into() straight into FramedReader.get_buffer(), as the
+asyncio transport of socket_server.bind_and_listen does, and parses them with messages().
+
+Example:
+    python bench_framed_reader.py --count 20000 --size 64 --size 65536
+"""
+import argparse
+import select
+import socket
+import threading
+import time
+
+from socket_server import HEADER_LENGTH, FramedReader
+
+
+def frame(payload):
+    return f"{len(payload):<{HEADER_LENGTH}}".encode('utf-8') + payload
+
+
+def writer(sock, payload, count, mode, chunk_size, batch):
+    message = frame(payload)
+    if mode == 'fragmented':
+        for _ in range(count):
+            for offset in range(0, len(message), chunk_size):
+                sock.sendall(message[offset:offset + chunk_size])
+    else:
+        for sent in range(0, count, batch):
+            sock.sendall(message * min(batch, count - sent))
+    sock.shutdown(socket.SHUT_WR)
+
+
+def run(size, count, mode, chunk_size, batch):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    sender = socket.create_connection(listener.getsockname())
+    sender.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    receiver, _ = listener.accept()
+    listener.close()
+
+    payload = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    reader = FramedReader()
+    received = wakeups = 0
+    t = threading.Thread(target=writer, args=(sender, payload, count, mode, chunk_size, batch), daemon=True)
+
+    start = time.perf_counter()
+    t.start()
+    while received < count:
+        select.select([receiver], [], [])
+        wakeups += 1
+        n = receiver.recv_into(reader.get_buffer())
+        if not n:
+            break
+        reader.buffer_updated(n)
+        for message in reader.messages():
+            if len(message['data']) != size:
+                raise RuntimeError("message truncated: {} != {}".format(len(message['data']), size))
+            received += 1
+    elapsed = time.perf_counter() - start
+    t.join()
+    sender.close()
+    receiver.close()
+
+    if received != count:
+        raise RuntimeError("received {} of {} messages".format(received, count))
+    print("{:>10} {:>9} B {:>9} msgs {:>12.0f} msgs/s {:>9.1f} MB/s {:>8.2f} msgs/wakeup".format(
+        mode, size, count, count / elapsed, count * (size + HEADER_LENGTH) / elapsed / 1e6, count / wakeups))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-n", "--count", type=int, default=20000, help="messages per run")
+    ap.add_argument("-s", "--size", type=int, action='append', help="payload size in bytes (repeatable)")
+    ap.add_argument("-c", "--chunk-size", type=int, default=7, help="bytes per send() in fragmented mode")
+    ap.add_argument("-b", "--batch", type=int, default=64, help="messages per sendall() in coalesced mode")
+    args = ap.parse_args()
+
+    for size in args.size or [20, 1024, 65536]:
+        # keep fragmented runs of large messages short; each chunk is a separate system call
+        fragmented_count = max(1, min(args.count, args.count * 64 // max(size, 64)))
+        run(size, fragmented_count, 'fragmented', args.chunk_size, args.batch)
+        run(size, args.count, 'coalesced', args.chunk_size, args.batch)
+
+
+if __name__ == '__main__':
+    main()
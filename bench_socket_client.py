@@ -0,0 +1,100 @@
+"""
+Micro-benchmark of the SocketClient receive path.
+
+Compares the current SocketClient._listen (recv_into a reused, header-sized buffer) with the previous loop, which
+built every message with 'message += buf' over 4096 byte recv() calls. For each payload size a local server sends
+the same stream of length-prefixed messages to each implementation and the time to receive all of them is measured.
+
+Example:
+    python bench_socket_client.py --total-bytes 64000000
+"""
+import argparse
+import socket
+import threading
+import time
+
+from socket_client import HEADER_LENGTH, SocketClient
+
+
+def legacy_listen(client_socket, count, incoming_message_callback):
+    # the receive loop SocketClient._listen used before recv_into, kept here for comparison. Only the header read
+    # differs: the original single recv(HEADER_LENGTH) could return a partial header under load.
+    for _ in range(count):
+        message_header = b''
+        while len(message_header) < HEADER_LENGTH:
+            message_header += client_socket.recv(HEADER_LENGTH - len(message_header))
+        message_length = int(message_header.decode('utf-8').strip())
+        message = b''
+        while len(message) < message_length:
+            remains = message_length - len(message)
+            bufsize = 4096 if remains > 4096 else remains
+            buf = client_socket.recv(bufsize)
+            if not buf:
+                return
+            message += buf
+        incoming_message_callback(message)
+
+
+def serve(listener, message, count):
+    connection, _ = listener.accept()
+    for _ in range(count):
+        connection.sendall(message)
+    connection.close()
+
+
+def run_engine(engine, size, count):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    payload = bytes(size)
+    message = f"{len(payload):<{HEADER_LENGTH}}".encode('utf-8') + payload
+    server = threading.Thread(target=serve, args=(listener, message, count), daemon=True)
+    server.start()
+
+    received = []
+    done = threading.Event()
+
+    def on_message(data):
+        received.append(len(data))
+        if len(received) == count:
+            done.set()
+
+    client = SocketClient(*listener.getsockname())
+    client.connect(print)
+    start = time.perf_counter()
+    if engine == 'legacy':
+        legacy_listen(client.client_socket, count, on_message)
+    else:
+        client.start_listening(on_message, lambda error: done.set())
+        done.wait()
+    elapsed = time.perf_counter() - start
+    if engine != 'legacy':
+        client.stop_listening()
+    client.client_socket.close()
+    server.join()
+    listener.close()
+
+    if len(received) != count or any(n != size for n in received):
+        raise RuntimeError("{}: received {} of {} messages intact".format(engine, len(received), count))
+    return elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-t", "--total-bytes", type=int, default=32 * 1024 * 1024,
+                    help="approximate payload volume per run; the message count is derived from it")
+    ap.add_argument("-s", "--size", type=int, action='append',
+                    help="payload size in bytes (repeatable, default 20 B to 1 MB)")
+    args = ap.parse_args()
+
+    print("{:>9} {:>8} {:>14} {:>14} {:>8}".format('size', 'msgs', 'legacy MB/s', 'recv_into MB/s', 'speedup'))
+    for size in args.size or [20, 256, 4096, 65536, 262144, 1048576]:
+        count = max(10, min(100000, args.total_bytes // size))
+        legacy = run_engine('legacy', size, count)
+        current = run_engine('recv_into', size, count)
+        print("{:>9} {:>8} {:>14.1f} {:>14.1f} {:>7.2f}x".format(
+            size, count, count * size / legacy / 1e6, count * size / current / 1e6, legacy / current))
+
+
+if __name__ == '__main__':
+    main()
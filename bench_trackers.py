@@ -0,0 +1,239 @@
+"""
+Offline benchmark of the OpenCV trackers, without a camera or a client.
+
+Clips are replayed through every tracker type (see tracking.TRACKER_TYPES; types the OpenCV build can't create are
+reported as errors) and, with -t ENSEMBLE, through the parallel ensemble of --ensemble-members. Clips are either video
+files or synthetic moving-target clips (synthetic_scene.py). Frames are decoded up front, so only the tracker is timed.
+Each run reports:
+ - init time and throughput (frames per second of tracker.update)
+ - update latency: mean, p50, p95, p99 and max
+ - memory: growth of the process resident set size over the run (Linux; approximate, shared by the allocator)
+ - accuracy when ground truth is available: mean IoU, success rate (IoU >= 0.5), mean centre error of tracked frames
+
+A table is printed and the full results, including the OpenCV version, are written as JSON so runs on different
+OpenCV builds can be compared.
+
+Ground truth files have one 'x,y,w,h' line per frame (commas, tabs or spaces). Without one, a video file needs --roi
+for the initial selection and accuracy is not reported.
+
+Examples:
+    python bench_trackers.py --frames 300 -o bench_opencv454.json
+    python bench_trackers.py clip.mp4 --ground-truth clip.txt -t KCF -t CSRT --scale 0.5 --gray
+"""
+import argparse
+import datetime
+import json
+import platform
+import resource
+import sys
+import time
+import cv2
+import numpy as np
+
+from synthetic_scene import MOTIONS, SyntheticScene
+from tracking import ENSEMBLE, ENSEMBLE_MEMBERS, TRACKER_TYPES, ScaledTracker, TrackerPool, available_tracker_types, \
+    create_tracker
+
+
+def rss_bytes():
+    # current resident set size; falls back to the peak where /proc is not available
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def load_video(path, max_frames):
+    capture = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < max_frames:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames.append(frame)
+    capture.release()
+    if not frames:
+        raise ValueError("no frames could be read from {}".format(path))
+    return frames
+
+
+def load_ground_truth(path):
+    with open(path) as f:
+        rows = [line.replace(',', ' ').split() for line in f if line.strip()]
+    return np.array(rows, dtype=float)[:, :4]
+
+
+def synthetic_clip(motion, args):
+    width, height = args.resolution
+    scene = SyntheticScene(width, height, motion, args.speed, noise=args.noise, seed=args.seed)
+    frames, truth = zip(*(scene.render(i) for i in range(args.frames)))
+    return {'name': 'synthetic-' + motion, 'source': 'synthetic', 'frames': list(frames),
+            'ground_truth': np.array(truth, dtype=float)}
+
+
+def iou(boxes, truth):
+    # row-wise intersection over union of (N, 4) x, y, w, h arrays
+    x0 = np.maximum(boxes[:, 0], truth[:, 0])
+    y0 = np.maximum(boxes[:, 1], truth[:, 1])
+    x1 = np.minimum(boxes[:, 0] + boxes[:, 2], truth[:, 0] + truth[:, 2])
+    y1 = np.minimum(boxes[:, 1] + boxes[:, 3], truth[:, 1] + truth[:, 3])
+    intersection = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    union = boxes[:, 2] * boxes[:, 3] + truth[:, 2] * truth[:, 3] - intersection
+    return np.divide(intersection, union, out=np.zeros(len(boxes)), where=union > 0)
+
+
+def run_tracker(tracker_type, clip, roi, scale, grayscale, pool):
+    frames = clip['frames']
+    result = {'tracker': tracker_type}
+    rss_before = rss_bytes()
+    try:
+        tracker = pool.take_ensemble() if tracker_type == ENSEMBLE else create_tracker(tracker_type)
+        if tracker is None:
+            raise ValueError("not available in this OpenCV build")
+        tracker = ScaledTracker(tracker, scale, grayscale)
+        start = time.perf_counter()
+        tracker.init(frames[0], roi)
+        result['init_ms'] = 1000 * (time.perf_counter() - start)
+    except (cv2.error, AttributeError, ValueError) as e:
+        result['error'] = str(e).strip().splitlines()[-1]
+        return result
+
+    # frame 0 is the initialization frame; every later frame is an update
+    latencies = np.zeros(len(frames) - 1)
+    ok = np.zeros(len(frames) - 1, dtype=bool)
+    boxes = np.zeros((len(frames) - 1, 4))
+    for i, frame in enumerate(frames[1:]):
+        start = time.perf_counter()
+        ok[i], bbox = tracker.update(frame)
+        latencies[i] = time.perf_counter() - start
+        if ok[i]:
+            boxes[i] = bbox
+
+    if tracker_type == ENSEMBLE:
+        tracker.tracker.latency.report()
+        result['ensemble_members'] = list(tracker.tracker.members)
+
+    latency_ms = 1000 * latencies
+    result.update({
+        'frames': len(latencies),
+        'fps': len(latencies) / latencies.sum() if latencies.sum() > 0 else 0.0,
+        'latency_ms': {'mean': latency_ms.mean(), 'p50': np.percentile(latency_ms, 50),
+                       'p95': np.percentile(latency_ms, 95), 'p99': np.percentile(latency_ms, 99),
+                       'max': latency_ms.max()},
+        'lost_frames': int((~ok).sum()),
+        'memory_mb': (rss_bytes() - rss_before) / 1e6,
+    })
+    truth = clip.get('ground_truth')
+    if truth is not None:
+        truth = truth[1:len(frames)]
+        overlap = iou(boxes[:len(truth)], truth)
+        tracked = ok[:len(truth)]
+        centre_error = np.hypot(*((boxes[:len(truth), :2] + boxes[:len(truth), 2:] / 2) -
+                                  (truth[:, :2] + truth[:, 2:] / 2)).T)
+        result.update({
+            'iou_mean': overlap.mean(),
+            'success_rate': (overlap >= 0.5).mean(),
+            'centre_error_px': centre_error[tracked].mean() if tracked.any() else None,
+        })
+    return result
+
+
+def print_result(clip_name, result):
+    if 'error' in result:
+        print("{:<20} {:<10} error: {}".format(clip_name, result['tracker'], result['error']))
+        return
+    latency = result['latency_ms']
+    line = "{:<20} {:<10} {:>8.2f} {:>8.1f} {:>7.2f} {:>7.2f} {:>7.2f} {:>6} {:>8.1f}".format(
+        clip_name, result['tracker'], result['init_ms'], result['fps'], latency['p50'], latency['p95'],
+        latency['p99'], result['lost_frames'], result['memory_mb'])
+    if 'iou_mean' in result:
+        centre_error = result['centre_error_px']
+        line += " {:>6.3f} {:>6.1%} {:>8}".format(result['iou_mean'], result['success_rate'],
+                                                  '-' if centre_error is None else "{:.1f}".format(centre_error))
+    print(line)
+
+
+def to_json(value):
+    # NumPy scalars are not JSON serializable
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("videos", nargs='*', help="video files to replay; synthetic clips are used when none are given")
+    ap.add_argument("-g", "--ground-truth", action='append', default=[],
+                    help="ground truth file for the video at the same position (repeatable)")
+    ap.add_argument("--roi", type=lambda s: tuple(int(v) for v in s.split(',')),
+                    help="initial selection x,y,w,h for videos without ground truth")
+    ap.add_argument("-s", "--synthetic", action='append', choices=MOTIONS,
+                    help="synthetic clip with this target motion (repeatable, default: all when no videos are given)")
+    ap.add_argument("-n", "--frames", type=int, default=300, help="frames per clip (videos are truncated)")
+    ap.add_argument("--resolution", type=lambda s: tuple(int(v) for v in s.split('x')), default=(640, 480),
+                    help="synthetic clip resolution WIDTHxHEIGHT")
+    ap.add_argument("--speed", type=float, default=4.0, help="synthetic target speed in pixels per frame")
+    ap.add_argument("--noise", type=float, default=2.0, help="synthetic sensor noise (standard deviation)")
+    ap.add_argument("--seed", type=int, default=0, help="synthetic scene seed")
+    ap.add_argument("-t", "--tracker", action='append', choices=TRACKER_TYPES + [ENSEMBLE],
+                    help="tracker type to benchmark (repeatable, default: all but ENSEMBLE)")
+    ap.add_argument("--ensemble-members", nargs="+", default=list(ENSEMBLE_MEMBERS), choices=available_tracker_types(),
+                    help="trackers of the ENSEMBLE")
+    ap.add_argument("--scale", type=float, default=1.0, help="tracking scale, as ppn_server --tracking-scale")
+    ap.add_argument("--gray", action='store_true', help="track on grayscale frames, as ppn_server --tracking-gray")
+    ap.add_argument("-o", "--output", default='bench_trackers.json', help="JSON results file ('-' for stdout)")
+    args = ap.parse_args()
+
+    clips = []
+    for i, path in enumerate(args.videos):
+        clip = {'name': path, 'source': 'video', 'frames': load_video(path, args.frames)}
+        if i < len(args.ground_truth):
+            clip['ground_truth'] = load_ground_truth(args.ground_truth[i])
+        elif args.roi is None:
+            ap.error("{} has no ground truth; give its initial selection with --roi".format(path))
+        clips.append(clip)
+    for motion in args.synthetic or ([] if args.videos else MOTIONS):
+        clips.append(synthetic_clip(motion, args))
+
+    print("{:<20} {:<10} {:>8} {:>8} {:>7} {:>7} {:>7} {:>6} {:>8} {:>6} {:>7} {:>8}".format(
+        'clip', 'tracker', 'init ms', 'fps', 'p50 ms', 'p95 ms', 'p99 ms', 'lost', 'mem MB', 'IoU', 'success',
+        'error px'))
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'opencv_version': cv2.__version__,
+        'numpy_version': np.__version__,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'frames': args.frames, 'scale': args.scale, 'gray': args.gray,
+                     'ensemble_members': args.ensemble_members},
+        'clips': [],
+    }
+    # builds the ENSEMBLE trackers; each ensemble run ends with its per-member latency report
+    pool = TrackerPool(spares=0, ensemble_members=args.ensemble_members)
+    for clip in clips:
+        frames = clip['frames']
+        truth = clip.get('ground_truth')
+        roi = tuple(int(v) for v in truth[0]) if truth is not None else args.roi
+        results = []
+        for tracker_type in args.tracker or TRACKER_TYPES:
+            result = run_tracker(tracker_type, clip, roi, args.scale, args.gray, pool)
+            print_result(clip['name'], result)
+            results.append(result)
+        report['clips'].append({'name': clip['name'], 'source': clip['source'], 'frames': len(frames),
+                                'width': frames[0].shape[1], 'height': frames[0].shape[0], 'roi': roi,
+                                'results': results})
+
+    pool.close()
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, default=to_json)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, default=to_json)
+        print("results written to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Shared capture: one CaptureHub per frame source, read by any number of Streamer sessions.
+
+The hub's capture thread reads the source (see frame_sources.py) and publishes each new frame as the latest frame,
+numbered and time-stamped once for every reader. Sessions wait for a frame newer than the last one they took and get
+the very same array: frames are never copied by the hub, so they are marked read-only and a session that needs to
+modify one (flip it, draw an overlay) works on its own copy.
+
+A camera or a real-time replay produces frames at its own rate, and the hub publishes them as they come. An unpaced
+replay (--as-fast-as-possible) produces a frame on every read, so the hub only reads the next one once a session has
+claimed the current one with wait_newer(): replay then runs as fast as the fastest session consumes it.
+
+Hubs are reference counted. acquire() starts the source for the first session and returns the running hub to later
+ones; release() stops it when the last session is done, freeing the device for the next acquire().
+"""
+import threading
+import time
+
+from frame_pipeline import StageWorker
+
+_hubs = {}
+_hubs_lock = threading.Lock()
+
+
+class CaptureHub:
+    def __init__(self, key, source):
+        self.key = key
+        self.source = source
+        self.references = 0
+        self.frame = None
+        self.frame_id = 0
+        self.capture_time = 0.0  # time.time() of the latest frame
+        self.captured = 0.0  # time.perf_counter() of the latest frame
+        self._last_read = None
+        # cameras and real-time replays have a frame rate of their own; see frame_sources.ReplaySource
+        self.paced = getattr(source, 'realtime', True)
+        self._claimed = True
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._worker = StageWorker('capture-hub-{}'.format(key), self._capture_step)
+
+    def start(self):
+        self.source.start()
+        self._worker.start()
+        return self
+
+    def stop(self):
+        self._worker.stop()
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self.source.stop()
+
+    def _capture_step(self):
+        if not self.paced:
+            with self._condition:
+                if not self._condition.wait_for(lambda: self._claimed or self._stopped, 0.1) or self._stopped:
+                    return
+        frame = self.source.read()
+        if frame is None or frame is self._last_read:
+            # the source has not produced a new frame yet
+            time.sleep(0.001)
+            return
+        self._last_read = frame
+        frame.flags.writeable = False
+        with self._condition:
+            self.frame = frame
+            self.frame_id += 1
+            self.capture_time = time.time()
+            self.captured = time.perf_counter()
+            self._claimed = False
+            self._condition.notify_all()
+
+    def wait_newer(self, frame_id, timeout=None):
+        """
+        Waits for a frame newer than frame_id. Returns (frame_id, capture_time, captured, frame), with frame None if
+        none arrived within the timeout or the hub stopped. Frames published in between are skipped.
+        """
+        with self._condition:
+            if self._condition.wait_for(lambda: self.frame_id > frame_id or self._stopped, timeout) \
+                    and not self._stopped:
+                self._claimed = True
+                self._condition.notify_all()
+                return self.frame_id, self.capture_time, self.captured, self.frame
+        return frame_id, None, None, None
+
+
+def acquire(key, create_source):
+    """
+    Returns the running hub for 'key', creating and starting it with the source returned by create_source() if no
+    session holds it yet. Every acquire() must be paired with a release().
+    """
+    with _hubs_lock:
+        hub = _hubs.get(key)
+        if hub is None:
+            hub = _hubs[key] = CaptureHub(key, create_source()).start()
+            print("capture hub started:", key)
+        hub.references += 1
+        return hub
+
+
+def release(hub):
+    with _hubs_lock:
+        hub.references -= 1
+        if hub.references > 0:
+            return
+        # stopped under the lock, so a new hub for the same device can't start before this one has released it
+        del _hubs[hub.key]
+        hub.stop()
+    print("capture hub stopped:", hub.key)
@@ -0,0 +1,42 @@
+"""
+Sample timing of the PID controllers in pid-tuner.
+
+The control loop ticks at the faster of the two axes' sample frequencies and is the only thing that decides when a
+PID computes: the PIDs are built with sample_time=None and called with an explicit dt. Leaving the gating to
+simple_pid's sample_time would compare real time against the period, so a tick that arrives a little early through
+timing jitter would return the previous output and ignore a fresh displacement.
+
+A SampleSchedule per axis keeps that axis's deadlines on the loop's scheduled tick times, so jitter in when a tick
+actually runs can't skip a computation, and an axis slower than the loop computes at its own frequency.
+"""
+
+
+class SampleSchedule:
+    """
+    Deadlines of one PID at 'frequency' samples per second, on the control loop's tick schedule.
+    """
+    def __init__(self, frequency):
+        self.frequency = frequency
+        self.deadline = None  # scheduled time of the next computation
+        self.last = None  # actual time of the last computation
+
+    def reset(self):
+        # the next tick computes, with a dt of one period (e.g. when tracking resumes)
+        self.deadline = self.last = None
+
+    def due(self, tick, now, tolerance=0.0):
+        """
+        Called on every control loop tick: 'tick' is its scheduled time, 'now' the time it actually runs (same
+        clock). A tick within 'tolerance' seconds of the deadline is on time. Returns the dt in seconds since the
+        previous computation if the PID computes on this tick, otherwise None.
+        """
+        period = 1 / self.frequency
+        if self.deadline is not None and tick < self.deadline - tolerance:
+            return None
+        dt = period if self.last is None else max(now - self.last, 1e-6)
+        self.last = now
+        if self.deadline is None or tick - self.deadline >= period:
+            # the first computation, or a whole period late: restart the schedule from this tick
+            self.deadline = tick
+        self.deadline += period
+        return dt
@@ -0,0 +1,280 @@
+"""
+Wire format for the displacement stream sent by ppn_server to pid-tuner.
+
+Each message (framed by the usual 10 byte length header) is a fixed-layout little-endian record:
+
+    magic       2s   b'PD'
+    kind        u1   1 = single displacement
+    flags       u1   bit 0: target is being tracked
+    seq         u4   message sequence number, incremented by the sender for every record
+    timestamp   f8   capture time of the frame the displacement was measured on (time.time(), seconds)
+    x, y        i4   displacement of the target from the frame centre (pixels; y is positive upwards)
+    width       u2   frame width (frame.shape[1])
+    height      u2   frame height (frame.shape[0])
+
+When several targets are tracked, a batch record (kind 2) is sent instead. It starts with the same magic, kind, flags,
+seq and timestamp fields (flags then describe the primary target), followed by
+
+    width       u2   frame width
+    height      u2   frame height
+    count       u2   number of target entries
+    reserved    u2
+    count x TARGET_DTYPE entries: target_id u2, flags u1, pad u1, x i4, y i4, cost f4 (tracker update time, seconds)
+
+The first entry is the primary target; decoders also expose it as a regular single displacement record.
+
+Either record may be followed by a timing block, signalled by flag bit 1 (FLAG_TIMING):
+
+    frame_id    u4   id the server gave the frame at capture (also in the imagezmq msg of that frame)
+    age         f4   seconds from capture to sending this message, measured on the server's clock
+    track       f4   seconds spent in the tracker updates for this frame
+
+and then by a prediction block for the primary target, signalled by flag bit 2 (FLAG_PREDICTION; see motion_filter.py):
+
+    x, y        f4   filtered displacement predicted 'horizon' seconds after capture (pixels, as the raw x, y)
+    vx, vy      f4   estimated velocity of the displacement (pixels per second)
+    horizon     f4   seconds from capture the prediction is for: the server's latency up to sending
+    coasting    u2   frames predicted without a measurement (the tracker has lost the target); 0 when measured
+    reserved    u2
+
+Target ids are u2: encode_batch() refuses ids above MAX_TARGET_ID rather than let them wrap.
+
+The legacy format, a pickled (tracking, x, y, width, height) tuple, remains as a fallback. Receivers tell the two
+apart by the magic bytes, and only unpickle when they explicitly allow it, since unpickling data from the network can
+execute arbitrary code. The format is negotiated over TCP: on connecting, the receiver sends a hello record (framed
+like the displacements) listing the formats it accepts,
+
+    magic       2s   b'PD'
+    kind        u1   3 = hello
+    formats     u1   bit 0: binary records, bit 1: pickled tuples
+
+and the sender uses its preferred format (ppn_server --offset-format) if accepted, else the other one. A receiver
+that sends no hello within HANDSHAKE_TIMEOUT predates the handshake and only understands pickled tuples.
+"""
+import pickle
+import struct
+import time
+import numpy as np
+
+OFFSET_FORMATS = ['binary', 'pickle']
+
+MAGIC = b'PD'
+KIND_DISPLACEMENT = 1
+KIND_BATCH = 2
+KIND_HELLO = 3
+FLAG_TRACKING = 0x01
+FLAG_TIMING = 0x02
+FLAG_PREDICTION = 0x04
+MAX_TARGETS = 64
+MAX_TARGET_ID = 0xFFFF
+
+FORMAT_BITS = {'binary': 0x01, 'pickle': 0x02}
+HELLO = struct.Struct('<2sBB')
+# seconds a sender waits for the receiver's hello before falling back to pickle
+HANDSHAKE_TIMEOUT = 1.0
+
+RECORD = struct.Struct('<2sBBIdiiHH')
+RECORD_DTYPE = np.dtype([('magic', 'S2'), ('kind', 'u1'), ('flags', 'u1'), ('seq', '<u4'), ('timestamp', '<f8'),
+                         ('x', '<i4'), ('y', '<i4'), ('width', '<u2'), ('height', '<u2')])
+assert RECORD_DTYPE.itemsize == RECORD.size
+
+BATCH_HEADER = struct.Struct('<2sBBIdHHHH')
+TARGET_DTYPE = np.dtype([('target_id', '<u2'), ('flags', 'u1'), ('pad', 'u1'), ('x', '<i4'), ('y', '<i4'),
+                         ('cost', '<f4')])
+
+TIMING = struct.Struct('<Iff')
+TIMING_DTYPE = np.dtype([('frame_id', '<u4'), ('age', '<f4'), ('track', '<f4')])
+assert TIMING_DTYPE.itemsize == TIMING.size
+
+PREDICTION = struct.Struct('<fffffHH')
+PREDICTION_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('vx', '<f4'), ('vy', '<f4'), ('horizon', '<f4'),
+                             ('coasting', '<u2'), ('reserved', '<u2')])
+assert PREDICTION_DTYPE.itemsize == PREDICTION.size
+
+# copied over the timing and prediction blocks of messages without them
+NO_TIMING = bytes(TIMING.size)
+NO_PREDICTION = bytes(PREDICTION.size)
+
+# first byte of any pickle of protocol 2 or above
+PICKLE_PROTO = 0x80
+
+
+def encode_hello(formats):
+    return HELLO.pack(MAGIC, KIND_HELLO, sum(FORMAT_BITS[offset_format] for offset_format in formats))
+
+
+def decode_hello(data):
+    # the formats a hello record accepts, or None if data isn't a hello
+    if len(data) != HELLO.size or data[0] != MAGIC[0] or data[1] != MAGIC[1] or data[2] != KIND_HELLO:
+        return None
+    return [offset_format for offset_format in OFFSET_FORMATS if data[3] & FORMAT_BITS[offset_format]]
+
+
+class DisplacementEncoder:
+    """
+    Builds displacement messages in the selected format ('binary' or 'pickle'), numbering binary records.
+    offset_format is the preferred format until negotiate() picks the one the receiver accepts.
+    """
+    def __init__(self, offset_format='binary'):
+        if offset_format not in OFFSET_FORMATS:
+            raise ValueError("unknown offset format: {}".format(offset_format))
+        self.preferred_format = self.offset_format = offset_format
+        self.seq = 0
+
+    def negotiate(self, accepted):
+        """
+        Selects the format for a receiver that accepts the given formats (from decode_hello), or for a receiver that
+        sent no hello if accepted is None. Returns the selected format.
+        """
+        if accepted is None:
+            accepted = ['pickle']
+        if not accepted:
+            raise ValueError("the receiver accepts no displacement format")
+        self.offset_format = self.preferred_format if self.preferred_format in accepted else accepted[0]
+        return self.offset_format
+
+    @staticmethod
+    def _flags(tracking, timing, prediction):
+        return ((FLAG_TRACKING if tracking else 0) | (FLAG_TIMING if timing is not None else 0) |
+                (FLAG_PREDICTION if prediction is not None else 0))
+
+    @staticmethod
+    def _blocks(timing, prediction):
+        # timing is None or (frame_id, age, track); prediction is None or (x, y, vx, vy, horizon, coasting)
+        blocks = b'' if timing is None else TIMING.pack(int(timing[0]) & 0xFFFFFFFF, timing[1], timing[2])
+        if prediction is not None:
+            x, y, vx, vy, horizon, coasting = prediction
+            blocks += PREDICTION.pack(x, y, vx, vy, horizon, min(int(coasting), 0xFFFF), 0)
+        return blocks
+
+    def encode(self, tracking, x, y, width, height, timestamp=None, timing=None, prediction=None):
+        if self.offset_format == 'pickle':
+            return pickle.dumps((tracking, x, y, width, height))
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        if timestamp is None:
+            timestamp = time.time()
+        return RECORD.pack(MAGIC, KIND_DISPLACEMENT, self._flags(tracking, timing, prediction), self.seq, timestamp,
+                           int(x), int(y), int(width), int(height)) + self._blocks(timing, prediction)
+
+    def encode_batch(self, target_ids, tracking, displacements, costs, width, height, timestamp=None, timing=None,
+                     prediction=None):
+        """
+        Encodes all targets of a frame in one message. target_ids, tracking and costs are (N,) arrays,
+        displacements an (N, 2) array; the first target is the primary one. timing, if given, is
+        (frame_id, age, track) for the timing block, prediction (x, y, vx, vy, horizon, coasting) of the primary
+        target for the prediction block.
+        The pickle format can only carry a single displacement, so it gets the primary target.
+        """
+        if self.offset_format == 'pickle' or len(target_ids) == 1:
+            return self.encode(bool(tracking[0]), displacements[0, 0], displacements[0, 1], width, height, timestamp,
+                               timing, prediction)
+        if len(target_ids) > MAX_TARGETS:
+            raise ValueError("at most {} targets per message".format(MAX_TARGETS))
+        if np.min(target_ids) < 0 or np.max(target_ids) > MAX_TARGET_ID:
+            raise ValueError("target ids must be within 0..{}".format(MAX_TARGET_ID))
+        entries = np.zeros(len(target_ids), dtype=TARGET_DTYPE)
+        entries['target_id'] = target_ids
+        entries['flags'] = np.where(tracking, FLAG_TRACKING, 0)
+        entries['x'] = displacements[:, 0]
+        entries['y'] = displacements[:, 1]
+        entries['cost'] = costs
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        if timestamp is None:
+            timestamp = time.time()
+        header = BATCH_HEADER.pack(MAGIC, KIND_BATCH, self._flags(tracking[0], timing, prediction), self.seq,
+                                   timestamp, int(width), int(height), len(entries), 0)
+        return header + entries.tobytes() + self._blocks(timing, prediction)
+
+
+class DisplacementDecoder:
+    """
+    Decodes displacement messages into preallocated records, so decoding a binary message needs no new buffers.
+    decode() returns that record: a one-element NumPy array with RECORD_DTYPE fields, overwritten by the next call.
+    Legacy pickled tuples are only accepted when allow_pickle is True; seq and timestamp are then left at 0.
+
+    After a batch message, 'targets[:target_count]' holds every target entry and the returned record describes the
+    primary target. After a single displacement, the record is also stored as the only target entry.
+
+    'timing' holds the timing block of the last message (see has_timing), 'prediction' its prediction block (see
+    has_prediction); they are zeroed for messages without them.
+    """
+    def __init__(self, allow_pickle=False):
+        self.allow_pickle = allow_pickle
+        self._buffer = bytearray(RECORD.size)
+        self.record = np.frombuffer(self._buffer, dtype=RECORD_DTYPE)
+        self._targets_buffer = bytearray(MAX_TARGETS * TARGET_DTYPE.itemsize)
+        self.targets = np.frombuffer(self._targets_buffer, dtype=TARGET_DTYPE)
+        self.target_count = 0
+        self._timing_buffer = bytearray(TIMING.size)
+        self.timing = np.frombuffer(self._timing_buffer, dtype=TIMING_DTYPE)
+        self.has_timing = False
+        self._prediction_buffer = bytearray(PREDICTION.size)
+        self.prediction = np.frombuffer(self._prediction_buffer, dtype=PREDICTION_DTYPE)
+        self.has_prediction = False
+
+    def _read_blocks(self, data, size):
+        # copies the timing and prediction blocks that follow a record of the given size, if the flags announce them;
+        # returns the expected message size
+        self.has_timing = bool(data[3] & FLAG_TIMING)
+        if self.has_timing and len(data) >= size + TIMING.size:
+            self._timing_buffer[:] = data[size:size + TIMING.size]
+        else:
+            self._timing_buffer[:] = NO_TIMING
+        size += TIMING.size if self.has_timing else 0
+        self.has_prediction = bool(data[3] & FLAG_PREDICTION)
+        if self.has_prediction and len(data) >= size + PREDICTION.size:
+            self._prediction_buffer[:] = data[size:size + PREDICTION.size]
+        else:
+            self._prediction_buffer[:] = NO_PREDICTION
+        return size + (PREDICTION.size if self.has_prediction else 0)
+
+    def _single_target(self):
+        self.target_count = 1
+        self.targets['target_id'][0] = 1
+        self.targets['flags'][0] = self.record['flags'][0]
+        self.targets['x'][0] = self.record['x'][0]
+        self.targets['y'][0] = self.record['y'][0]
+        self.targets['cost'][0] = 0
+
+    def _decode_batch(self, data):
+        count = data[20] | data[21] << 8
+        size = count * TARGET_DTYPE.itemsize
+        if count == 0 or count > MAX_TARGETS or len(data) != self._read_blocks(data, BATCH_HEADER.size + size):
+            raise ValueError("malformed displacement batch ({} bytes, {} targets)".format(len(data), count))
+        self._targets_buffer[:size] = data[BATCH_HEADER.size:BATCH_HEADER.size + size]
+        self.target_count = count
+        # the primary target as a single displacement record; the header fields before x are shared
+        self._buffer[:16] = data[:16]
+        self._buffer[24:28] = data[16:20]
+        self.record['kind'] = KIND_DISPLACEMENT
+        self.record['x'] = self.targets['x'][0]
+        self.record['y'] = self.targets['y'][0]
+        return self.record
+
+    def decode(self, data):
+        if len(data) >= RECORD.size and data[0] == MAGIC[0] and data[1] == MAGIC[1]:
+            if data[2] == KIND_BATCH:
+                return self._decode_batch(data)
+            if data[2] != KIND_DISPLACEMENT or len(data) != self._read_blocks(data, RECORD.size):
+                raise ValueError("unsupported displacement record (kind {}, {} bytes)".format(data[2], len(data)))
+            self._buffer[:] = data[:RECORD.size]
+            self._single_target()
+            return self.record
+
+        if len(data) and data[0] == PICKLE_PROTO:
+            if not self.allow_pickle:
+                raise ValueError("refusing pickled displacement message (pickle fallback not allowed)")
+            tracking, x, y, width, height = pickle.loads(data)
+            self.has_timing = self.has_prediction = False
+            self._timing_buffer[:] = NO_TIMING
+            self._prediction_buffer[:] = NO_PREDICTION
+            RECORD.pack_into(self._buffer, 0, MAGIC, KIND_DISPLACEMENT, FLAG_TRACKING if tracking else 0, 0, 0.0,
+                             int(x), int(y), int(width), int(height))
+            self._single_target()
+            return self.record
+
+        raise ValueError("unrecognised displacement message ({} bytes)".format(len(data)))
+
+
+def is_tracking(record):
+    return bool(record['flags'][0] & FLAG_TRACKING)
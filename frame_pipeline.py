@@ -0,0 +1,141 @@
+"""
+Building blocks for the staged capture / track / send pipeline used by ppn_server.Streamer.
+
+Each stage runs on its own thread and hands its output to the next stage through a bounded buffer that drops
+its oldest entry when full, so a slow consumer (e.g. the network link) never stalls its producer (e.g. the tracker).
+"""
+import threading
+from collections import OrderedDict, deque
+
+
+class DropOldestBuffer:
+    """
+    A bounded, thread-safe FIFO. put() never blocks: when the buffer is full the oldest item is discarded and
+    counted in 'dropped'. get() returns the oldest item, get_latest() returns the newest one and discards the rest.
+    """
+    def __init__(self, maxlen=1):
+        self._items = deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def __len__(self):
+        with self._cond:
+            return len(self._items)
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        # returns None if nothing arrived within the timeout, or if the buffer was closed
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items or self.closed, timeout):
+                return None
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def get_latest(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items or self.closed, timeout):
+                return None
+            if not self._items:
+                return None
+            self.dropped += len(self._items) - 1
+            item = self._items.pop()
+            self._items.clear()
+            self._cond.notify_all()
+            return item
+
+    def wait_empty(self, timeout=None):
+        # waits until the consumer has taken every item; returns False on timeout or once the buffer is closed
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._items or self.closed, timeout) and not self.closed
+
+    def close(self):
+        # wakes up any waiting consumer
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class FrameRing:
+    """
+    The most recent 'maxlen' frames by frame id, so a client can select targets on a frame it has already received and
+    send back only the frame id. Frames are kept by reference and must not be modified once added.
+
+    A selection can take longer than the ring lasts, so hold() sets a frame aside until take() or until 'max_held'
+    newer holds have replaced it.
+    """
+    def __init__(self, maxlen=30, max_held=4):
+        self.maxlen = maxlen
+        self.max_held = max_held
+        self._frames = OrderedDict()
+        self._held = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, frame_id, frame):
+        with self._lock:
+            self._frames[frame_id] = frame
+            while len(self._frames) > self.maxlen:
+                self._frames.popitem(last=False)
+
+    def latest(self):
+        # (frame_id, frame) of the newest frame, or (None, None)
+        with self._lock:
+            if not self._frames:
+                return None, None
+            return next(reversed(self._frames.items()))
+
+    def hold(self, frame_id):
+        # returns False if the frame is no longer cached
+        with self._lock:
+            frame = self._held.get(frame_id)
+            if frame is None:
+                frame = self._frames.get(frame_id)
+            if frame is None:
+                return False
+            self._held[frame_id] = frame
+            while len(self._held) > self.max_held:
+                self._held.popitem(last=False)
+            return True
+
+    def take(self, frame_id):
+        # the frame with this id, released from hold; None if it is no longer cached
+        with self._lock:
+            frame = self._held.pop(frame_id, None)
+            return self._frames.get(frame_id) if frame is None else frame
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._held.clear()
+
+
+class StageWorker(threading.Thread):
+    """
+    Runs step() repeatedly on its own thread until stop() is called.
+    step() must return periodically (use timeouts on any blocking call), so that stop() can take effect.
+    """
+    def __init__(self, name, step):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self._step = step
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._step()
+            except Exception as x:
+                print(self.name, "stage error:", x)
+
+    def stop(self, timeout=2.0):
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
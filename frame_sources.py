@@ -0,0 +1,169 @@
+"""
+Frame sources for ppn_server: the live camera, or replayed / generated frames for running the server without a webcam.
+
+Every source has the interface of imutils' VideoStream that Streamer.capture_step relies on: start() returns the
+source, read() returns the newest frame (the same object again until a new one is available, or None before the first
+frame) and stop() releases it.
+
+Replayed and synthetic sources run either in real time, where a thread publishes frames at the source frame rate and
+read() returns the newest one like a camera would, or as fast as possible, where every read() produces the next frame.
+At the end of a file or directory the source stops producing frames unless 'loop' is set.
+"""
+import os
+import threading
+import time
+import cv2
+from imutils.video import VideoStream
+
+from synthetic_scene import SyntheticScene
+
+FRAME_SOURCES = ['camera', 'video', 'images', 'synthetic']
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.ppm', '.tif', '.tiff')
+
+
+class CameraSource:
+    def __init__(self, src=0):
+        self.stream = VideoStream(src=src)
+
+    def start(self):
+        self.stream.start()
+        return self
+
+    def read(self):
+        return self.stream.read()
+
+    def stop(self):
+        self.stream.stream.release()
+        self.stream.stop()
+
+
+class ReplaySource:
+    """
+    Base class of the non-camera sources; subclasses implement next_frame(), returning None once they are exhausted.
+    """
+    def __init__(self, fps=30.0, realtime=True, loop=False):
+        self.fps = fps
+        self.realtime = realtime
+        self.loop = loop
+        self.frame = None
+        self.finished = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def next_frame(self):
+        raise NotImplementedError
+
+    def rewind(self):
+        raise NotImplementedError
+
+    def _produce(self):
+        frame = self.next_frame()
+        if frame is None and self.loop:
+            self.rewind()
+            frame = self.next_frame()
+        if frame is None:
+            self.finished = True
+        return frame
+
+    def _run(self):
+        # publish frames at the source frame rate; a late frame moves the schedule instead of causing a burst
+        interval = 1 / self.fps
+        deadline = time.monotonic()
+        while not self._stopped.is_set() and not self.finished:
+            frame = self._produce()
+            if frame is not None:
+                self.frame = frame
+            deadline += interval
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                deadline -= delay
+            self._stopped.wait(max(delay, 0))
+
+    def start(self):
+        if self.realtime:
+            self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+        return self
+
+    def read(self):
+        if not self.realtime and not self.finished:
+            frame = self._produce()
+            if frame is not None:
+                self.frame = frame
+        return self.frame
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout=2.0)
+
+
+class VideoFileSource(ReplaySource):
+    def __init__(self, path, fps=None, realtime=True, loop=False):
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise ValueError("cannot open video file {}".format(path))
+        super().__init__(fps or self.capture.get(cv2.CAP_PROP_FPS) or 30.0, realtime, loop)
+
+    def next_frame(self):
+        ok, frame = self.capture.read()
+        return frame if ok else None
+
+    def rewind(self):
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def stop(self):
+        super().stop()
+        self.capture.release()
+
+
+class ImageDirectorySource(ReplaySource):
+    # the images of a directory in file name order
+    def __init__(self, path, fps=None, realtime=True, loop=False):
+        super().__init__(fps or 30.0, realtime, loop)
+        self.paths = sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.lower().endswith(IMAGE_EXTENSIONS))
+        if not self.paths:
+            raise ValueError("no images in {}".format(path))
+        self.index = 0
+
+    def next_frame(self):
+        while self.index < len(self.paths):
+            frame = cv2.imread(self.paths[self.index])
+            self.index += 1
+            if frame is not None:
+                return frame
+            print("skipping unreadable image", self.paths[self.index - 1])
+        return None
+
+    def rewind(self):
+        self.index = 0
+
+
+class SyntheticSource(ReplaySource):
+    # an endless synthetic_scene.SyntheticScene clip
+    def __init__(self, scene, fps=None, realtime=True):
+        super().__init__(fps or 30.0, realtime)
+        self.scene = scene
+        self.index = 0
+
+    def next_frame(self):
+        frame, _ = self.scene.render(self.index)
+        self.index += 1
+        return frame
+
+    def rewind(self):
+        self.index = 0
+
+
+def create_frame_source(source='camera', path=None, camera=0, fps=None, realtime=True, loop=False,
+                        resolution=(640, 480), motion='linear', speed=4.0):
+    if source == 'camera':
+        return CameraSource(camera)
+    if source == 'video':
+        return VideoFileSource(path, fps, realtime, loop)
+    if source == 'images':
+        return ImageDirectorySource(path, fps, realtime, loop)
+    if source == 'synthetic':
+        return SyntheticSource(SyntheticScene(resolution[0], resolution[1], motion, speed), fps, realtime)
+    raise ValueError("unknown frame source: {}".format(source))
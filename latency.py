@@ -0,0 +1,142 @@
+"""
+Per-stage latency bookkeeping for ppn_server, ppn_client and pid-tuner.
+
+Every frame is tagged at capture with a monotonic frame id and its capture time (time.time()). Each process times its
+own stages with time.perf_counter() and records the durations in a LatencyMonitor, which keeps the most recent samples
+of every stage and periodically prints their percentiles and a histogram.
+
+The server's stage durations travel with the frame (the imagezmq msg 'stages', in milliseconds) and with the
+displacement (the timing block of displacement_protocol), so the viewer and the PID tuner can show the whole chain.
+Their 'age' stages are measured from the capture time, which is only meaningful when the clocks of both machines are
+synchronized (e.g. with NTP); all other stages are durations measured on a single clock.
+"""
+import threading
+import time
+from collections import deque
+import numpy as np
+
+# upper bucket edges of the printed histograms, in milliseconds; the last bucket is open-ended
+HISTOGRAM_EDGES_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class LatencyHistogram:
+    """
+    Rolling window of the last 'window' samples (seconds) of one stage.
+    """
+    def __init__(self, window=512):
+        self.samples = np.zeros(window)
+        self.count = 0  # samples recorded in total
+
+    def record(self, seconds):
+        self.samples[self.count % len(self.samples)] = seconds
+        self.count += 1
+
+    def values(self):
+        return self.samples[:min(self.count, len(self.samples))]
+
+    def percentiles(self, q=(50, 95, 99)):
+        values = self.values()
+        return np.percentile(values, q) if len(values) else np.zeros(len(q))
+
+    def histogram(self, edges_ms=HISTOGRAM_EDGES_MS):
+        # sample counts per bucket: [0, edges_ms[0]), ..., [edges_ms[-1], inf)
+        return np.histogram(1000 * self.values(), bins=(0,) + tuple(edges_ms) + (np.inf,))[0]
+
+
+class LatencyMonitor:
+    """
+    A LatencyHistogram per stage, in the order the stages were first recorded. Stages may be recorded from several
+    threads. When report_interval is positive, record() prints a report every report_interval seconds.
+    """
+    def __init__(self, label, report_interval=10.0, window=512):
+        self.label = label
+        self.report_interval = report_interval
+        self.window = window
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._last_report = time.monotonic()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = LatencyHistogram(self.window)
+            histogram.record(seconds)
+        if self.report_interval > 0 and time.monotonic() - self._last_report >= self.report_interval:
+            self._last_report = time.monotonic()
+            self.report()
+
+    def record_stages(self, stages_ms, prefix=''):
+        # stage durations received from another process, in milliseconds
+        for stage, ms in stages_ms.items():
+            self.record(prefix + stage, ms / 1000)
+
+    def snapshot(self):
+        """
+        Returns {stage: {'count', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'histogram'}} over the current windows;
+        'histogram' holds the sample counts of the HISTOGRAM_EDGES_MS buckets.
+        """
+        with self._lock:
+            result = {}
+            for stage, histogram in self.stages.items():
+                p50, p95, p99 = 1000 * histogram.percentiles()
+                values = histogram.values()
+                result[stage] = {'count': histogram.count, 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+                                 'max_ms': 1000 * values.max() if len(values) else 0.0,
+                                 'histogram': histogram.histogram().tolist()}
+            return result
+
+    def report(self):
+        snapshot = self.snapshot()
+        if not snapshot:
+            return
+        edges = ' '.join("<{:<4}".format(edge) for edge in HISTOGRAM_EDGES_MS) + ' more'
+        print("{} latency (ms, last {} samples per stage)".format(self.label, self.window))
+        print("  {:<36} {:>7} {:>7} {:>7} {:>7}   {}".format('stage', 'p50', 'p95', 'p99', 'max', edges))
+        for stage, stats in snapshot.items():
+            print("  {:<36} {:>7.2f} {:>7.2f} {:>7.2f} {:>7.2f}   {}".format(
+                stage, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['max_ms'],
+                ' '.join("{:<5}".format(n) for n in stats['histogram'])))
+
+
+class FrameRateCounter:
+    """
+    Frame rate over the last 'window' frames. tick() once per displayed frame, with the time spent displaying it.
+    """
+    def __init__(self, window=60):
+        self.ticks = deque(maxlen=window)
+        self.busy = deque(maxlen=window)
+
+    def tick(self, busy=0.0):
+        self.ticks.append(time.perf_counter())
+        self.busy.append(busy)
+
+    @property
+    def fps(self):
+        if len(self.ticks) < 2 or self.ticks[-1] == self.ticks[0]:
+            return 0.0
+        return (len(self.ticks) - 1) / (self.ticks[-1] - self.ticks[0])
+
+    @property
+    def busy_time(self):
+        # mean time spent per frame, in seconds
+        return sum(self.busy) / len(self.busy) if self.busy else 0.0
+
+    def text(self):
+        fps = self.fps
+        return "{:.1f} FPS  {:.1f} ms/frame  display {:.2f} ms".format(fps, 1000 / fps if fps else 0.0,
+                                                                      1000 * self.busy_time)
+
+
+def new_frame_info(frame_id, capture_time=None, captured=None):
+    # the timing record that accompanies a frame through the server: capture_time is time.time() and captured
+    # time.perf_counter() at capture (default: now); stage durations are in seconds
+    return {'frame_id': frame_id,
+            'capture_time': time.time() if capture_time is None else capture_time,
+            'captured': time.perf_counter() if captured is None else captured,
+            'stages': {}}
+
+
+def stages_ms(info):
+    # the stage durations of a frame info, in milliseconds, as sent to the viewer
+    return {stage: round(1000 * seconds, 3) for stage, seconds in info['stages'].items()}
@@ -0,0 +1,107 @@
+"""
+Latency compensation for the tracked targets: a constant-velocity Kalman filter on each target's displacement.
+
+Between capture and the velocity command the target keeps moving, so a controller acting on the measured displacement
+always acts on the past. The filter estimates each target's position and velocity from the measurements, so the
+position can be predicted for a later time: ppn_server sends the estimate predicted to the moment of sending (see the
+prediction block of displacement_protocol), and pid-tuner extrapolates it further to the moment of the command.
+
+While a tracker has lost its target the filter coasts on its velocity estimate for up to max_coast seconds, so short
+dropouts don't stop the controller; after that the estimate is dropped.
+"""
+import numpy as np
+
+
+class ConstantVelocityFilter:
+    """
+    Kalman filter with state (x, y, vx, vy) in pixels and pixels per second, measuring (x, y).
+
+    process_noise is the spectral density of the random acceleration (pixels / s^2, as a standard deviation per
+    square-root second); measurement_noise the standard deviation of a measured position (pixels). A new filter
+    starts at its first measurement with zero velocity and an uncertainty of initial_speed pixels per second.
+    """
+    def __init__(self, position, process_noise=300.0, measurement_noise=4.0, initial_speed=500.0):
+        self.state = np.array([position[0], position[1], 0.0, 0.0])
+        self.covariance = np.diag([measurement_noise ** 2] * 2 + [initial_speed ** 2] * 2)
+        self.process_noise = process_noise
+        self.measurement_noise = np.eye(2) * measurement_noise ** 2
+        self.coasting = 0  # predictions since the last measurement
+        self.coast_time = 0.0  # seconds since the last measurement
+
+    def predict(self, dt):
+        transition = np.eye(4)
+        transition[0, 2] = transition[1, 3] = dt
+        # white noise acceleration, per axis q * [[dt^3 / 3, dt^2 / 2], [dt^2 / 2, dt]]
+        q = self.process_noise ** 2
+        noise = np.zeros((4, 4))
+        noise[[0, 1], [0, 1]] = q * dt ** 3 / 3
+        noise[[0, 1, 2, 3], [2, 3, 0, 1]] = q * dt ** 2 / 2
+        noise[[2, 3], [2, 3]] = q * dt
+        self.state = transition @ self.state
+        self.covariance = transition @ self.covariance @ transition.T + noise
+
+    def update(self, position):
+        # H selects the position; the gain is the position columns of P over the innovation covariance
+        innovation = np.asarray(position, dtype=float) - self.state[:2]
+        innovation_covariance = self.covariance[:2, :2] + self.measurement_noise
+        gain = self.covariance[:, :2] @ np.linalg.inv(innovation_covariance)
+        self.state = self.state + gain @ innovation
+        self.covariance = self.covariance - gain @ self.covariance[:2, :]
+        self.coasting = 0
+        self.coast_time = 0.0
+
+    @property
+    def position(self):
+        return self.state[:2]
+
+    @property
+    def velocity(self):
+        return self.state[2:]
+
+    def position_at(self, horizon):
+        # the position predicted 'horizon' seconds after the latest estimate, without changing the filter
+        return self.state[:2] + self.state[2:] * horizon
+
+
+class TargetPredictor:
+    """
+    A ConstantVelocityFilter per target id. update() is called once per frame with the tracker results; targets that
+    are no longer tracked lose their filter, lost targets coast for up to max_coast seconds.
+    """
+    def __init__(self, process_noise=300.0, measurement_noise=4.0, max_coast=0.5):
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.max_coast = max_coast
+        self.filters = {}
+        self.last_time = None
+
+    def update(self, target_ids, ok, displacements, timestamp):
+        """
+        Filters the displacements measured on the frame captured at 'timestamp' (seconds, time.perf_counter()).
+        Returns {target_id: filter} for the targets with an estimate; a filter's 'coasting' is non-zero when the
+        target was not measured on this frame.
+        """
+        dt = 0.0 if self.last_time is None else max(0.0, timestamp - self.last_time)
+        self.last_time = timestamp
+        current = set(int(target_id) for target_id in target_ids)
+        for target_id in list(self.filters):
+            if target_id not in current:
+                del self.filters[target_id]
+
+        for target_id, tracked, displacement in zip(target_ids, ok, displacements):
+            target_id = int(target_id)
+            motion = self.filters.get(target_id)
+            if motion is None:
+                if tracked:
+                    self.filters[target_id] = ConstantVelocityFilter(displacement, self.process_noise,
+                                                                     self.measurement_noise)
+                continue
+            motion.predict(dt)
+            if tracked:
+                motion.update(displacement)
+            else:
+                motion.coasting += 1
+                motion.coast_time += dt
+                if motion.coast_time > self.max_coast:
+                    del self.filters[target_id]
+        return self.filters
@@ -2,18 +2,22 @@
 
 This example script illustrates how to receive the data.
 
-You can run it in any venv, so long as socket_server.py accompanies it.
+You can run it in any venv, so long as socket_server.py, udp_channel.py, displacement_protocol.py, latency.py and
+control_timing.py accompany it.
 
 Once it is running, you can startup ppn_server.py, and then run ppn_client.py as usual.
 
 - 2021-12-05 Jeremy Broad
 """
 import socket_server
+from udp_channel import DatagramServer
 import argparse
-import pickle
 import time
 from simple_pid import PID
 import threading
+from displacement_protocol import DisplacementDecoder, encode_hello, is_tracking
+from latency import LatencyMonitor
+from control_timing import SampleSchedule
 
 # dronekit imports
 from pymavlink import mavutil  # needed for command message definitions
@@ -39,16 +43,43 @@ class Tracker:
         self.frame_shape_0 = 0
         self.frame_shape_1 = 0
 
-        self.x_PID = PID(self.x_kp, self.x_ki, self.x_kd, setpoint=self.x_setpoint, sample_time=self.x_sample_frequency,
+        # The control loop decides when each PID computes and passes the dt, so the PIDs don't gate on sample_time
+        # themselves (see control_timing.py); the sliders set each axis's sample frequency in Hz.
+        self.x_PID = PID(self.x_kp, self.x_ki, self.x_kd, setpoint=self.x_setpoint, sample_time=None,
                          output_limits=(self.x_lower_limit, self.x_upper_limit))
-        self.y_PID = PID(self.y_kp, self.y_ki, self.y_kd, setpoint=self.y_setpoint, sample_time=self.y_sample_frequency,
+        self.y_PID = PID(self.y_kp, self.y_ki, self.y_kd, setpoint=self.y_setpoint, sample_time=None,
                          output_limits=(self.y_lower_limit, self.y_upper_limit))
+        self.x_schedule = SampleSchedule(self.x_sample_frequency)
+        self.y_schedule = SampleSchedule(self.y_sample_frequency)
         self._is_tracking = False
         self.my_socket = None
         self.addr = addr
         self.port = port
         self.PID_outputs = {'x_offset': 0, 'x_control_variable': 0, 'y_offset': 0, 'y_control_variable': 0}
         self.last_time = time.time()
+        self.decoder = DisplacementDecoder(allow_pickle=args.allow_pickle)
+        self.last_seq = 0
+        self.last_capture_time = 0.0
+        # server timings carried by the displacement messages, their age on arrival and the PID update cost
+        self.latency = LatencyMonitor('pid-tuner', args.latency_report)
+
+        # The socket thread only stores the newest displacement (under input_lock); the control loop thread samples it
+        # at the sample frequency and sends the velocity commands (see control_loop).
+        self.input_lock = threading.Lock()
+        self.tracking_input = False
+        self.last_received = 0.0  # time.monotonic() of the newest displacement
+        # the server's Kalman prediction of the newest displacement (x, y, vx, vy, coasting), or None
+        self.prediction = None
+        self.last_sampled_seq = None
+        self.last_command = 0.0  # time.monotonic() of the last velocity command
+        self.ticks = 0
+        self.overruns = 0
+        self.stale_inputs = 0
+        self.commands_sent = 0
+        self.commands_capped = 0
+        self.stop_event = threading.Event()
+        # the DatagramServer receiving the displacements with --udp, for its loss and reorder counters
+        self.channel = None
 
     def refresh_pid_parameters(self, my_key, my_value):
         setattr(self, my_key, my_value)
@@ -57,13 +88,13 @@ class Tracker:
         self.x_PID.Ki = self.x_ki
         self.x_PID.Kd = self.x_kd
         self.x_PID.setpoint = self.x_setpoint
-        self.x_PID.sample_time = 1 / self.x_sample_frequency
+        self.x_schedule.frequency = self.x_sample_frequency
         self.x_PID.output_limits = (self.x_lower_limit, self.x_upper_limit)
         self.y_PID.Kp = self.y_kp
         self.y_PID.Ki = self.y_ki
         self.y_PID.Kd = self.y_kd
         self.y_PID.setpoint = self.y_setpoint
-        self.y_PID.sample_time = 1 / self.y_sample_frequency
+        self.y_schedule.frequency = self.y_sample_frequency
         self.y_PID.output_limits = (self.y_lower_limit, self.y_upper_limit)
 
     @property
@@ -80,22 +111,44 @@ class Tracker:
 
     def displacement_received(self, __, message):
         """
-        This method is called each time the socket_server created by this script receives a message.
+        This method is called each time the socket_server created by this script receives a message, or with --udp
+        each time its DatagramServer delivers a datagram.
         The ppn_server script is configured to send them while tracking, if this endpoint accepts the connection.
 
         The first argument (__) is a reference to the socket who delivered this message but it is not used here
-        message: a dictionary containing keys 'header' and 'data'. The 'data' key is pickle-encoded.
+        message: a dictionary containing keys 'header' and 'data'. The 'data' key is a binary displacement record
+        (see displacement_protocol.py), or a pickled tuple if --allow-pickle is given.
         """
-        values = pickle.loads(message['data'])
-        # Currently 'values' is an (B, x, y, fs1, fs0) tuple; B is a boolean to indicate the tracking status
-        # fs1 is frame.shape[1] from the image, fs0 is frame.shape[0] from the image. These are width and height.
-        self.is_tracking = False
         try:
-            self.is_tracking, self.x_displacement, self.y_displacement, self.frame_shape_1, self.frame_shape_0 = values
+            record = self.decoder.decode(message['data'])
         except ValueError as e:
             print(e)
-
-        self.update_pid_controllers()
+            record = None
+
+        # only stored here: the control loop samples the newest displacement at its own rate
+        with self.input_lock:
+            self.tracking_input = False
+            self.last_received = time.monotonic()
+            if record is not None:
+                # width and height are frame.shape[1] and frame.shape[0] from the image
+                self.tracking_input = is_tracking(record)
+                self.x_displacement = int(record['x'][0])
+                self.y_displacement = int(record['y'][0])
+                self.frame_shape_1 = int(record['width'][0])
+                self.frame_shape_0 = int(record['height'][0])
+                self.last_seq = int(record['seq'][0])
+                self.last_capture_time = float(record['timestamp'][0])
+                self.prediction = None
+                if self.decoder.has_prediction and not args.raw_displacement:
+                    p = self.decoder.prediction[0]
+                    self.prediction = (float(p['x']), float(p['y']), float(p['vx']), float(p['vy']),
+                                       int(p['coasting']))
+                    # the server keeps predicting a target its tracker has briefly lost
+                    self.tracking_input = self.tracking_input or self.prediction[4] > 0
+        if record is not None and self.decoder.has_timing:
+            self.latency.record('server track', float(self.decoder.timing['track'][0]))
+            self.latency.record('server age at send', float(self.decoder.timing['age'][0]))
+            self.latency.record('age at receipt', time.time() - self.last_capture_time)
         """
         # this is the old method of doing this.
         current_time = time.time()
@@ -139,36 +192,115 @@ class Tracker:
         # print("displacement: ", self.is_tracking, "received x=", self.x_displacement, "y=", self.y_displacement)
         """
 
-    def update_pid_controllers(self):
-        if self.is_tracking:
-            # the offset is scaled to a value between -1 and 1.
-            x_offset = (self.x_displacement / (self.frame_shape_1 * 0.5))
-            x_control_variable = self.x_PID(x_offset)
+    @property
+    def control_rate(self):
+        # control loop ticks per second: the faster of the two PID sample frequencies
+        return max(self.x_sample_frequency, self.y_sample_frequency)
 
-            y_offset = (self.y_displacement / (self.frame_shape_0 * 0.5))
-            y_control_variable = self.y_PID(y_offset)
+    def control_loop(self):
+        """
+        Runs update_pid_controllers at control_rate on monotonic deadlines, until stop_event is set. The rate is read
+        every tick, so the sample frequency sliders take effect at once. A tick that starts a whole period late counts
+        as an overrun, and the schedule restarts from then instead of running the missed ticks back to back.
+        Each tick passes its deadline, on which each axis's SampleSchedule decides whether that axis's PID computes.
+        """
+        deadline = time.monotonic()
+        last_report = deadline
+        while not self.stop_event.is_set():
+            period = 1 / self.control_rate
+            if self.stop_event.wait(max(0.0, deadline - time.monotonic())):
+                break
+            now = time.monotonic()
+            if now - deadline >= period:
+                self.overruns += 1
+                deadline = now
+            self.ticks += 1
+            self.update_pid_controllers(deadline, 0.5 * period)
+            deadline += period
+            if args.latency_report > 0 and now - last_report >= args.latency_report:
+                last_report = now
+                print("control loop: {} ticks at {:g} Hz, {} overruns, {} stale inputs, {} commands sent, {} held back "
+                      "by the {:g} Hz command rate cap".format(self.ticks, self.control_rate, self.overruns,
+                                                              self.stale_inputs, self.commands_sent,
+                                                              self.commands_capped, args.max_command_rate))
+                if self.channel is not None:
+                    print(self.channel.text())
+
+    def update_pid_controllers(self, tick, tolerance):
+        # tick: the scheduled time of this control loop tick (time.monotonic()); tolerance: how early a tick may be
+        # for a PID due at the tick's time
+        start = time.perf_counter()
+        now = time.monotonic()
+        with self.input_lock:
+            tracking = self.tracking_input
+            x_displacement, y_displacement = self.x_displacement, self.y_displacement
+            frame_width, frame_height = self.frame_shape_1, self.frame_shape_0
+            prediction = self.prediction
+            seq = self.last_seq
+            fresh = tracking and seq != self.last_sampled_seq
+        if tracking and now - self.last_received > args.stale_input:
+            # no displacement for too long (a stalled server or a lost link): stop rather than act on an old offset
+            self.stale_inputs += 1
+            tracking = False
+        if tracking != self.is_tracking:
+            self.is_tracking = tracking
+            # a resumed PID computes on the next tick, not after a dt spanning the pause
+            self.x_schedule.reset()
+            self.y_schedule.reset()
+        if tracking and prediction:
+            # The server predicted the displacement to the time it sent it; carry it on to this command: the time
+            # since receipt (on this clock) plus the expected command latency.
+            horizon = now - self.last_received + args.command_latency
+            x_displacement = prediction[0] + prediction[2] * horizon
+            y_displacement = prediction[1] + prediction[3] * horizon
+
+        computed = False
+        if self.is_tracking:
+            # The offset is scaled to a value between -1 and 1. An axis that isn't due on this tick holds its last
+            # output.
+            x_dt = self.x_schedule.due(tick, now, tolerance)
+            if x_dt is not None:
+                self.PID_outputs['x_offset'] = x_displacement / (frame_width * 0.5)
+                self.PID_outputs['x_control_variable'] = self.x_PID(self.PID_outputs['x_offset'], dt=x_dt)
+            y_dt = self.y_schedule.due(tick, now, tolerance)
+            if y_dt is not None:
+                self.PID_outputs['y_offset'] = y_displacement / (frame_height * 0.5)
+                self.PID_outputs['y_control_variable'] = self.y_PID(self.PID_outputs['y_offset'], dt=y_dt)
+            computed = x_dt is not None or y_dt is not None
         else:
-            x_control_variable = y_control_variable = x_offset = y_offset = 0
+            self.PID_outputs.update(x_offset=0, x_control_variable=0, y_offset=0, y_control_variable=0)
+        x_offset, x_control_variable = self.PID_outputs['x_offset'], self.PID_outputs['x_control_variable']
+        y_offset, y_control_variable = self.PID_outputs['y_offset'], self.PID_outputs['y_control_variable']
         print("x: {}, {}, y: {}, {}".format(x_offset, x_control_variable, y_offset, y_control_variable))
         if args.drone_control:
-            """
-            the args are: forward (positive for 'forward'), right (positive for 'right'), down (positive for 'down')
-            the offsets are x (right is positive ), and y (down is negative).
-            """
-            send_frd_velocity(0, -x_control_variable, y_control_variable, 1)
-
-        self.PID_outputs['x_offset'] = x_offset
-        self.PID_outputs['x_control_variable'] = x_control_variable
-        self.PID_outputs['y_offset'] = y_offset
-        self.PID_outputs['y_control_variable'] = y_control_variable
+            # the flight controller gets no more than --max-command-rate commands per second
+            if now - self.last_command >= 1 / args.max_command_rate:
+                self.last_command = now
+                self.commands_sent += 1
+                """
+                the args are: forward (positive for 'forward'), right (positive for 'right'), down (positive for 'down')
+                the offsets are x (right is positive ), and y (down is negative).
+                """
+                send_frd_velocity(0, -x_control_variable, y_control_variable, 1)
+            else:
+                self.commands_capped += 1
+
+        if fresh and computed and self.last_capture_time:
+            # once per displacement, on the first tick a PID computed on it
+            self.last_sampled_seq = seq
+            self.latency.record('pid update', time.perf_counter() - start)
+            self.latency.record('age at pid update', time.time() - self.last_capture_time)
 
     def connect(self, client_socket):
         self.my_socket = client_socket
+        # tells ppn_server which displacement formats to send (see displacement_protocol.py)
+        socket_server.send_data(client_socket, encode_hello(['binary', 'pickle'] if args.allow_pickle else ['binary']))
 
     def disconnect(self, __, arg):
         self.my_socket = None
-        self.is_tracking = False
-        self.update_pid_controllers()
+        # the control loop stops the PIDs and sends a zero command on its next tick
+        with self.input_lock:
+            self.tracking_input = False
 
 # vehicle methods
 def arm_and_takeoff(target_altitude):
@@ -261,6 +393,74 @@ def draw_figure(my_canvas, figure, loc=(0, 0)):
     return figure_canvas_agg
 
 
+class SeriesHistory:
+    """
+    The last 'length' samples of several series, kept in NumPy ring buffers that are written in place.
+    Times are NaN until written, so unwritten samples are not plotted.
+    """
+    def __init__(self, count, length):
+        self.times = np.full(length, np.nan)
+        self.values = np.zeros((count, length))
+        self.index = 0  # samples written in total
+
+    def append(self, sample_time, values):
+        i = self.index % len(self.times)
+        self.times[i] = sample_time
+        self.values[:, i] = values
+        self.index += 1
+
+    def ordered(self):
+        # (times, values) oldest first
+        order = (np.arange(len(self.times)) + self.index) % len(self.times)
+        return self.times[order], self.values[:, order]
+
+
+class ScrollingPlot:
+    """
+    Plots a SeriesHistory against the time before now, on fixed axes, so only the lines change between redraws:
+    update() restores the saved axes background, draws the animated lines over it and blits the axes. A full draw
+    (first show, resize, title change) saves a new background.
+    """
+    def __init__(self, fig_agg, ax, labels, window_length, y_limits=(-1.1, 1.1)):
+        self.canvas = fig_agg
+        self.figure = fig_agg.figure
+        self.ax = ax
+        self.title = None
+        self.background = None
+        ax.set_xlim(-window_length, 0)
+        ax.set_ylim(*y_limits)
+        self.lines = [ax.plot([], [], label=label, animated=True)[0] for label in labels]
+        ax.legend(loc='upper left')
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+        self.canvas.draw()
+
+    def _on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._draw_lines()
+
+    def _draw_lines(self):
+        for line in self.lines:
+            self.ax.draw_artist(line)
+
+    def set_title(self, title):
+        if title != self.title:
+            self.title = title
+            self.figure.suptitle(title)
+            self.canvas.draw()
+
+    def update(self, history, now):
+        times, values = history.ordered()
+        for line, series in zip(self.lines, values):
+            line.set_data(times - now, series)
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self._draw_lines()
+        self.canvas.blit(self.ax.bbox)
+        self.canvas.flush_events()
+
+
 # gui helpers
 def make_key(my_component, s_key):
     return '-{}_{}-'.format(my_component, s_key)
@@ -273,16 +473,14 @@ def horizontal_slider(my_component, text_label, s_key, s_resolution, s_range, s_
 
 
 def the_gui():
-    # to get the granularity of the graph, divide window_length by delta_time.
-    # other than that, delta_time is used only to set the window timeout (delta_time * window_length)
+    # the PID outputs are sampled every delta_time seconds, and the last window_length seconds are plotted; the plot
+    # is redrawn --plot-fps times per second, independently of the slider events
     delta_time = 0.1
     window_length = 10
 
-    plot_time = np.arange(0, window_length, delta_time)  # x axis for all plots
-    plot_x_offset = [0] * int(window_length / delta_time)  # y 1
-    plot_x_control_variable = [0] * int(window_length / delta_time)  # y 2
-    plot_y_offset = [0] * int(window_length / delta_time)  # y 3
-    plot_y_control_variable = [0] * int(window_length / delta_time)  # y 4
+    # x offset, x control variable, y offset, y control variable
+    plot_series = ['x_offset', 'x_control_variable', 'y_offset', 'y_control_variable']
+    history = SeriesHistory(len(plot_series), int(window_length / delta_time))
 
     row_label = ['KP Gain', 'Ki Gain', 'Kd Gain', 'Lower Limit', 'Upper Limit', 'Sample Freq', 'Setpoint']
     slider_key = ['kp', 'ki', 'kd', 'lower_limit', 'upper_limit', 'sample_frequency', 'setpoint']
@@ -332,26 +530,32 @@ def the_gui():
     fig = Figure()
     ax = fig.add_subplot(111)
     ax.set_xlabel("Time [s]")
-    ax.set_ylabel("Value")
-    fig.suptitle('Test Plot')
-
+    ax.set_ylabel("Values")
     ax.grid()
     fig_agg = draw_figure(canvas, fig)
-
-    ax.set_xlabel("Time [s]")
-    ax.set_ylabel("X Setpoint Value")
-    fig.suptitle('Test Plot')
-
-    threading.Thread(target=socket_server.bind_and_listen,
-                     args=(t.addr, t.port, t.connect, t.disconnect, t.displacement_received), daemon=True).start()
+    plot = ScrollingPlot(fig_agg, ax, ["X offset", "X Control Variable", "Y Offset", "Y Control Variable"],
+                         window_length)
+
+    if args.udp:
+        # datagrams carry no connection: the control loop stops on --stale-input instead of a disconnect
+        t.channel = DatagramServer(t.addr, t.port, t.displacement_received, args.max_datagram_age)
+        threading.Thread(target=t.channel.serve, daemon=True).start()
+    else:
+        threading.Thread(target=socket_server.bind_and_listen,
+                         args=(t.addr, t.port, t.connect, t.disconnect, t.displacement_received),
+                         kwargs={'control_messages': False}, daemon=True).start()
+    control_thread = threading.Thread(target=t.control_loop, name='control-loop', daemon=True)
+    control_thread.start()
 
     # force window to draw quickly
     event, values = window.read(timeout=0)
 
-    last_time = time.time()
+    next_sample = next_draw = time.monotonic()
     while True:  # Main GUI Event Loop
 
-        event, values = window.read(timeout=int(window_length * delta_time))
+        # wait for an event until the next sample or redraw is due
+        timeout = min(next_sample, next_draw) - time.monotonic()
+        event, values = window.read(timeout=max(0, int(1000 * timeout)))
 
         # event handler
         if event in (sg.WIN_CLOSED, 'Exit') or event == None:
@@ -381,46 +585,28 @@ def the_gui():
                 print("Set tracker value {}: {}".format(my_key, values[event]))
 
         # graph renderer
-        current_time = time.time()
-        dt = current_time - last_time
-        last_time = time.time()
-
-        plot_time[:-1] = plot_time[1:]
-        plot_time[-1] = plot_time[-1] + dt
-
-        # y axis 1
-        plot_x_offset[:-1] = plot_x_offset[1:]
-        plot_x_offset[-1] = t.PID_outputs['x_offset']
-
-        # y axis 2
-        plot_x_control_variable[:-1] = plot_x_control_variable[1:]
-        plot_x_control_variable[-1] = t.PID_outputs['x_control_variable']
-
-        # y axis 3
-        plot_y_offset[:-1] = plot_y_offset[1:]
-        plot_y_offset[-1] = t.PID_outputs['y_offset']
-
-        # y axis 4
-        plot_y_control_variable[:-1] = plot_y_control_variable[1:]
-        plot_y_control_variable[-1] = t.PID_outputs['y_control_variable']
+        now = time.monotonic()
+        if now >= next_sample:
+            history.append(now, [t.PID_outputs[series] for series in plot_series])
+            # a late sample moves the schedule on instead of catching up with a burst of samples
+            next_sample = max(next_sample + delta_time, now)
 
         """
         ** DONE ** the thread updates the values in PID_outputs, which the graph can use for its updates.
         ** DONE ** if the slider values change, the gui will update the thread class pid values.
         """
 
-        ax.cla()
-        ax.set_xlabel("Time [s]")
-        ax.set_ylabel("Values")
-        fig.suptitle("PID Tuning Visualizer (Tracking {})".format(tracking_states[t.is_tracking]))
-        ax.grid()
-        ax.plot(plot_time, plot_x_offset)
-        ax.plot(plot_time, plot_x_control_variable)
-        ax.plot(plot_time, plot_y_offset)
-        ax.plot(plot_time, plot_y_control_variable)
-        ax.legend(["X offset", "X Control Variable", "Y Offset", "Y Control Variable"])
-        fig_agg.draw()
-
+        if now >= next_draw:
+            # the title is outside the blitted axes, so a change of tracking state redraws the whole figure
+            plot.set_title("PID Tuning Visualizer (Tracking {})".format(tracking_states[t.is_tracking]))
+            plot.update(history, now)
+            next_draw = max(next_draw + 1 / args.plot_fps, now)
+
+    t.stop_event.set()
+    control_thread.join()
+    if t.channel is not None:
+        t.channel.stop()
+        print(t.channel.text())
     window.close()
 
 
@@ -430,6 +616,28 @@ if __name__ == '__main__':
                     help="port for data offset receipt")
     ap.add_argument("-d", "--drone-control", type=bool, required=False, default=False,
                     help="enable or disable drone control (this script connects to a drone on the default port)")
+    ap.add_argument("--allow-pickle", action="store_true", required=False, default=False,
+                    help="accept legacy pickled displacement messages (ppn_server --offset-format pickle). "
+                         "Only use this on a trusted network: unpickling network data can execute arbitrary code")
+    ap.add_argument("--udp", action="store_true", required=False, default=False,
+                    help="receive the displacements as UDP datagrams (ppn_server --offset-transport udp), keeping only "
+                         "the newest; out-of-order and duplicate datagrams are dropped and counted")
+    ap.add_argument("--max-datagram-age", required=False, type=float, default=0.0,
+                    help="with --udp, drop displacements captured more than this many seconds ago; needs synchronized "
+                         "clocks. 0 disables it")
+    ap.add_argument("--max-command-rate", required=False, type=float, default=10.0,
+                    help="most velocity commands per second sent to the flight controller, whatever the sample "
+                         "frequency")
+    ap.add_argument("--stale-input", required=False, type=float, default=0.5,
+                    help="seconds without a displacement after which the control loop stops tracking")
+    ap.add_argument("--raw-displacement", action="store_true", required=False, default=False,
+                    help="control on the measured displacement, ignoring the server's latency-compensated prediction")
+    ap.add_argument("--command-latency", required=False, type=float, default=0.0,
+                    help="seconds from sending a velocity command to the vehicle acting on it, added to the prediction")
+    ap.add_argument("--plot-fps", required=False, type=float, default=10.0,
+                    help="redraws per second of the PID plot")
+    ap.add_argument("--latency-report", required=False, type=float, default=10.0,
+                    help="seconds between latency reports of the displacement stream; 0 disables them")
     args = ap.parse_args()
     vehicle = None
 
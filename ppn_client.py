@@ -3,15 +3,22 @@ import os
 os.environ["KIVY_NO_ARGS"] = "1"
 import cv2
 import sys
+import time
 import kivy
 import pickle
 import argparse
+import threading
 import imagezmq
+import zmq
+import numpy as np
 from socket_client import SocketClient
+from video_transport import VIDEO_MODES, FrameReceiver, TransportStats
+from latency import FrameRateCounter, LatencyMonitor
 
 from functools import partial
 from kivy.lang import Builder
 from kivy.app import App
+from kivy.graphics import Color, Ellipse, InstructionGroup, Line
 from kivy.graphics.texture import Texture
 from kivy.uix.button import Button
 from kivy.uix.screenmanager import ScreenManager, Screen
@@ -46,17 +53,52 @@ ap.add_argument("-s", "--server-flip-code", required=False, default=None, type=i
                      "1 means flipping around y-axis;"
                      "-1 means flipping around both axes;"
                      "None means cv2.flip is not called (default).")
+ap.add_argument("-m", "--video-mode", required=False, default='reqrep', choices=VIDEO_MODES,
+                help="must match the server: 'reqrep' acknowledges every frame (default); "
+                     "'pubsub' subscribes to the server's stream and drops frames the UI cannot keep up with")
+ap.add_argument("-n", "--max-in-flight", required=False, type=int, default=2,
+                help="pubsub mode: frames queued on the client before new frames are dropped")
+ap.add_argument("--late-frame", required=False, type=float, default=20,
+                help="milliseconds a received frame may wait for the display before it counts as late")
+ap.add_argument("--latency-report", required=False, type=float, default=10.0,
+                help="seconds between per-stage latency reports (server stages, decode, blit and frame age); "
+                     "0 disables them")
 
 ih_args = ap.parse_args()
 
 kivy.require("1.10.1")
 
-# For REP/REQ:
-imageHub = imagezmq.ImageHub()
-IH_PORT = 5556
+# The server gives every session its own video port and announces it with ('video_port', port); the hub is created
+# then (see CamPage.start_receiver). For REP/REQ the hub binds the port and the server connects to it, for PUB/SUB
+# the server binds it and the hub subscribes.
+imageHub = None
+server_ip = None
+
+# pubsub mode: how often the newest received frame_id is reported to the server (seconds)
+FRAME_ACK_INTERVAL = 0.25
+
+# reports bytes per frame and decode cost of the incoming video stream
+receive_stats = TransportStats('video receiver')
+
+# per-stage latency of the displayed frames, including the server stages carried in the imagezmq msg
+latency = LatencyMonitor('viewer', ih_args.latency_report)
+
+
+def hub_start(open_port):
+    # PUB/SUB hub. The receive high-water mark only applies to new connections, so reconnect after setting it.
+    hub = imagezmq.ImageHub(open_port=open_port, REQ_REP=False)
+    hub.zmq_socket.disconnect(open_port)
+    hub.zmq_socket.setsockopt(zmq.RCVHWM, ih_args.max_in_flight)
+    hub.zmq_socket.setsockopt(zmq.LINGER, 0)
+    hub.zmq_socket.connect(open_port)
+    return hub
+
 
 tracker_index = -1
 tracker_list = []
+tracking_scale = 1.0
+# tracking scales offered on the tracker page
+tracking_scales = [1.0, 0.75, 0.5, 0.25]
 client_socket = SocketClient
 
 root_widget = """
@@ -191,6 +233,19 @@ MyScreenManager:
                 size: min(root.size), min(root.size)
                 pos_hint: {'center_x': .5, 'center_y': .5}
                 id: frame_data
+            Label:
+                id: overlay_text
+                text_size: self.size
+                halign: 'left'
+                valign: 'top'
+                color: 50 / 255, 170 / 255, 50 / 255, 1
+                bold: True
+            Label:
+                id: frame_rate
+                text_size: self.size
+                halign: 'right'
+                valign: 'top'
+                color: 1, 1, 1, 1
 
         AnchorLayout: 
             anchor_x: 'center'
@@ -370,6 +425,19 @@ MyScreenManager:
                 size: min(root.size), min(root.size)
                 pos_hint: {'center_x': .5, 'center_y': .5}
                 id: frame_data
+            Label:
+                id: overlay_text
+                text_size: self.size
+                halign: 'left'
+                valign: 'top'
+                color: 50 / 255, 170 / 255, 50 / 255, 1
+                bold: True
+            Label:
+                id: frame_rate
+                text_size: self.size
+                halign: 'right'
+                valign: 'top'
+                color: 1, 1, 1, 1
 
         AnchorLayout: 
             anchor_x: 'center'
@@ -474,15 +542,11 @@ class ConnectPage(Screen):
     # (second parameter is the time after which this function had been called,
     #  we don't care about it, but kivy sends it, so we have to receive it)
     def connect(self, _):
-        global client_socket
+        global client_socket, server_ip
         # Get information for sockets client
         port = int(self.ids.port.text)
         ip = self.ids.ip.text
-
-        # print("Prepare IH...")
-        # initialize the ImageHub object
-        imageHub.connect("tcp://{}:{}".format(ip, IH_PORT))
-        # print("IH connect")
+        server_ip = ip
 
         client_socket = SocketClient(ip, port)
         if not client_socket.connect(show_error):
@@ -507,6 +571,19 @@ class InfoPage(Screen):
 class CamPage(Screen):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.last_frame_ack = 0
+        # tracking overlay for 'ppn_server --overlay client', drawn over the frame by draw_overlay
+        self.overlay = InstructionGroup()
+        self.overlay_attached = False
+        # (frame_id, frame) of the newest frame received, as sent by the server; targets are selected on it
+        self.displayed = None
+        # one texture is reused while the frame size and the client flip stay the same (see frame_texture)
+        self.texture = None
+        self.texture_key = None
+        self.frame_rate = FrameRateCounter()
+        self.frame_rate_shown = 0.0
+        # receives frames on its own thread; the UI shows the newest one on every Kivy frame (see show_frame)
+        self.receiver = None
         # print("build cam page")
 
     def on_pre_enter(self, *args):
@@ -520,50 +597,218 @@ class CamPage(Screen):
         if not client_socket.is_listening():
             print("socket startup")
             client_socket.start_listening(self.incoming_message, show_error)
-            Clock.schedule_once(self.receive_frame)
-
-    def receive_frame(self, _):
-        # receive RPi name and frame from the RPi and acknowledge the receipt
-        (rpiName, frame) = imageHub.recv_image()
-        imageHub.send_reply(b'OK')
-        if ih_args.flip_code is not None:
-            frame = cv2.flip(frame, ih_args.flip_code)
-
-        buf = frame.tobytes()
-        image_texture = Texture.create(size=(frame.shape[1], frame.shape[0]), colorfmt='bgr')
-        image_texture.blit_buffer(buf, colorfmt='bgr', bufferfmt='ubyte')
+            # an interval of 0 runs show_frame once per Kivy frame, i.e. once per vsync
+            Clock.schedule_interval(self.show_frame, 0)
+
+    def start_receiver(self, port):
+        # the ImageHub for the session's video port, and the receiver thread reading it
+        global imageHub
+        pubsub = ih_args.video_mode == 'pubsub'
+        if pubsub:
+            imageHub = hub_start("tcp://{}:{}".format(server_ip, port))
+        else:
+            imageHub = imagezmq.ImageHub(open_port='tcp://*:{}'.format(port))
+        self.receiver = FrameReceiver(imageHub, reply=not pubsub,
+                                      on_receive=self.acknowledge_frame if pubsub else None, stats=receive_stats,
+                                      late_after=ih_args.late_frame / 1000, latency=latency).start()
+
+    def show_frame(self, _):
+        # display the newest frame (raw or JPEG, decoded by the receiver) from the RPi, if one has arrived
+        item = self.receiver.take() if self.receiver else None
+        if item is None:
+            return
+        rpiName, frame, decode_time, received = item
+        latency.record('decode', decode_time)
+        latency.record('display wait', time.perf_counter() - received)
+        if isinstance(rpiName, dict) and 'frame_id' in rpiName:
+            self.displayed = (rpiName['frame_id'], frame)
+
+        # display image from the texture; the client flip is applied by the texture coordinates
+        blit_start = time.perf_counter()
+        self.blit_frame(self.frame_texture(frame.shape), frame)
+        self.ids.frame_data.canvas.ask_update()
+        displayed = time.perf_counter()
+        latency.record('blit', displayed - blit_start)
+        self.frame_rate.tick(decode_time + displayed - blit_start)
+        if displayed - self.frame_rate_shown >= 0.5:
+            self.frame_rate_shown = displayed
+            self.ids.frame_rate.text = "{}\ndropped {}  late {}".format(self.frame_rate.text(), self.receiver.dropped,
+                                                                     self.receiver.late)
+        if isinstance(rpiName, dict) and 'stages' in rpiName:
+            latency.record_stages(rpiName['stages'], 'server ')
+            latency.record('age at display', time.time() - rpiName['capture_time'])
+        if isinstance(rpiName, dict) and 'overlay' in rpiName:
+            overlay_start = time.perf_counter()
+            self.draw_overlay(rpiName['overlay'], frame.shape)
+            latency.record('overlay', time.perf_counter() - overlay_start)
+
+    def frame_texture(self, frame_shape):
+        # The texture for frames of this shape. A new one is made only when the frame size or the client flip
+        # changes: the flip is set through the texture coordinates, which the Image picks up when it is assigned.
+        key = (frame_shape[1], frame_shape[0], ih_args.flip_code)
+        if key != self.texture_key:
+            texture = Texture.create(size=key[:2], colorfmt='bgr')
+            # mirrors the texture coordinates the way cv2.flip would mirror the pixels
+            if ih_args.flip_code in (0, -1):
+                texture.flip_vertical()
+            if ih_args.flip_code in (1, -1):
+                texture.flip_horizontal()
+            self.texture = texture
+            self.texture_key = key
+            self.ids.frame_data.texture = texture
+        return self.texture
+
+    @staticmethod
+    def blit_frame(texture, frame):
+        # blits straight from the array's buffer; a flat view needs no copy when the frame is contiguous
+        pixels = np.ascontiguousarray(frame).reshape(-1)
+        try:
+            texture.blit_buffer(pixels, colorfmt='bgr', bufferfmt='ubyte')
+        except (TypeError, ValueError):
+            # Kivy builds without buffer protocol support in blit_buffer, or a read-only buffer
+            texture.blit_buffer(pixels.tobytes(), colorfmt='bgr', bufferfmt='ubyte')
+
+    def draw_overlay(self, overlay, frame_shape):
+        """
+        Draws the tracking metadata sent by 'ppn_server --overlay client' with canvas instructions over the displayed
+        frame: the same boxes, crosshair and lines the server would draw into the image, and the text in a label.
+        overlay is None while nothing is tracked.
+        """
+        image = self.ids.frame_data
+        if not self.overlay_attached:
+            image.canvas.after.add(self.overlay)
+            self.overlay_attached = True
+        self.overlay.clear()
+        if not overlay:
+            self.ids.overlay_text.text = ''
+            return
 
-        # display image from the texture
-        self.ids.frame_data.texture = image_texture
+        # frame pixels to window coordinates: the image keeps its aspect ratio and is centred in the widget. The
+        # texture's first row is at the bottom, and the client flip mirrors the frame.
+        frame_height, frame_width = frame_shape[:2]
+        display_width, display_height = image.norm_image_size
+        scale = display_width / frame_width
+        left = image.center_x - display_width / 2
+        bottom = image.center_y - display_height / 2
+        flip_x = ih_args.flip_code in (1, -1)
+        flip_y = ih_args.flip_code in (0, -1)
+
+        def to_window(x, y):
+            x = frame_width - x if flip_x else x
+            y = frame_height - y if flip_y else y
+            return left + x * scale, bottom + y * scale
+
+        targets = overlay['targets']
+        cx, cy = to_window(*overlay['crosshair'])
+        if any(target['ok'] for target in targets):
+            self.overlay.add(Color(1, 1, 1))
+            self.overlay.add(Line(points=[cx - 20 * scale, cy, cx + 20 * scale, cy], width=2.5 * scale))
+            self.overlay.add(Line(points=[cx, cy - 20 * scale, cx, cy + 20 * scale], width=2.5 * scale))
+
+        lines = []
+        for target in targets:
+            label = "#{} {} {:.1f} ms".format(target['id'], target['tracker'], target['cost_ms'])
+            if target['ok']:
+                x, y, w, h = target['bbox']
+                x0, y0 = to_window(x, y)
+                x1, y1 = to_window(x + w, y + h)
+                self.overlay.add(Color(0, 0, 1))
+                self.overlay.add(Line(rectangle=(min(x0, x1), min(y0, y1), abs(x1 - x0), abs(y1 - y0)),
+                                      width=max(1.0, scale)))
+                tx, ty = to_window(*target['centre'])
+                self.overlay.add(Color(1, 1, 1))
+                self.overlay.add(Ellipse(pos=(tx - 5 * scale, ty - 5 * scale), size=(10 * scale, 10 * scale)))
+                self.overlay.add(Color(0, 1, 0))
+                self.overlay.add(Line(points=[cx, cy, tx, ty], width=2.5 * scale))
+            else:
+                label += " lost"
+            lines.append(label)
 
-        # tick for next frame
-        Clock.schedule_once(self.receive_frame, timeout=0.01)
+        primary = targets[0]
+        if len(targets) > 1:
+            text = ["{} targets".format(len(targets))]
+        else:
+            text = [primary['tracker'] + " Tracker"]
+        text += ["FPS : {}".format(int(overlay['fps'])),
+                 "x displacement : {}".format(primary['displacement'][0]),
+                 "y displacement : {}".format(primary['displacement'][1])]
+        if not primary['ok']:
+            text.append("Tracking failure detected")
+        if len(targets) > 1:
+            text += lines
+        self.ids.overlay_text.text = '\n'.join(text)
+
+    def acknowledge_frame(self, msg):
+        # lets the server measure the frames in flight without a per-frame round trip. Called on the receiver thread;
+        # SocketClient.send serializes it with the commands sent from the UI.
+        now = time.monotonic()
+        if isinstance(msg, dict) and now - self.last_frame_ack >= FRAME_ACK_INTERVAL:
+            self.last_frame_ack = now
+            client_socket.send(pickle.dumps(('frame_ack', msg['seq'])))
 
     # Called from sockets client on new message receipt
     def incoming_message(self, message):
         args = pickle.loads(message)
         print(args[0])
         if args[0] == 'disconnect_ok':
+            # the receiver kept acknowledging frames until the server stopped streaming
+            if self.receiver:
+                self.receiver.stop()
             client_socket.listening = False
             App.get_running_app().stop()
 
+        if args[0] == 'video_port':
+            # the server streams this session's video on its own port
+            print("video port", args[1])
+            self.start_receiver(args[1])
+
         if args[0] == 'tracker_list':
-            global tracker_list, tracker_index
+            global tracker_list, tracker_index, tracking_scale
             tracker_list, tracker_index = args[1], args[2]
+            if len(args) > 3:
+                tracking_scale = args[3]
             self.manager.current = 'tracker_page'
 
+        if args[0] == 'budget_switch':
+            # the server changed tracker or scale to keep within its frame budget (ppn_server --frame-budget)
+            tracker_index, tracking_scale = args[1], args[2]  # globals, see 'tracker_list'
+            print("server frame budget: level {}, tracker {}, scale {} ({})".format(
+                args[3], tracker_list[tracker_index] if tracker_index < len(tracker_list) else tracker_index,
+                tracking_scale, args[4]))
+
+        if args[0] == 'selection_snapshot':
+            frame = cv2.imdecode(np.frombuffer(args[2], dtype='uint8'), cv2.IMREAD_COLOR)
+            self.select_targets(args[1], frame)
+
+        if args[0] == 'set_roi_failed':
+            print("selection on frame {} failed: {}".format(args[1], args[2]))
+
         if args[0] == 'raw_selection_data':
-            r = cv2.selectROI('select', args[1], False, False)
-            cv2.destroyWindow("select")
-            client_socket.send(pickle.dumps(('set_roi', args[1], r)))
+            # a frame the server doesn't keep: it is sent back with the selections
+            self.select_targets(args[1], args[1])
 
     def tracker_button(self):
         # print("requesting tracker list...")
         client_socket.send(pickle.dumps(('trackers',)))
 
     def select_button(self):
-        # print("requesting selection")
-        client_socket.send(pickle.dumps(('get_frame',)))
+        # Select on the frame on screen and send back only its frame id; the server initializes the trackers from its
+        # own copy. Without a frame to select on, the server sends a JPEG snapshot.
+        if self.displayed is None:
+            client_socket.send(pickle.dumps(('get_snapshot',)))
+            return
+        frame_id, frame = self.displayed
+        client_socket.send(pickle.dumps(('hold_frame', frame_id)))
+        # off the Kivy thread, like the selections on frames sent by the server
+        threading.Thread(target=self.select_targets, args=(frame_id, frame.copy()), daemon=True).start()
+
+    def select_targets(self, frame_id, frame):
+        # One or more targets: confirm each selection with SPACE or ENTER, finish with ESC. frame_id identifies the
+        # frame to the server in the set_roi message: its frame id, or the frame itself.
+        rois = cv2.selectROIs('select', frame, False, False)
+        cv2.destroyWindow("select")
+        rois = [tuple(int(v) for v in roi) for roi in rois] or [(0, 0, 0, 0)]
+        client_socket.send(pickle.dumps(('set_roi', frame_id, rois)))
 
     def client_flip_button(self):
         flip_index = (flip_list.index(ih_args.flip_code) + 1) % 4
@@ -584,7 +829,7 @@ class CamPage(Screen):
 
     def disconnect_button(self):
         # print('requesting disconnect')
-        Clock.unschedule(self.receive_frame)  # prevents race condition
+        Clock.unschedule(self.show_frame)  # prevents race condition
         client_socket.send(pickle.dumps(('disconnect',)))
 
 
@@ -605,6 +850,11 @@ class TrackerPage(Screen):
             else:
                 text = tracker_list[index]
             val = self.ids.grid.add_widget(Button(text=text, on_press=partial(self.button_clicked, number=index)))
+        for scale in tracking_scales:
+            text = 'Tracking Scale {}'.format(scale)
+            if scale == tracking_scale:
+                text = '[ ' + text + ' ]'
+            self.ids.grid.add_widget(Button(text=text, on_press=partial(self.scale_clicked, scale=scale)))
 
     def remove_buttons(self, *args):
         for child in [child for child in self.grid.children]:
@@ -616,6 +866,11 @@ class TrackerPage(Screen):
         client_socket.send(pickle.dumps(('set_tracker', number)))
         self.manager.current = 'cam_page'
 
+    def scale_clicked(self, caller, scale):
+        # the server runs the tracker on frames downscaled by this factor
+        client_socket.send(pickle.dumps(('set_tracking_scale', scale)))
+        self.manager.current = 'cam_page'
+
 
 class MyScreenManager(ScreenManager):
     connect_page = ObjectProperty(None)
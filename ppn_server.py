@@ -7,9 +7,21 @@ import imagezmq
 import zmq
 import argparse
 import threading
+from collections import deque
+import numpy as np
 import socket_server
+import capture_hub
 from socket_client import SocketClient
-from imutils.video import VideoStream
+from udp_channel import DatagramClient
+from frame_pipeline import DropOldestBuffer, FrameRing, StageWorker
+from displacement_protocol import HANDSHAKE_TIMEOUT, OFFSET_FORMATS, DisplacementEncoder, decode_hello
+from tracking import ENSEMBLE, ENSEMBLE_MEMBERS, FrameBudget, MultiTracker, degradation_levels, \
+    available_tracker_types, target_displacements
+from video_transport import TRANSPORT_MODES, VIDEO_MODES, AdaptiveJpegQuality, TransportStats, encode_jpg
+from frame_sources import FRAME_SOURCES, create_frame_source
+from latency import LatencyMonitor, new_frame_info, stages_ms
+from motion_filter import TargetPredictor
+from synthetic_scene import MOTIONS
 
 
 def int_with_none(value):
@@ -21,6 +33,9 @@ def int_with_none(value):
 
 HEADER_LENGTH = 10
 
+# 'server' draws the overlay into the frame, 'client' sends it as metadata with the clean frame, 'none' skips it
+OVERLAY_MODES = ['server', 'client', 'none']
+
 IP = "127.0.0.1"
 PORT = 1234
 
@@ -36,16 +51,122 @@ ap.add_argument("-f", "--flip-code", required=False, default=None, type=int_with
                      "None means cv2.flip is not called (default).")
 ap.add_argument("-c", "--client-port", required=False, type=int, default=14560,
                 help="sets the port for data offset transmission")
+ap.add_argument("-b", "--send-buffer", required=False, type=int, default=2,
+                help="number of processed frames held for the network sender; the oldest is dropped when full")
+ap.add_argument("-t", "--transport", required=False, default='raw', choices=TRANSPORT_MODES,
+                help="video transport: 'raw' sends uncompressed BGR arrays (default), "
+                     "'jpg' sends JPEG buffers with a quality adapted to the measured send time and bandwidth")
+ap.add_argument("-j", "--jpeg-quality", required=False, type=int, default=80,
+                help="initial JPEG quality for the 'jpg' transport")
+ap.add_argument("--jpeg-quality-range", required=False, type=int, nargs=2, default=[30, 95], metavar=('MIN', 'MAX'),
+                help="limits for the adaptive JPEG quality; set both to the same value for a fixed quality")
+ap.add_argument("--target-send-fps", required=False, type=float, default=30,
+                help="frame rate the adaptive JPEG quality aims to sustain on the video link")
+ap.add_argument("-m", "--video-mode", required=False, default='reqrep', choices=VIDEO_MODES,
+                help="'reqrep' waits for the client to acknowledge every frame (default); "
+                     "'pubsub' publishes frames without waiting, dropping frames for a slow viewer")
+ap.add_argument("--video-port", required=False, type=int, default=5555,
+                help="first video port: every session streams on the lowest free port from here on and tells its "
+                     "client with a ('video_port', port) message")
+ap.add_argument("-n", "--max-in-flight", required=False, type=int, default=2,
+                help="pubsub mode: frames queued for the viewer before new frames are dropped")
+ap.add_argument("-o", "--offset-format", required=False, default='binary', choices=OFFSET_FORMATS,
+                help="preferred displacement message format: 'binary' fixed-layout records (default), or 'pickle' "
+                     "tuples. Over TCP the receiver's hello decides; receivers without one only get pickle")
+ap.add_argument("--offset-transport", required=False, default='tcp', choices=['tcp', 'udp'],
+                help="displacement transport: a 'tcp' connection (default), or 'udp' datagrams that are never "
+                     "retransmitted, for pid-tuner --udp (see udp_channel.py); 'udp' needs the binary offset format")
+ap.add_argument("--tracking-scale", required=False, type=float, default=1.0,
+                help="run the tracker on frames downscaled by this factor (0 < scale <= 1); "
+                     "can be changed at runtime with the set_tracking_scale message")
+ap.add_argument("--tracking-gray", required=False, default=False, action="store_true",
+                help="run the tracker on a grayscale copy of the frame")
+ap.add_argument("--reacquire-threshold", required=False, type=float, default=0.7,
+                help="template match score (0..1) needed to re-acquire a lost target automatically; 0 disables it")
+ap.add_argument("--target-fps", required=False, type=float, default=20,
+                help="frame rate re-acquisition must not push the stream below; bounds the search time per frame")
+ap.add_argument("--frame-budget", required=False, type=float, default=0,
+                help="per-frame tracking budget in milliseconds, e.g. 33; when it is repeatedly missed the session "
+                     "switches to a cheaper tracker or a lower tracking scale, and back once there is headroom again. "
+                     "0 disables it (default)")
+ap.add_argument("--min-tracking-scale", required=False, type=float, default=0.25,
+                help="lowest tracking scale --frame-budget may switch to")
+ap.add_argument("--no-prediction", required=False, default=False, action="store_true",
+                help="don't send the primary target's Kalman-filtered displacement, predicted to the time of "
+                     "sending (see motion_filter.py)")
+ap.add_argument("--process-noise", required=False, type=float, default=300.0,
+                help="prediction: random acceleration of the target (pixels / s^2 per square-root second); higher "
+                     "follows manoeuvres faster, lower smooths more")
+ap.add_argument("--measurement-noise", required=False, type=float, default=4.0,
+                help="prediction: standard deviation of the tracked position (pixels)")
+ap.add_argument("--max-coast", required=False, type=float, default=0.5,
+                help="prediction: seconds a lost target is predicted from its last velocity before it is dropped")
+ap.add_argument("--source", required=False, default='camera', choices=FRAME_SOURCES,
+                help="where frames come from: the 'camera' (default), a 'video' file, a directory of 'images', "
+                     "or a 'synthetic' moving target")
+ap.add_argument("--source-path", required=False, default=None,
+                help="video file or image directory for the 'video' and 'images' sources")
+ap.add_argument("--camera", required=False, type=int, default=0,
+                help="camera index for the 'camera' source")
+ap.add_argument("--source-fps", required=False, type=float, default=None,
+                help="frame rate of replayed and synthetic frames (default: the file's rate, or 30)")
+ap.add_argument("--as-fast-as-possible", required=False, default=False, action="store_true",
+                help="produce replayed and synthetic frames as fast as they are consumed instead of in real time")
+ap.add_argument("--loop", required=False, default=False, action="store_true",
+                help="restart the video file or image directory at its end")
+ap.add_argument("--synthetic-resolution", required=False, type=int, nargs=2, default=[640, 480],
+                metavar=('WIDTH', 'HEIGHT'), help="frame size of the 'synthetic' source")
+ap.add_argument("--synthetic-motion", required=False, default='linear', choices=MOTIONS,
+                help="target motion of the 'synthetic' source")
+ap.add_argument("--synthetic-speed", required=False, type=float, default=4.0,
+                help="target speed of the 'synthetic' source in pixels per frame")
+ap.add_argument("--ensemble-members", required=False, nargs='+', default=list(ENSEMBLE_MEMBERS),
+                choices=available_tracker_types(), metavar='TRACKER',
+                help="trackers the ENSEMBLE tracker runs in parallel and fuses, out of those this OpenCV build has: "
+                     "%(choices)s (default: %(default)s)")
+ap.add_argument("--overlay", required=False, default='server', choices=OVERLAY_MODES,
+                help="'server' draws the tracking overlay into the frame (default); 'client' sends the bounding boxes, "
+                     "displacements, tracker types and FPS as metadata with the clean frame for the viewer to draw; "
+                     "'none' sends neither, for maximum throughput")
+ap.add_argument("--selection-frames", required=False, type=int, default=30,
+                help="recent frames kept per session for target selection by frame id (see the set_roi message)")
+ap.add_argument("--latency-report", required=False, type=float, default=10.0,
+                help="seconds between per-stage latency reports (percentiles and histograms); 0 disables them")
 ih_args = ap.parse_args()
+if ih_args.source in ('video', 'images') and not ih_args.source_path:
+    ap.error("--source {} needs --source-path".format(ih_args.source))
+if ih_args.offset_transport == 'udp' and ih_args.offset_format == 'pickle':
+    ap.error("--offset-transport udp needs --offset-format binary: datagrams are ordered by their sequence numbers")
 
 threads = {}
 
-(major_ver, minor_ver, subminor_ver) = cv2.__version__.split('.')
+# video ports of the running sessions, so no two sessions bind (pubsub) or feed (reqrep) the same endpoint
+_video_ports = set()
+_video_ports_lock = threading.Lock()
+
+
+def acquire_video_port():
+    with _video_ports_lock:
+        port = ih_args.video_port
+        while port in _video_ports:
+            port += 1
+        _video_ports.add(port)
+        return port
+
+
+def release_video_port(port):
+    with _video_ports_lock:
+        _video_ports.discard(port)
 
 
 def sender_start(connect_to=None):
     print("connect to ImageSender")
-    sender = imagezmq.ImageSender(connect_to=connect_to)
+    if ih_args.video_mode == 'pubsub':
+        # the PUB socket binds; frames beyond the high-water mark are dropped instead of blocking the sender
+        sender = imagezmq.ImageSender(connect_to=connect_to, REQ_REP=False)
+        sender.zmq_socket.setsockopt(zmq.SNDHWM, ih_args.max_in_flight)
+    else:
+        sender = imagezmq.ImageSender(connect_to=connect_to)
     sender.zmq_socket.setsockopt(zmq.LINGER, 0)  # prevents ZMQ hang on exit
     # NOTE: because of the way PyZMQ and imageZMQ are implemented, the
     #       timeout values specified must be integer constants, not variables.
@@ -57,6 +178,21 @@ def sender_start(connect_to=None):
     return sender
 
 
+def source_key():
+    # identifies the physical source, so sessions on the same source share one capture hub
+    if ih_args.source == 'camera':
+        return 'camera:{}'.format(ih_args.camera)
+    if ih_args.source == 'synthetic':
+        return 'synthetic'
+    return '{}:{}'.format(ih_args.source, ih_args.source_path)
+
+
+def create_source():
+    return create_frame_source(ih_args.source, ih_args.source_path, ih_args.camera, ih_args.source_fps,
+                               not ih_args.as_fast_as_possible, ih_args.loop, ih_args.synthetic_resolution,
+                               ih_args.synthetic_motion, ih_args.synthetic_speed)
+
+
 def show_error(message):
     print('Offset communications ERROR: ', message)
 
@@ -83,7 +219,11 @@ def app_server_disconnect(client_socket, arg):
 
 def app_message(notified_socket, message):
     t = threads[notified_socket]
-    t.my_queue.put(pickle.loads(message['data']))
+    args = pickle.loads(message['data'])
+    if args[0] == 'frame_ack':
+        # stamped on arrival: the Streamer only reads its queue once per frame, too late to time the delivery
+        args += (time.perf_counter(),)
+    t.my_queue.put(args)
     print('530 putting in queue: ', pickle.loads(message['data'])[0])
 
     if pickle.loads(message['data'])[0] == 'disconnect':
@@ -105,41 +245,203 @@ class Streamer(threading.Thread):
         self.client_name = socket.gethostname()
         self.offset_socket = None
         self.has_socket = False
+        self.displacement_encoder = DisplacementEncoder(ih_args.offset_format)
+        # position and velocity of every target, to predict the primary target past the pipeline latency
+        self.predictor = None
+        if not ih_args.no_prediction:
+            self.predictor = TargetPredictor(ih_args.process_noise, ih_args.measurement_noise, ih_args.max_coast)
 
         # Not all these trackers appear to work with the current opencv ('4.5.4-dev')
         # self.tracker_types = ['BOOSTING', 'MIL', 'KCF', 'TLD', 'MEDIANFLOW', 'GOTURN', 'MOSSE', 'CSRT']
-        self.tracker_types = ['MIL', 'KCF', 'CSRT']
-        self.tracker_type = self.tracker_types[1]
-        self.tracker = self.setup_tracker()
-        self.tracker_ok = False
+        self.tracker_types = ['MIL', 'KCF', 'CSRT', ENSEMBLE]
+        # the tracker and scale the client chose; with --frame-budget the active tracker_type and targets.scale may
+        # be cheaper levels (see apply_budget), and the budget's levels are built from the preferred ones
+        self.preferred_tracker_type = self.tracker_types[1]
+        self.preferred_scale = ih_args.tracking_scale
+        self.tracker_type = self.preferred_tracker_type
+        # every tracked target, each with its own tracker and cached selection (roi_frame, roi) for changing trackers
+        # without making a new selection. Trackers of the offered types are constructed ahead of time, and tracker
+        # switches are initialized in the background while the current tracker keeps running.
+        self.targets = MultiTracker(ih_args.tracking_scale, ih_args.tracking_gray, ih_args.reacquire_threshold,
+                                    self.tracker_types, ih_args.ensemble_members)
+        # steps down from the chosen tracker and scale when tracking keeps missing the frame budget (--frame-budget)
+        self.budget = None
+        if ih_args.frame_budget > 0:
+            self.budget = FrameBudget(ih_args.frame_budget / 1000, self.budget_levels())
         self.flip_list = [0, 1, -1, None]
-        self.vs = None
+        self.flip_code = ih_args.flip_code
+        # the shared capture of the frame source; its frames are read-only and shared with the other sessions
+        self.hub = None
         self.sender = None
-
-        # Caches the selection of roi_frame and roi for changing trackers without making a new selection
-        self.roi_frame = None
-        self.roi = None
+        self.video_port = None
+        self.connect_to = None
+
+        # Pipeline stages: capture -> (this thread) track -> transport. The capture stage takes frames from the
+        # shared capture hub. The capture buffer holds only the newest frame, so tracking always runs on the freshest
+        # image; the send buffer absorbs network stalls.
+        self.capture_buffer = DropOldestBuffer(maxlen=1)
+        self.send_buffer = DropOldestBuffer(maxlen=max(1, ih_args.send_buffer))
+        self.capture_worker = None
+        self.transport_worker = None
+        # the frames recently sent to the client as they were before the overlay, for selections made by frame id
+        self.recent_frames = FrameRing(max(1, ih_args.selection_frames))
+        # frames are numbered by the capture hub; the id and the stage timings travel with the frame to the viewer
+        self.frame_id = 0
+        self.latency = LatencyMonitor('server', ih_args.latency_report)
+
+        self.jpeg_quality = AdaptiveJpegQuality(ih_args.jpeg_quality, *ih_args.jpeg_quality_range,
+                                                target_send_time=1 / ih_args.target_send_fps)
+        # frame_id of the last frame sent and of the last frame the client acknowledged (pubsub mode)
+        self.send_seq = 0
+        self.acked_seq = 0
+        # pubsub mode: (seq, send time, bytes) of the JPEG frames not yet acknowledged, to time their delivery
+        self.unacked = deque(maxlen=256)
+        self.transport_stats = TransportStats('video sender ({})'.format(ih_args.transport))
         print("thread init")
 
     def sender_stop(self):
-        print("Release VS")
-        self.vs.stream.release()
-        self.vs.stop()
-        print("VS Released.")
+        print("Stop pipeline stages")
+        self.capture_worker.stop()
+        self.capture_buffer.close()
+        self.transport_worker.stop()
+        self.send_buffer.close()
+        print("frames dropped; capture: {}, send: {}".format(self.capture_buffer.dropped, self.send_buffer.dropped))
+        print("Release capture hub")
+        capture_hub.release(self.hub)
+        self.hub = None
+        self.recent_frames.clear()
+        self.targets.close()
         self.sender.close()
+        release_video_port(self.video_port)
         self.offset_socket.stop_listening()
         self.offset_socket.client_socket.close()
-        del self.vs
+
+    def budget_levels(self):
+        return degradation_levels(self.preferred_tracker_type, self.preferred_scale, self.tracker_types,
+                                  ih_args.min_tracking_scale)
+
+    def apply_budget(self, costs):
+        # Feeds the frame's tracking cost to the budget and switches every target when the level changes. The client
+        # is told with ('budget_switch', tracker_index, scale, level, reason); level 0 is its own choice.
+        level = self.budget.level
+        switch = self.budget.update(costs.sum())
+        if switch is None:
+            return
+        tracker_type, scale, reason = switch
+        direction = 'down' if self.budget.level > level else 'up'
+        print("frame budget: {} {} at scale {} ({})".format(direction, tracker_type, scale, reason))
+        self.tracker_type = tracker_type
+        self.targets.scale = scale
+        self.targets.restart(None, tracker_type)
+        socket_server.send_message(self.client_socket, ('budget_switch', self.tracker_types.index(tracker_type),
+                                                        scale, self.budget.level, reason))
+
+    def capture_step(self):
+        # capture stage: take the newest frame from the capture hub and flip it (into a frame of our own)
+        if not self.hub.paced and not self.capture_buffer.wait_empty(timeout=0.5):
+            # an unpaced replay produces frames as they are consumed: claim the next one only once tracking took
+            # the last, instead of dropping frames in the capture buffer
+            return
+        frame_id, capture_time, captured, frame = self.hub.wait_newer(self.frame_id, timeout=0.5)
+        if frame is None:
+            return
+        self.frame_id = frame_id
+        info = new_frame_info(frame_id, capture_time, captured)
+        # time from the hub publishing the frame to this session picking it up
+        start = time.perf_counter()
+        info['stages']['capture'] = start - captured
+        if self.flip_code is not None:
+            frame = cv2.flip(frame, self.flip_code)
+            # kept in recent_frames, so the overlay must be drawn on a copy, as for the shared frames
+            frame.flags.writeable = False
+            info['stages']['flip'] = time.perf_counter() - start
+        self.recent_frames.add(frame_id, frame)
+        info['queued'] = time.perf_counter()
+        self.capture_buffer.put((info, frame))
+
+    def transport_step(self):
+        # transport stage: send processed frames to the client, reconnecting on failure
+        item = self.send_buffer.get(timeout=0.5)
+        if item is None:
+            return
+        info, frame = item
+        stages = info['stages']
+        stages['send_wait'] = time.perf_counter() - info['queued']
+        self.send_seq += 1
+        try:
+            if ih_args.transport == 'jpg':
+                start = time.perf_counter()
+                jpg_buffer = encode_jpg(frame, self.jpeg_quality.quality)
+                encoded = time.perf_counter()
+                stages['encode'] = encoded - start
+                self.sender.send_jpg(self.frame_msg(info), jpg_buffer)
+                send_time = time.perf_counter() - encoded
+                if ih_args.video_mode == 'pubsub':
+                    # a PUB send only queues the frame, so the quality follows its delivery instead (see frame_acked)
+                    self.unacked.append((self.send_seq, encoded, jpg_buffer.nbytes))
+                else:
+                    self.jpeg_quality.update(send_time, jpg_buffer.nbytes)
+                self.transport_stats.record(jpg_buffer.nbytes, encoded - start, send_time,
+                                            quality=self.jpeg_quality.quality, in_flight=self.in_flight)
+            else:
+                start = time.perf_counter()
+                self.sender.send_image(self.frame_msg(info), frame)
+                send_time = time.perf_counter() - start
+                self.transport_stats.record(frame.nbytes, 0.0, send_time, in_flight=self.in_flight)
+            stages['send'] = send_time
+            stages['age_at_send'] = time.perf_counter() - info['captured']
+            for stage, seconds in stages.items():
+                self.latency.record(stage, seconds)
+        except (zmq.ZMQError, zmq.ContextTerminated, zmq.Again) as e:
+            self.sender.close()
+            print('Closing ImageSender.', e)
+            time.sleep(0.5)
+            self.sender = sender_start(self.connect_to)
+        except Exception as x:
+            print(354, x)
+
+    def frame_msg(self, info):
+        # the imagezmq msg: 'seq' numbers the frames sent (for frame_ack), 'frame_id' and 'capture_time' identify the
+        # captured frame, 'stages' holds the server stage durations so far in milliseconds. With --overlay client,
+        # 'overlay' holds the tracking metadata of the frame (see overlay_metadata), or None while nothing is tracked.
+        msg = {'name': self.client_name, 'seq': self.send_seq, 'frame_id': info['frame_id'],
+               'capture_time': info['capture_time'], 'stages': stages_ms(info)}
+        if ih_args.overlay == 'client':
+            msg['overlay'] = info.get('overlay')
+        return msg
+
+    def frame_acked(self, seq, received):
+        # The viewer acknowledges a frame as soon as it has received it, so the time from sending the frame to the
+        # ack is its delivery time, including any queueing behind the frames sent before it. In pubsub mode that
+        # drives the JPEG quality in place of the send time.
+        while self.unacked and self.unacked[0][0] < seq:
+            self.unacked.popleft()
+        if self.unacked and self.unacked[0][0] == seq:
+            _, sent, nbytes = self.unacked.popleft()
+            self.jpeg_quality.update(received - sent, nbytes)
+
+    @property
+    def in_flight(self):
+        # frames sent but not yet acknowledged by the viewer; a REQ/REP round trip never has more than one
+        if ih_args.video_mode == 'pubsub':
+            return max(0, self.send_seq - self.acked_seq)
+        return 0
 
     def run(self):
         print("thread running")
-        frame_cropped_len = 0
-        connect_to = "tcp://{}:5555".format(ih_args.server_ip)
-        self.sender = sender_start(connect_to)
-        self.vs = VideoStream(src=0).start()
+        # a video port of its own; the client binds it (reqrep) or subscribes to it (pubsub) once it is told
+        self.video_port = acquire_video_port()
+        self.connect_to = "tcp://{}:{}".format(ih_args.server_ip, self.video_port)  # bound instead in pubsub mode
+        self.sender = sender_start(self.connect_to)
+        socket_server.send_message(self.client_socket, ('video_port', self.video_port))
+        self.hub = capture_hub.acquire(source_key(), create_source)
 
-        self.offset_socket = SocketClient(ih_args.server_ip, ih_args.client_port)
-        self.has_socket = self.offset_socket.connect(show_error)
+        self.capture_worker = StageWorker(self.name + '-capture', self.capture_step)
+        self.transport_worker = StageWorker(self.name + '-transport', self.transport_step)
+        self.capture_worker.start()
+        self.transport_worker.start()
+
+        self.connect_offset_socket()
 
         print("beginning outer try")
         '''
@@ -156,12 +458,13 @@ class Streamer(threading.Thread):
 
         while True:
             # print("read frame")
-            # Read a new frame (this must be above queue processing since set_roi overwrites the frame data once
-            frame = self.vs.read()
-            if ih_args.flip_code is not None:
-                frame = cv2.flip(frame, ih_args.flip_code)
-
-            # ret_code, jpg_buffer = cv2.imencode(".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality])
+            # Take the newest captured frame (this must be above queue processing since set_roi overwrites the frame
+            # data once). None means no new frame arrived in time; control messages are still processed.
+            captured = self.capture_buffer.get_latest(timeout=0.5)
+            info, frame = captured if captured else (None, None)
+            frame_start = time.perf_counter()
+            if info:
+                info['stages']['capture_wait'] = frame_start - info['queued']
 
             # print("frame read")
             try:
@@ -177,7 +480,7 @@ class Streamer(threading.Thread):
                     '''
                     if message == 'disconnect':
                         try:
-                            self.offset_socket.send(pickle.dumps((False, 0, 0, 0, 0)))
+                            self.offset_socket.send(self.displacement_encoder.encode(False, 0, 0, 0, 0))
                         except Exception as ex:
                             print(353, ex, "; displacement socket closed")
                             self.has_socket = False
@@ -187,32 +490,74 @@ class Streamer(threading.Thread):
                         break
 
                     '''
-                    set_roi  ('set_roi', frame, roi)
+                    set_roi  ('set_roi', frame_id, roi[, action[, tracker_index]])
+                        selects targets on a recently sent frame, identified by the frame_id of its msg (see
+                        hold_frame); the trackers are initialized from the server's copy of that frame. If it is no
+                        longer cached the client is sent ('set_roi_failed', frame_id, reason).
+                    set_roi  ('set_roi', frame, roi[, action[, tracker_index]])
+                        the same with the frame itself, for clients that predate frame ids.
                         with this style of message handling it will be implemented a little differently. The arguments
-                        are processed by the running thread so no streaming delay should occur
+                        are processed by the running thread so no streaming delay should occur.
+                        roi is a single (x, y, w, h) selection or a list of them. action 'replace' (default) drops the
+                        current targets first, 'add' tracks the selections alongside them. tracker_index picks the
+                        tracker for the new targets (default: the current tracker).
+                    set_roi  ('set_roi', None, target_id, 'remove')
+                        stops tracking a single target
                     '''
                     if message == 'set_roi':
-                        self.roi_frame, self.roi = args
-                        # print("> frame and roi are present")
-                        frame_cropped_len = len(self.roi_frame[int(self.roi[1]):int(self.roi[1] + self.roi[3]),
-                                                int(self.roi[0]):int(self.roi[0] + self.roi[2])])
-                        if frame_cropped_len > 0:
-                            # print("> cropped frame selected", self.roi)
-                            # Initialize tracker with input frame and bounding box
-                            del self.tracker
-                            self.tracker = self.setup_tracker()
-                            self.tracker_ok = self.tracker.init(self.roi_frame, self.roi)
-                            if not self.has_socket:
-                                self.offset_socket = SocketClient(ih_args.server_ip, ih_args.client_port)
-                                self.has_socket = self.offset_socket.connect(show_error)
-                                if self.has_socket:
-                                    print("set ROI; displacement socket opened")
+                        roi_frame, rois = args[:2]
+                        action = args[2] if len(args) > 2 else 'replace'
+                        if isinstance(roi_frame, (int, np.integer)):
+                            frame_id, roi_frame = roi_frame, self.recent_frames.take(roi_frame)
+                            if roi_frame is None:
+                                print("set_roi: frame", frame_id, "is no longer cached")
+                                socket_server.send_message(self.client_socket, ('set_roi_failed', frame_id,
+                                                                                'frame no longer cached'))
+                                action = None
+                        if action == 'remove':
+                            self.targets.remove(rois)
+                            if not len(self.targets):
+                                self.close_offset_socket("last target removed")
+                        elif action is not None:
+                            tracker_type = self.tracker_type
+                            if len(args) > 3 and args[3] is not None:
+                                tracker_type = self.tracker_types[args[3]]
+                            if action == 'replace':
+                                self.targets.clear()
+                            if np.ndim(rois) == 1:
+                                rois = [rois]
+                            # print("> frame and roi are present")
+                            for roi in rois:
+                                self.targets.add(roi_frame, roi, tracker_type)
+                            if len(self.targets):
+                                self.open_offset_socket("set ROI")
+
+                    '''
+                    hold_frame  ('hold_frame', frame_id)
+                        keeps a recently sent frame cached until a set_roi names it, while the client makes its
+                        selection on the frame it displays
+                    '''
+                    if message == 'hold_frame' and not self.recent_frames.hold(args[0]):
+                        socket_server.send_message(self.client_socket, ('set_roi_failed', args[0],
+                                                                        'frame no longer cached'))
+
+                    '''
+                    get_snapshot  ('get_snapshot')
+                        responds with ('selection_snapshot', frame_id, jpg_buffer): the newest frame as JPEG (at
+                        --jpeg-quality), held for a set_roi with its frame_id, for clients without a displayed frame
+                    '''
+                    if message == 'get_snapshot':
+                        frame_id, snapshot = self.recent_frames.latest()
+                        if snapshot is not None and self.recent_frames.hold(frame_id):
+                            socket_server.send_message(self.client_socket, ('selection_snapshot', frame_id,
+                                                                            encode_jpg(snapshot, ih_args.jpeg_quality)))
 
                     '''
                     get_frame  ('get_frame')
-                        requests the raw frame data be sent via socket, for the client to use in a selectROI window
+                        requests the raw frame data be sent via socket, for the client to use in a selectROI window.
+                        Superseded by selections by frame id (set_roi, hold_frame and get_snapshot).
                     '''
-                    if message == 'get_frame':
+                    if message == 'get_frame' and frame is not None:
                         socket_server.send_message(self.client_socket, ('raw_selection_data', frame, 1))
 
                     '''
@@ -220,56 +565,76 @@ class Streamer(threading.Thread):
                         the arguments are processed by the running thread and the tracker is disabled
                     '''
                     if message == 'clear_roi':
-                        self.roi = None
-                        frame_cropped_len = 0
-                        if self.has_socket:
-                            try:
-                                self.offset_socket.send(pickle.dumps((False, 0, 0, 0, 0)))
-                                self.offset_socket.client_socket.close()
-                                print("roi cleared; displacement socket closed")
-                            except Exception as ex:
-                                print(ex, "; displacement socket closed")
-                            finally:
-                                self.has_socket = False
+                        self.targets.clear()
+                        self.close_offset_socket("roi cleared")
 
                     '''
                     trackers ('trackers')
-                        responds with a list of server-supported trackers and the current tracker's index in that list
+                        responds with a list of server-supported trackers, the current tracker's index in that list
+                        and the current tracking scale
                     '''
                     if message == 'trackers':
                         socket_server.send_message(self.client_socket, ('tracker_list', self.tracker_types,
-                                                                        self.tracker_types.index(self.tracker_type)))
+                                                                        self.tracker_types.index(self.tracker_type),
+                                                                        self.targets.scale))
 
                     '''
-                    set_tracker ('set_tracker', tracker_array_index_from_client)
-                        selects a tracker, re-initializing the tracking algorithm as needed
-                        note: this is not 100% reliable.
+                    set_tracker ('set_tracker', tracker_array_index_from_client[, target_id])
+                        selects a tracker; without a target_id it becomes the tracker of every target and of targets
+                        added later. The new tracker is initialized in the background where the target was last
+                        tracked (on its cached selection while it is lost) and replaces the current one, which keeps
+                        tracking until then. With --frame-budget, the tracker of every target becomes the budget's
+                        preferred choice.
                     '''
                     if message == 'set_tracker':
-                        self.tracker_type = self.tracker_types[args[0]]
-                        if self.roi_frame is not None and self.roi is not None:
-                            # print("< frame and roi are present")
-                            frame_cropped_len = len(self.roi_frame[int(self.roi[1]):int(self.roi[1] + self.roi[3]),
-                                                    int(self.roi[0]):int(self.roi[0] + self.roi[2])])
-                            if frame_cropped_len > 0:
-                                # print("< cropped frame selected", self.roi)
-                                # Initialize tracker with input frame and bounding box
-                                del self.tracker
-                                self.tracker = self.setup_tracker()
-                                self.tracker_ok = self.tracker.init(self.roi_frame, self.roi)
-                                if not self.has_socket:
-                                    self.offset_socket = SocketClient(ih_args.server_ip, ih_args.client_port)
-                                    self.has_socket = self.offset_socket.connect(show_error)
-                                    if self.has_socket:
-                                        print("set tracker; displacement socket opened")
+                        tracker_type = self.tracker_types[args[0]]
+                        target_id = args[1] if len(args) > 1 else None
+                        if target_id is None:
+                            self.preferred_tracker_type = self.tracker_type = tracker_type
+                            if self.budget:
+                                # the budget starts again from level 0: the preferred tracker at the preferred scale
+                                self.targets.scale = self.preferred_scale
+                                self.budget.reset(self.budget_levels())
+                        self.targets.restart(target_id, tracker_type)
+
+                    '''
+                    set_tracking_scale ('set_tracking_scale', scale[, grayscale])
+                        runs the trackers on a copy of the frame downscaled by 'scale' (0 < scale <= 1), converted to
+                        grayscale if requested; boxes and displacements stay in full-resolution coordinates.
+                        The trackers are re-initialized where their targets were last tracked, in the background like
+                        set_tracker.
+                        With --frame-budget, the scale becomes the budget's preferred choice.
+                    '''
+                    if message == 'set_tracking_scale':
+                        if not 0 < args[0] <= 1:
+                            raise ValueError("tracking scale must be in (0, 1], got {}".format(args[0]))
+                        self.preferred_scale = self.targets.scale = args[0]
+                        if len(args) > 1:
+                            self.targets.grayscale = bool(args[1])
+                        if self.budget:
+                            # back to level 0, which also restores the preferred tracker
+                            self.tracker_type = self.preferred_tracker_type
+                            self.budget.reset(self.budget_levels())
+                            self.targets.restart(None, self.tracker_type)
+                        else:
+                            self.targets.restart()
 
                     '''flip ('flip', flip_index)
-                        adjusts the value stored in ih_args.flip_code) for the server-side call to cv2.flip 
+                        adjusts this session's flip code (initially ih_args.flip_code) for the server-side call to
+                        cv2.flip
                         list index: 0, 1, 2, 3 corresponding to the server-side list index of [0, 1, -1, None]
                     '''
                     if message == 'set_flip':
                         # print(message, args)
-                        ih_args.flip_code = self.flip_list[args[0]]
+                        self.flip_code = self.flip_list[args[0]]
+
+                    '''frame_ack ('frame_ack', seq)
+                        periodically sent by a pubsub viewer with the newest frame 'seq' it has received; used to
+                        report the number of frames in flight and to adapt the JPEG quality to their delivery time
+                    '''
+                    if message == 'frame_ack':
+                        self.acked_seq = max(self.acked_seq, args[0])
+                        self.frame_acked(*args)
 
                 self.my_queue.task_done()
             except queue.Empty:
@@ -277,141 +642,197 @@ class Streamer(threading.Thread):
             except Exception as x:
                 print(256, x)
 
-            if frame_cropped_len:
-                x_displacement = 0
-                y_displacement = 0
-
-                ok = True
-                tracker_frame = frame
-                if not ok:
-                    break
-
-                # Start timer
-                timer = cv2.getTickCount()
-
-                # Update tracker
-                ok, bbox = self.tracker.update(tracker_frame)
-
-                # Calculate Frames per second (FPS)
-                fps = cv2.getTickFrequency() / (cv2.getTickCount() - timer)
-
-                # Draw bounding box
-                if ok:
-                    # Tracking success
-                    p1 = (int(bbox[0]), int(bbox[1]))
-                    p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
-                    cv2.rectangle(tracker_frame, p1, p2, (255, 0, 0), 2, 1)
-
-                    #
-                    frame_height, frame_width = tracker_frame.shape[:2]
-                    crosshair_col = int(frame_height / 2)
-                    crosshair_row = int(frame_width / 2)
-
-                    #
-                    crosshair_p1 = (crosshair_row - 20, crosshair_col)
-                    crosshair_p2 = (crosshair_row + 20, crosshair_col)
-                    crosshair_p3 = (crosshair_row, crosshair_col - 20)
-                    crosshair_p4 = (crosshair_row, crosshair_col + 20)
-
-                    #
-                    target_x = int(bbox[0] + int(bbox[2] / 2))
-                    target_y = int(bbox[1] + int(bbox[3] / 2))
-
-                    # target_centroid = (int(bbox[0]+int(bbox[2]/2), int(bbox[1]+int(bbox[3]/2))))
-                    # print statements for debugging
-                    # print("X = " + str(int(bbox[0] + int(bbox[2] / 2))) + " Y = " + str(
-                    #    int(bbox[1] + int(bbox[3] / 2))))
-
-                    cv2.circle(tracker_frame, (target_x, target_y), 5, (255, 255, 255), 5)
-
-                    # Draw saw crosshair
-                    cv2.line(tracker_frame, crosshair_p1, crosshair_p2, (255, 255, 255), 5)
-                    cv2.line(tracker_frame, crosshair_p3, crosshair_p4, (255, 255, 255), 5)
-
-                    # Draw line from crosshair to saw
-                    cv2.line(tracker_frame, (crosshair_row, crosshair_col), (target_x, target_y), (0, 255, 0), 5)
-
-                    x_displacement = target_x - crosshair_row
-                    y_displacement = crosshair_col - target_y
-
-                    if self.has_socket:
-                        try:
-                            self.offset_socket.send(pickle.dumps((True, x_displacement, y_displacement,
-                                                                  frame.shape[1], frame.shape[0]
-                                                                  )))
-                        except Exception as ex:
-                            print(340, ex, "; displacement socket closed")
-                            self.has_socket = False
-                else:
-                    # Tracking failure
-                    cv2.putText(tracker_frame, "Tracking failure detected", (20, 100), cv2.FONT_HERSHEY_SIMPLEX, 0.75,
-                                (170, 50, 50), 2)
-
-                    if self.has_socket:
-                        try:
-                            self.offset_socket.send(pickle.dumps((False, 0, 0, 0, 0)))
-                        except Exception as ex:
-                            print(353, ex, "; displacement socket closed")
-                            self.has_socket = False
-
-                # Display tracker type on frame
-                cv2.putText(tracker_frame, self.tracker_type + " Tracker", (20, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.75,
-                            (50, 170, 50), 2)
-
-                # Display FPS on frame
-                cv2.putText(tracker_frame, "FPS : " + str(int(fps)), (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.75,
-                            (50, 170, 50), 2)
-
-                # Display x displacement
-                cv2.putText(tracker_frame, "x displacement : " + str(x_displacement), (20, 60),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            0.75,
-                            (50, 170, 50), 2)
-
-                # Display y displacement
-                cv2.putText(tracker_frame, "y displacement : " + str(y_displacement), (20, 80),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            0.75,
-                            (50, 170, 50), 2)
-
-                frame = tracker_frame
-
-            try:
-                self.sender.send_image(self.client_name, frame)
-            except (zmq.ZMQError, zmq.ContextTerminated, zmq.Again) as e:
-                self.sender.close()
-                print('Closing ImageSender.', e)
-                time.sleep(0.5)
-                self.sender = sender_start(connect_to)
-            except Exception as x:
-                print(354, x)
+            if frame is None:
+                continue
+
+            if len(self.targets):
+                # Update every tracker; each target's cost is the time its tracker (and any re-acquisition search)
+                # took. Searching for lost targets stops once the frame has used up its share of the target FPS.
+                deadline = frame_start + 1 / ih_args.target_fps
+                track_start = time.perf_counter()
+                target_ids, ok, bboxes, costs = self.targets.update(frame, deadline)
+                info['stages']['track'] = time.perf_counter() - track_start
+
+                # Calculate Frames per second (FPS) the trackers could sustain
+                fps = 1 / costs.sum() if costs.sum() > 0 else 0
+                # frames with a lost target (their cost includes the re-acquisition search) or with a tracker switch
+                # still initializing don't count against the frame budget
+                if self.budget and ok.all() and not self.targets.pending:
+                    self.apply_budget(costs)
+
+                crosshair, centres, displacements = target_displacements(bboxes, frame.shape)
+                displacements[~ok] = 0
+                motion = {}
+                if self.predictor:
+                    predict_start = time.perf_counter()
+                    motion = self.predictor.update(target_ids, ok, displacements, info['captured'])
+                    info['stages']['predict'] = time.perf_counter() - predict_start
+
+                if self.has_socket:
+                    try:
+                        age = time.perf_counter() - info['captured']
+                        timing = (info['frame_id'], age, info['stages']['track'])
+                        # the primary target predicted to now, i.e. past the measured latency from capture to sending
+                        prediction = None
+                        primary = motion.get(int(target_ids[0]))
+                        if primary:
+                            prediction = (*primary.position_at(age), *primary.velocity, age, primary.coasting)
+                        self.offset_socket.send(self.displacement_encoder.encode_batch(
+                            target_ids, ok, displacements, costs, frame.shape[1], frame.shape[0],
+                            info['capture_time'], timing, prediction))
+                    except Exception as ex:
+                        print(340, ex, "; displacement socket closed")
+                        self.has_socket = False
+
+                overlay_start = time.perf_counter()
+                if ih_args.overlay == 'server':
+                    if not frame.flags.writeable:
+                        # a frame shared through the capture hub; draw on a copy of our own
+                        frame = frame.copy()
+                    self.draw_overlay(frame, target_ids, ok, bboxes, crosshair, centres, displacements, costs, fps)
+                elif ih_args.overlay == 'client':
+                    info['overlay'] = self.overlay_metadata(target_ids, ok, bboxes, crosshair, centres, displacements,
+                                                            costs, fps)
+                info['stages']['overlay'] = time.perf_counter() - overlay_start
+
+            # hand the frame to the transport stage; if the link is slow the oldest pending frame is dropped, except
+            # for an unpaced replay, which waits for the link instead
+            if not self.hub.paced:
+                self.send_buffer.wait_empty(timeout=0.5)
+            info['queued'] = time.perf_counter()
+            self.send_buffer.put((info, frame))
 
         # end while loop
         print("thread ending")
 
-    def setup_tracker(self):
-        tracker = None
-        if int(minor_ver) < 3:
-            tracker = cv2.Tracker_create(self.tracker_type)
+    def draw_overlay(self, tracker_frame, target_ids, ok, bboxes, crosshair, centres, displacements, costs, fps):
+        crosshair_row, crosshair_col = int(crosshair[0]), int(crosshair[1])
+        if ok.any():
+            crosshair_p1 = (crosshair_row - 20, crosshair_col)
+            crosshair_p2 = (crosshair_row + 20, crosshair_col)
+            crosshair_p3 = (crosshair_row, crosshair_col - 20)
+            crosshair_p4 = (crosshair_row, crosshair_col + 20)
+
+            # Draw saw crosshair
+            cv2.line(tracker_frame, crosshair_p1, crosshair_p2, (255, 255, 255), 5)
+            cv2.line(tracker_frame, crosshair_p3, crosshair_p4, (255, 255, 255), 5)
+
+        for i, target_id in enumerate(target_ids):
+            target = self.targets.targets[target_id]
+            p1 = (int(bboxes[i, 0]), int(bboxes[i, 1]))
+            label = "#{} {} {:.1f} ms".format(target_id, target.tracker_type, 1000 * costs[i])
+            if ok[i]:
+                # Tracking success
+                p2 = (int(bboxes[i, 0] + bboxes[i, 2]), int(bboxes[i, 1] + bboxes[i, 3]))
+                cv2.rectangle(tracker_frame, p1, p2, (255, 0, 0), 2, 1)
+
+                target_x, target_y = int(centres[i, 0]), int(centres[i, 1])
+                cv2.circle(tracker_frame, (target_x, target_y), 5, (255, 255, 255), 5)
+
+                # Draw line from crosshair to saw
+                cv2.line(tracker_frame, (crosshair_row, crosshair_col), (target_x, target_y), (0, 255, 0), 5)
+            else:
+                label += " lost"
+            if len(target_ids) > 1:
+                cv2.putText(tracker_frame, label, (p1[0], max(p1[1] - 8, 12)), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                            (50, 170, 50), 1)
+
+        if not ok[0]:
+            # Tracking failure of the primary target
+            cv2.putText(tracker_frame, "Tracking failure detected", (20, 100), cv2.FONT_HERSHEY_SIMPLEX, 0.75,
+                        (170, 50, 50), 2)
+
+        # Display tracker type on frame
+        if len(target_ids) > 1:
+            tracker_text = "{} targets".format(len(target_ids))
         else:
-            if self.tracker_type == 'BOOSTING':
-                tracker = cv2.TrackerBoosting_create()
-            if self.tracker_type == 'MIL':
-                tracker = cv2.TrackerMIL_create()
-            if self.tracker_type == 'KCF':
-                tracker = cv2.TrackerKCF_create()
-            if self.tracker_type == 'TLD':
-                tracker = cv2.TrackerTLD_create()
-            if self.tracker_type == 'MEDIANFLOW':
-                tracker = cv2.TrackerMedianFlow_create()
-            if self.tracker_type == 'GOTURN':
-                tracker = cv2.TrackerGOTURN_create()
-            if self.tracker_type == 'MOSSE':
-                tracker = cv2.TrackerMOSSE_create()
-            if self.tracker_type == "CSRT":
-                tracker = cv2.TrackerCSRT_create()
-
-        return tracker
+            tracker_text = self.targets.targets[target_ids[0]].tracker_type + " Tracker"
+        cv2.putText(tracker_frame, tracker_text, (20, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.75,
+                    (50, 170, 50), 2)
+
+        # Display FPS on frame
+        cv2.putText(tracker_frame, "FPS : " + str(int(fps)), (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.75,
+                    (50, 170, 50), 2)
+
+        # Display x displacement (of the primary target)
+        cv2.putText(tracker_frame, "x displacement : " + str(displacements[0, 0]), (20, 60),
+                    cv2.FONT_HERSHEY_SIMPLEX,
+                    0.75,
+                    (50, 170, 50), 2)
+
+        # Display y displacement
+        cv2.putText(tracker_frame, "y displacement : " + str(displacements[0, 1]), (20, 80),
+                    cv2.FONT_HERSHEY_SIMPLEX,
+                    0.75,
+                    (50, 170, 50), 2)
+
+    def overlay_metadata(self, target_ids, ok, bboxes, crosshair, centres, displacements, costs, fps):
+        # the overlay draw_overlay would draw, as JSON-serializable values in frame pixel coordinates
+        return {
+            'crosshair': crosshair.tolist(),
+            'fps': round(float(fps), 1),
+            'targets': [{'id': int(target_id),
+                         'tracker': self.targets.targets[target_id].tracker_type,
+                         'ok': bool(ok[i]),
+                         'bbox': [int(v) for v in bboxes[i]],
+                         'centre': centres[i].tolist(),
+                         'displacement': displacements[i].tolist(),
+                         'cost_ms': round(1000 * float(costs[i]), 2)}
+                        for i, target_id in enumerate(target_ids)],
+        }
+
+    def new_offset_socket(self):
+        if ih_args.offset_transport == 'udp':
+            return DatagramClient(ih_args.server_ip, ih_args.client_port)
+        return SocketClient(ih_args.server_ip, ih_args.client_port)
+
+    def connect_offset_socket(self):
+        self.offset_socket = self.new_offset_socket()
+        self.has_socket = self.offset_socket.connect(show_error)
+        if self.has_socket and ih_args.offset_transport == 'tcp':
+            self.negotiate_offset_format()
+
+    def negotiate_offset_format(self):
+        # Waits for the receiver's hello, which lists the displacement formats it accepts (see
+        # displacement_protocol.py). Datagrams are always binary, so there is no handshake over UDP.
+        hello = threading.Event()
+        accepted = []
+
+        def hello_received(message):
+            formats = decode_hello(message)
+            if formats is not None and not hello.is_set():
+                accepted.extend(formats)
+                hello.set()
+
+        self.offset_socket.start_listening(hello_received, show_error)
+        if not hello.wait(HANDSHAKE_TIMEOUT):
+            print("no displacement format hello from the receiver; assuming it only understands pickle")
+            accepted = None
+        try:
+            print("displacement format:", self.displacement_encoder.negotiate(accepted))
+        except ValueError as ex:
+            print(ex, "; displacement socket closed")
+            self.offset_socket.stop_listening()
+            self.offset_socket.client_socket.close()
+            self.has_socket = False
+
+    def open_offset_socket(self, reason):
+        if not self.has_socket:
+            self.connect_offset_socket()
+            if self.has_socket:
+                print(reason + "; displacement socket opened")
+
+    def close_offset_socket(self, reason):
+        if self.has_socket:
+            try:
+                self.offset_socket.send(self.displacement_encoder.encode(False, 0, 0, 0, 0))
+                self.offset_socket.stop_listening()
+                self.offset_socket.client_socket.close()
+                print(reason + "; displacement socket closed")
+            except Exception as ex:
+                print(ex, "; displacement socket closed")
+            finally:
+                self.has_socket = False
 
 
 def main():
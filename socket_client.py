@@ -1,6 +1,7 @@
 # original code from https://pythonprogramming.net/pickle-objects-sockets-tutorial-python-3/
+import select
 import socket
-from threading import Thread
+from threading import Lock, Thread
 
 # some globals
 HEADER_LENGTH = 10
@@ -13,6 +14,10 @@ class SocketClient:
         self.listening = False
         self.socket_thread = None
         self.client_socket = None
+        # stop_listening() writes to this pair to wake the listening thread out of select()
+        self._wakeup_r = self._wakeup_w = None
+        # send() may be called from several threads; each message must go out whole
+        self._send_lock = Lock()
 
     # Connects to the server
     def connect(self, error_callback):
@@ -36,7 +41,8 @@ class SocketClient:
         # Encode message to bytes, prepare header and convert to bytes, like for username above, then send
         message = msg
         message_header = f"{len(message):<{HEADER_LENGTH}}".encode('utf-8')
-        self.client_socket.sendall(message_header + message)
+        with self._send_lock:
+            self.client_socket.sendall(message_header + message)
 
     def is_listening(self):
         return self.listening == True
@@ -46,6 +52,7 @@ class SocketClient:
     # error_callback - callback to be called on error
     def start_listening(self, incoming_message_callback, error_callback):
         if not self.listening:
+            self._wakeup_r, self._wakeup_w = socket.socketpair()
             self.socket_thread = Thread(target=self._listen,
                                         args=(incoming_message_callback, error_callback),
                                         daemon=True)
@@ -55,45 +62,87 @@ class SocketClient:
     def stop_listening(self):
         self.listening = False
         print(__name__, "waiting to stop")
+        if self._wakeup_w:
+            try:
+                self._wakeup_w.send(b'\0')
+            except OSError:
+                pass
         if self.socket_thread:
             self.socket_thread.join()
         print(__name__, "stopped")
 
+    # Waits until the socket is readable. Returns False if stop_listening() was called meanwhile.
+    def _wait_readable(self):
+        readable, _, _ = select.select([self.client_socket, self._wakeup_r], [], [])
+        return self._wakeup_r not in readable and self.listening
+
+    # Fills view[:length], first from the read-ahead buffer and then from the socket. Small reads refill the read-ahead
+    # buffer, so a burst of small messages costs a single recv; large remainders are received directly into view.
+    # Returns the number of bytes received, which is less than length only if listening was stopped or the server
+    # closed the connection.
+    def _recv_into(self, view, length):
+        received = min(length, self._ahead_end - self._ahead_start)
+        view[:received] = self._ahead_view[self._ahead_start:self._ahead_start + received]
+        self._ahead_start += received
+        while received < length and self._wait_readable():
+            if length - received >= len(self._ahead_view):
+                n = self.client_socket.recv_into(view[received:length])
+            else:
+                n = self.client_socket.recv_into(self._ahead_view)
+                self._ahead_start, self._ahead_end = 0, n
+                chunk = min(n, length - received)
+                view[received:received + chunk] = self._ahead_view[:chunk]
+                self._ahead_start = chunk
+                n = chunk
+            if not n:
+                break
+            received += n
+        return received
+
     # Listen for incoming messages
+    # The message passed to incoming_message_callback is a memoryview into a buffer that is reused for the next
+    # message, so the callback must decode (or copy) it before returning.
     def _listen(self, incoming_message_callback, error_callback):
-        while self.listening:
-            try:
-                while self.listening:
-                    try:
-                        message_header = self.client_socket.recv(HEADER_LENGTH)
-
-                        # If we received no data, server gracefully closed a connection, for example using
-                        # socket.close() or socket.shutdown(socket.SHUT_RDWR)
-                        if not len(message_header):
-                            error_callback('Connection closed by the server')
-
-                        # Convert header to int value
-                        message_length = int(message_header.decode('utf-8').strip())
-                        message = b''
-                        while len(message) < message_length:
-                            remains = message_length - len(message)
-                            bufsize = 4096 if remains > 4096 else remains
-                            buf = self.client_socket.recv(bufsize)
-                            if not buf:
-                                self.client_socket.close()
-                                self.listening = False
-                                break
-                            message += buf
-
-                        # Print message to client
-                        incoming_message_callback(message)
-                    except socket.timeout:
-                        continue
-                print(__name__, "socket done listening (inner)", self.listening)
-            except Exception as e:
-                # Any other exception - something happened, exit
-                error_callback('Reading error: {}'.format(str(e)))
-                print(__name__, "Break after error")
-                self.listening = False
-                break
-        print(__name__, "socket done listening (outer)", self.listening)
+        self._ahead_view = memoryview(bytearray(65536))
+        self._ahead_start = self._ahead_end = 0
+        message_header = bytearray(HEADER_LENGTH)
+        header_view = memoryview(message_header)
+        # grown to the largest message seen so far, then reused
+        buffer = bytearray(4096)
+        buffer_view = memoryview(buffer)
+        try:
+            while self.listening:
+                received = self._recv_into(header_view, HEADER_LENGTH)
+                if not self.listening:
+                    break
+
+                # If we received no data, server gracefully closed a connection, for example using
+                # socket.close() or socket.shutdown(socket.SHUT_RDWR)
+                if received < HEADER_LENGTH:
+                    error_callback('Connection closed by the server')
+                    self.listening = False
+                    break
+
+                # Convert header to int value
+                message_length = int(message_header)
+                if message_length > len(buffer):
+                    buffer = bytearray(message_length)
+                    buffer_view = memoryview(buffer)
+
+                if self._recv_into(buffer_view, message_length) < message_length:
+                    if self.listening:
+                        self.client_socket.close()
+                        self.listening = False
+                    break
+
+                # Print message to client
+                incoming_message_callback(buffer_view[:message_length])
+        except Exception as e:
+            # Any other exception - something happened, exit
+            error_callback('Reading error: {}'.format(str(e)))
+            print(__name__, "Break after error")
+            self.listening = False
+        finally:
+            self._wakeup_r.close()
+            self._wakeup_w.close()
+        print(__name__, "socket done listening", self.listening)
@@ -1,28 +1,80 @@
-import socket
-import select
+import asyncio
+import concurrent.futures
 import pickle
+import threading
 
 # some globals
 HEADER_LENGTH = 10
 listening = False
 
+# bytes queued for one peer before Connection.sendall() waits for it to catch up, and how long it waits (seconds)
+WRITE_HIGH_WATER = 256 * 1024
+SEND_TIMEOUT = 5.0
 
-def receive_message(client_socket):
-    try:
-        message_header = client_socket.recv(HEADER_LENGTH)
+_servers = set()
+_servers_lock = threading.Lock()
+
+
+class FramedReader:
+    """
+    Incremental parser for the length-prefixed messages of one connection, received into a reusable buffer.
+
+    bind_and_listen feeds it from an asyncio.BufferedProtocol: the transport receives straight into get_buffer() and
+    reports the byte count to buffer_updated(). A select() loop over a plain socket does the same with recv_into()
+    (see bench_framed_reader.py). messages() then yields every complete message buffered so far, however the stream
+    was fragmented or coalesced by TCP. Messages are {'header': ..., 'data': ...} dictionaries of memoryviews into the
+    buffer: they are only valid until the next get_buffer(), so copy anything that must be kept longer.
+    """
+    def __init__(self, buffer_size=65536):
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first byte not yet handed out
+        self._end = 0  # end of the buffered data
 
-        if not len(message_header):
-            return False
+    def get_buffer(self):
+        # The free space to receive into. Moves the unparsed tail to the front of the buffer first (this invalidates
+        # previously returned messages).
+        pending = self._end - self._start
+        if self._start:
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+        if self._end == len(self._buffer):
+            self._grow(2 * len(self._buffer))
+        return self._view[self._end:]
 
-        message_length = int(message_header.decode('utf-8').strip())
-        return {'header': message_header, 'data': client_socket.recv(message_length)}
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
 
-    except:
-        return False
+    def _grow(self, size):
+        # A new buffer is allocated rather than resizing the old one, so views already handed out remain valid.
+        pending = self._end - self._start
+        buffer = bytearray(size)
+        buffer[:pending] = self._view[self._start:self._end]
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._start, self._end = 0, pending
+
+    def messages(self):
+        while self._end - self._start >= HEADER_LENGTH:
+            header = self._view[self._start:self._start + HEADER_LENGTH]
+            message_length = int(header.tobytes())
+            message_end = self._start + HEADER_LENGTH + message_length
+            if message_end > self._end:
+                # incomplete message: make sure the buffer can hold all of it, then wait for more data
+                if HEADER_LENGTH + message_length > len(self._buffer):
+                    self._grow(HEADER_LENGTH + message_length)
+                return
+            data = self._view[self._start + HEADER_LENGTH:message_end]
+            self._start = message_end
+            yield {'header': header, 'data': data}
 
 
 def send_message(client_socket, message_tuple):
-    message = pickle.dumps(message_tuple)
+    send_data(client_socket, pickle.dumps(message_tuple))
+
+
+def send_data(client_socket, message):
+    # sends bytes that are already encoded, e.g. a displacement_protocol hello
     message_header = f"{len(message):<{HEADER_LENGTH}}".encode('utf-8')
     try:
         client_socket.sendall(message_header + message)
@@ -30,95 +82,214 @@ def send_message(client_socket, message_tuple):
         print(__name__, "send_message caught exception", ex)
 
 
+class _FramedProtocol(asyncio.BufferedProtocol):
+    """
+    Receives one connection straight into its FramedReader. Reading pauses whenever data has arrived and the
+    connection task resumes it once every buffered message has been handled, so the buffer the messages view is never
+    written while a callback runs, and a slow callback holds up its client through TCP flow control.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.framed = FramedReader()
+        self.transport = None
+        self.closed = False
+        self.received = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+        self.server.connection_made(self)
+
+    def get_buffer(self, sizehint):
+        return self.framed.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.framed.buffer_updated(nbytes)
+        self.transport.pause_reading()
+        self.received.set()
+
+    def eof_received(self):
+        self.closed = True
+        self.received.set()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.received.set()
+        self.writable.set()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+
+class Connection:
+    """
+    An accepted connection, handed to the bind_and_listen callbacks in place of its socket.
+
+    sendall() may be called from any thread (send_message uses it). It blocks while more than WRITE_HIGH_WATER bytes
+    are waiting to be sent to this peer, so a client that stops reading slows down its own sender instead of filling
+    the server's memory; after send_timeout seconds it raises TimeoutError.
+    """
+    def __init__(self, protocol, loop, send_timeout=SEND_TIMEOUT):
+        self.protocol = protocol
+        self.loop = loop
+        self.send_timeout = send_timeout
+        self.peername = protocol.transport.get_extra_info('peername')
+        self.name = '{}:{}'.format(*self.peername[:2])
+
+    def __repr__(self):
+        return '<Connection {}>'.format(self.name)
+
+    def getpeername(self):
+        return self.peername
+
+    @property
+    def closed(self):
+        return self.protocol.closed
+
+    async def _write(self, data):
+        if self.protocol.closed:
+            raise ConnectionError("connection to {} is closed".format(self.name))
+        self.protocol.transport.write(data)
+        await self.protocol.writable.wait()
+
+    def sendall(self, data):
+        if self.closed:
+            raise ConnectionError("connection to {} is closed".format(self.name))
+        future = asyncio.run_coroutine_threadsafe(self._write(data), self.loop)
+        try:
+            future.result(self.send_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError("{} is not reading; send timed out".format(self.name))
+
+
 def stop_listening():
+    # shuts down every running bind_and_listen server (see ControlServer.stop)
     global listening
     listening = False
+    with _servers_lock:
+        servers = list(_servers)
+    for server in servers:
+        server.stop()
 
 
-def bind_and_listen(ip, port, connect_callback, disconnect_callback, message_callback):
-    global listening
-    # Create a socket socket.AF_INET - address family, IPv4, some otehr possible are AF_INET6, AF_BLUETOOTH,
-    # AF_UNIX socket.SOCK_STREAM - TCP, conection-based, socket.SOCK_DGRAM - UDP, connectionless, datagrams,
-    # socket.SOCK_RAW - raw IP packets
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+class ControlServer:
+    """
+    asyncio server for length-prefixed messages (see bind_and_listen).
 
-    # SO_ - socket option
-    # SOL_ - socket option level
-    # Sets REUSEADDR (as a socket option) to 1 on socket
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    Each connection is received into its own FramedReader (see _FramedProtocol) and served by its own task, which
+    hands the buffered messages to the callbacks one at a time. The callbacks run in a thread pool, never on the event
+    loop, and reading only resumes once the callbacks for the buffered messages have returned: messages of one client
+    are handled in order, and a slow callback holds up only its own client, which TCP flow control then slows down.
+    """
+    def __init__(self, connect_callback, disconnect_callback, message_callback, control_messages=True,
+                 callback_workers=32, shutdown_timeout=5.0):
+        self.connect_callback = connect_callback
+        self.disconnect_callback = disconnect_callback
+        self.message_callback = message_callback
+        self.control_messages = control_messages
+        self.shutdown_timeout = shutdown_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(callback_workers, thread_name_prefix='socket_server')
+        self.loop = None
+        self.tasks = set()
+        self._stop_event = None
 
-    # Bind, so server informs operating system that it's going to use given IP and port For a server using 0.0.0.0
-    # means to listen on all available interfaces, useful to connect locally to 127.0.0.1 and remotely to LAN
-    # interface IP
-    server_socket.bind((ip, port))
+    async def _call(self, callback, *args):
+        if callback:
+            try:
+                await self.loop.run_in_executor(self.executor, callback, *args)
+            except asyncio.CancelledError:
+                # an Exception before Python 3.8; the connection task must see it to stop
+                raise
+            except Exception as ex:
+                print(__name__, 'callback error:', callback.__name__, ex)
 
-    # This makes server listen to new connections
-    server_socket.listen()
+    async def _serve_connection(self, protocol):
+        connection = Connection(protocol, self.loop)
+        print(__name__, 'Accepted new connection from ', connection.name)
+        # disconnect callback argument: -1 when the peer went away, 0 when the server shuts down, None after a
+        # ('disconnect',) control message (which the message callback has already handled)
+        reason = -1
+        try:
+            await self._call(self.connect_callback, connection)
+            while True:
+                for message in protocol.framed.messages():
+                    await self._call(self.message_callback, connection, message)
+                    if self.control_messages and pickle.loads(message['data'])[0] == 'disconnect':
+                        reason = None
+                        break
+                if reason is None or protocol.closed:
+                    break
+                protocol.received.clear()
+                protocol.transport.resume_reading()
+                await protocol.received.wait()
+        except ValueError as ex:
+            # malformed length header; the stream cannot be resynchronised
+            print(__name__, 'Bad message header from', connection.name, ex)
+        except asyncio.CancelledError:
+            reason = 0
+        if reason is not None:
+            await self._call(self.disconnect_callback, connection, reason)
+            print(__name__, 'Closed connection from: ', connection.name)
+        protocol.closed = True
+        protocol.transport.close()
 
-    # List of sockets for select.select()
-    sockets_list = [server_socket]
+    def connection_made(self, protocol):
+        task = self.loop.create_task(self._serve_connection(protocol))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
 
-    clients = {}
+    async def serve(self, ip, port):
+        self.loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        server = await self.loop.create_server(lambda: _FramedProtocol(self), ip, port, reuse_address=True,
+                                               backlog=1024)
+        print(__name__, f'Listening for connections on {ip}:{port}...')
+        async with server:
+            await self._stop_event.wait()
+            # graceful shutdown: stop accepting, let every connection run its disconnect callback, then close
+            server.close()
+            for task in list(self.tasks):
+                task.cancel()
+            if self.tasks:
+                _, pending = await asyncio.wait(list(self.tasks), timeout=self.shutdown_timeout)
+                if pending:
+                    # the executor must outlive every disconnect callback, so keep waiting for them
+                    print(__name__, '{} connections still in a callback after {} s'.format(len(pending),
+                                                                                     self.shutdown_timeout))
+                    await asyncio.wait(pending)
+        self.executor.shutdown(wait=False)
+        print(__name__, 'Stopped listening on {}:{}'.format(ip, port))
 
-    print(__name__, f'Listening for connections on {ip}:{port}...')
-    listening = True
+    def stop(self):
+        if self.loop and self._stop_event:
+            self.loop.call_soon_threadsafe(self._stop_event.set)
+
+
+def bind_and_listen(ip, port, connect_callback, disconnect_callback, message_callback, control_messages=True):
+    """
+    Serves length-prefixed messages on ip:port until stop_listening() is called; blocks the calling thread.
 
-    while listening:
-        # Calls Unix select() system call or Windows select() WinSock call with three parameters:
-        #   - rlist - sockets to be monitored for incoming data
-        #   - wlist - sockets for data to be send to (checks if for example buffers are not full and socket is ready to
-        #             send some data)
-        #   - xlist - sockets to be monitored for exceptions (we want to monitor all sockets for errors, so we can use
-        #             rlist)
-        # Returns lists:
-        #   - reading - sockets we received some data on (that way we don't have to check sockets manually)
-        #   - writing - sockets ready for data to be send thru them
-        #   - errors  - sockets with some exceptions
-        # This is a blocking call, code execution will "wait" here and "get" notified in case any action should be taken
-        read_sockets, _, exception_sockets = select.select(sockets_list, [], sockets_list)
-
-        # Iterate over notified sockets
-        for notified_socket in read_sockets:
-
-            if notified_socket == server_socket:
-
-                client_socket, client_address = server_socket.accept()
-
-                # Add accepted socket to select.select() list
-                sockets_list.append(client_socket)
-
-                user = '{}:{}'.format(*client_address)
-
-                clients[client_socket] = user
-                print(__name__, 'Accepted new connection from ', user)
-
-                if connect_callback:
-                    connect_callback(client_socket)
-
-            # Else existing socket is sending a message
-            else:
-                # Receive message
-                message = receive_message(notified_socket)
-
-                # If False, client disconnected, cleanup
-                if message is False:
-                    if disconnect_callback:
-                        disconnect_callback(notified_socket, -1)
-
-                    print(__name__, 'Closed connection from: ', clients[notified_socket])
-                else:
-                    if message_callback:
-                        message_callback(notified_socket, message)
-
-                if message is False or pickle.loads(message['data'])[0] == 'disconnect':
-                    print(__name__, 'Closing socket')
-                    sockets_list.remove(notified_socket)
-                    del clients[notified_socket]
-                    notified_socket.close()
-                    print(__name__, 'Socket closed')
-
-        # It's not really necessary to have this, but will handle some socket exceptions just in case
-        for notified_socket in exception_sockets:
-            print(__name__, "Disconnecting a client")
-            if disconnect_callback:
-                disconnect_callback(notified_socket, 0)
+    Callbacks receive a Connection in place of the client socket (socket_server.send_message works with it):
+      connect_callback(connection), message_callback(connection, {'header': ..., 'data': ...}),
+      disconnect_callback(connection, -1 if the client went away, 0 on server shutdown).
+    The message header and data are memoryviews into the connection's receive buffer, valid until the message
+    callback returns: decode or copy them there.
+    control_messages: the peers send pickled control tuples, and a ('disconnect',) tuple closes the connection.
+    Set it to False for data streams (e.g. binary displacement records) so their payloads are never unpickled.
+    """
+    global listening
+    server = ControlServer(connect_callback, disconnect_callback, message_callback, control_messages)
+    with _servers_lock:
+        _servers.add(server)
+    listening = True
+    try:
+        asyncio.run(server.serve(ip, port))
+    finally:
+        with _servers_lock:
+            _servers.discard(server)
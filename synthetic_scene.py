@@ -0,0 +1,75 @@
+"""
+Synthetic moving-target clips with exact ground truth, for benchmarking the trackers without a camera.
+
+The scene is a blurred noise background with a textured rectangle moving over it. Everything is derived from the seed,
+so the same arguments always give the same frames.
+"""
+import math
+import cv2
+import numpy as np
+
+MOTIONS = ['linear', 'circle', 'random']
+
+
+class SyntheticScene:
+    """
+    render(index) returns (frame, bbox) for frame number 'index': a BGR uint8 image and the target's (x, y, w, h).
+
+    motion is 'linear' (bouncing off the frame edges), 'circle' (around the frame centre) or 'random' (a random walk);
+    speed is in pixels per frame. noise adds Gaussian sensor noise with that standard deviation to every frame.
+    """
+    def __init__(self, width=640, height=480, motion='linear', speed=4.0, target_size=(64, 48), noise=0.0, seed=0):
+        if motion not in MOTIONS:
+            raise ValueError("unknown motion: {}".format(motion))
+        self.width = width
+        self.height = height
+        self.motion = motion
+        self.speed = speed
+        self.target_width, self.target_height = target_size
+        self.noise = noise
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self.background = cv2.GaussianBlur(rng.integers(0, 160, (height, width, 3), dtype=np.uint8), (0, 0), 4)
+        target = rng.integers(0, 256, (self.target_height, self.target_width, 3), dtype=np.uint8)
+        self.target = cv2.GaussianBlur(target, (0, 0), 1.5)
+        cv2.rectangle(self.target, (0, 0), (self.target_width - 1, self.target_height - 1), (255, 255, 255), 2)
+        self._restart_walk()
+
+    def _restart_walk(self):
+        # only the current position of the random walk is kept, so endless clips use constant memory
+        self._walk_index = 0
+        self._walk_position = (float(self.width - self.target_width) / 2, float(self.height - self.target_height) / 2)
+        self._walk_rng = np.random.default_rng(self.seed + 1)
+
+    def position(self, index):
+        free_x = self.width - self.target_width
+        free_y = self.height - self.target_height
+        if self.motion == 'linear':
+            # fold the unbounded path back into the frame, which makes the target bounce off the edges
+            x = (free_x / 2 + self.speed * index) % (2 * free_x)
+            y = (free_y / 2 + self.speed * 0.6 * index) % (2 * free_y)
+            return min(x, 2 * free_x - x), min(y, 2 * free_y - y)
+        if self.motion == 'circle':
+            radius = 0.4 * min(free_x, free_y)
+            angle = self.speed * index / radius
+            return free_x / 2 + radius * math.cos(angle), free_y / 2 + radius * math.sin(angle)
+        if index < self._walk_index:
+            self._restart_walk()
+        while self._walk_index < index:
+            x, y = self._walk_position
+            angle = self._walk_rng.uniform(0, 2 * math.pi)
+            x = min(max(x + self.speed * math.cos(angle), 0), free_x)
+            y = min(max(y + self.speed * math.sin(angle), 0), free_y)
+            self._walk_position = (x, y)
+            self._walk_index += 1
+        return self._walk_position
+
+    def render(self, index):
+        x, y = (int(round(v)) for v in self.position(index))
+        frame = self.background.copy()
+        frame[y:y + self.target_height, x:x + self.target_width] = self.target
+        if self.noise:
+            rng = np.random.default_rng((self.seed, index))
+            noisy = frame + rng.normal(0, self.noise, frame.shape)
+            frame = np.clip(noisy, 0, 255).astype(np.uint8)
+        return frame, (x, y, self.target_width, self.target_height)
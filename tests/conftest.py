@@ -0,0 +1,9 @@
+"""
+pytest configuration: the modules under test are top-level scripts of the repository, not an installed package.
+
+Run from the repository root with: python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from control_timing import SampleSchedule
+
+
+def ticks(rate, seconds, jitter=0.004, seed=0):
+    # (scheduled, actual) times of the control loop ticks; each tick runs up to 'jitter' seconds late
+    rng = np.random.default_rng(seed)
+    scheduled = np.arange(int(rate * seconds)) / rate
+    return list(zip(scheduled, scheduled + rng.uniform(0, jitter, len(scheduled))))
+
+
+def computations(schedule, loop_rate, seconds=5):
+    # the dt of every tick the schedule computed on
+    dts = [schedule.due(tick, now, 0.5 / loop_rate) for tick, now in ticks(loop_rate, seconds)]
+    return [dt for dt in dts if dt is not None]
+
+
+def test_axis_at_the_loop_rate_computes_every_tick():
+    dts = computations(SampleSchedule(20), 20)
+    assert len(dts) == 100
+    assert np.mean(dts[1:]) == pytest.approx(0.05, abs=1e-3)
+
+
+def test_slower_axis_keeps_its_own_rate():
+    dts = computations(SampleSchedule(7), 20)
+    assert len(dts) == pytest.approx(35, abs=1)
+    assert np.mean(dts[1:]) == pytest.approx(1 / 7, abs=0.01)
+
+
+def test_late_tick_restarts_the_schedule():
+    schedule = SampleSchedule(10)
+    assert schedule.due(0.0, 0.0) == pytest.approx(0.1)
+    assert schedule.due(0.5, 0.5) == pytest.approx(0.5)
+    # not a burst of the missed computations
+    assert schedule.due(0.55, 0.55, 0.025) is None
+    assert schedule.due(0.6, 0.6, 0.025) == pytest.approx(0.1)
+
+
+def test_reset():
+    schedule = SampleSchedule(10)
+    schedule.due(0.0, 0.0)
+    schedule.reset()
+    assert schedule.due(0.05, 3.0) == pytest.approx(0.1)
+
+
+def test_pid_computes_on_every_due_tick():
+    # simple_pid gating on sample_time would hold its last output on ticks that run a little early
+    pid = pytest.importorskip('simple_pid').PID(1.0, 0.0, 0.0, setpoint=0.0, sample_time=None)
+    schedule = SampleSchedule(20)
+    outputs = [pid(-i, dt=schedule.due(tick, now, 0.025)) for i, (tick, now) in enumerate(ticks(20, 5))]
+    assert outputs == [float(i) for i in range(100)]
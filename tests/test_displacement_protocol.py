@@ -0,0 +1,113 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from displacement_protocol import (MAX_TARGET_ID, PREDICTION, RECORD, TIMING, DisplacementDecoder,
+                                   DisplacementEncoder, decode_hello, encode_hello, is_tracking)
+
+
+def batch(encoder, target_ids, **kwargs):
+    count = len(target_ids)
+    tracking = np.array([True] + [False] * (count - 1))
+    displacements = np.arange(2 * count).reshape(count, 2) - 3
+    costs = np.linspace(0.001, 0.002, count)
+    return encoder.encode_batch(np.array(target_ids), tracking, displacements, costs, 640, 480, **kwargs)
+
+
+def test_single_record_round_trip():
+    encoder, decoder = DisplacementEncoder(), DisplacementDecoder()
+    message = encoder.encode(True, -12, 34, 640, 480, timestamp=1234.5)
+    assert len(message) == RECORD.size
+    record = decoder.decode(message)
+    assert is_tracking(record)
+    assert (record['seq'][0], record['timestamp'][0]) == (1, 1234.5)
+    assert (record['x'][0], record['y'][0], record['width'][0], record['height'][0]) == (-12, 34, 640, 480)
+    assert not decoder.has_timing and not decoder.has_prediction
+    assert decoder.target_count == 1 and decoder.targets['x'][0] == -12
+
+
+def test_timing_and_prediction_blocks():
+    encoder, decoder = DisplacementEncoder(), DisplacementDecoder()
+    message = encoder.encode(True, 1, 2, 640, 480, timing=(7, 0.03, 0.01), prediction=(1.5, 2.5, 10, -10, 0.03, 2))
+    assert len(message) == RECORD.size + TIMING.size + PREDICTION.size
+    decoder.decode(message)
+    assert decoder.has_timing and decoder.timing['frame_id'][0] == 7
+    assert decoder.timing['age'][0] == pytest.approx(0.03)
+    assert decoder.has_prediction and decoder.prediction['coasting'][0] == 2
+    assert decoder.prediction['vy'][0] == pytest.approx(-10)
+
+    # the blocks are cleared by a message without them
+    decoder.decode(encoder.encode(False, 0, 0, 640, 480))
+    assert not decoder.has_timing and decoder.timing['frame_id'][0] == 0
+    assert not decoder.has_prediction and decoder.prediction['x'][0] == 0
+
+
+def test_batch_round_trip():
+    encoder, decoder = DisplacementEncoder(), DisplacementDecoder()
+    record = decoder.decode(batch(encoder, [3, 9, 65535], timing=(1, 0.0, 0.0)))
+    assert decoder.target_count == 3
+    assert list(decoder.targets['target_id'][:3]) == [3, 9, 65535]
+    assert list(decoder.targets['x'][:3]) == [-3, -1, 1]
+    assert decoder.targets['cost'][2] == pytest.approx(0.002)
+    # the primary target is also decoded as a single record
+    assert is_tracking(record) and (record['x'][0], record['y'][0]) == (-3, -2)
+    assert (record['width'][0], record['height'][0]) == (640, 480)
+    assert decoder.has_timing
+
+
+def test_decoded_record_is_reused():
+    encoder, decoder = DisplacementEncoder(), DisplacementDecoder()
+    first = decoder.decode(encoder.encode(True, 1, 1, 10, 10))
+    second = decoder.decode(encoder.encode(True, 2, 2, 10, 10))
+    assert first is second and first['x'][0] == 2
+
+
+def test_sequence_wraps_around():
+    encoder, decoder = DisplacementEncoder(), DisplacementDecoder()
+    encoder.seq = 0xFFFFFFFE
+    assert decoder.decode(encoder.encode(True, 0, 0, 1, 1))['seq'][0] == 0xFFFFFFFF
+    assert decoder.decode(encoder.encode(True, 0, 0, 1, 1))['seq'][0] == 0
+    assert decoder.decode(batch(encoder, [1, 2]))['seq'][0] == 1
+
+
+def test_target_ids_out_of_range():
+    with pytest.raises(ValueError):
+        batch(DisplacementEncoder(), [1, MAX_TARGET_ID + 1])
+
+
+def test_malformed_messages():
+    encoder, decoder = DisplacementEncoder(), DisplacementDecoder()
+    with pytest.raises(ValueError):
+        decoder.decode(encoder.encode(True, 0, 0, 1, 1)[:-1])
+    with pytest.raises(ValueError):
+        decoder.decode(batch(encoder, [1, 2])[:-2])
+    with pytest.raises(ValueError):
+        decoder.decode(b'not a displacement')
+
+
+def test_pickle_needs_allow_pickle():
+    message = DisplacementEncoder('pickle').encode(True, 5, -6, 320, 240)
+    assert pickle.loads(message) == (True, 5, -6, 320, 240)
+    with pytest.raises(ValueError):
+        DisplacementDecoder().decode(message)
+    record = DisplacementDecoder(allow_pickle=True).decode(message)
+    assert is_tracking(record) and (record['x'][0], record['y'][0]) == (5, -6)
+
+
+def test_hello_round_trip():
+    assert decode_hello(encode_hello(['binary'])) == ['binary']
+    assert decode_hello(encode_hello(['pickle', 'binary'])) == ['binary', 'pickle']
+    assert decode_hello(DisplacementEncoder().encode(True, 0, 0, 1, 1)) is None
+
+
+def test_negotiation():
+    encoder = DisplacementEncoder('binary')
+    assert encoder.negotiate(['binary', 'pickle']) == 'binary'
+    assert encoder.negotiate(['pickle']) == 'pickle'
+    # a receiver without a hello only understands pickle
+    assert encoder.negotiate(None) == 'pickle'
+    assert pickle.loads(encoder.encode(True, 1, 2, 3, 4)) == (True, 1, 2, 3, 4)
+    assert DisplacementEncoder('pickle').negotiate(['binary']) == 'binary'
+    with pytest.raises(ValueError):
+        encoder.negotiate([])
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from motion_filter import ConstantVelocityFilter, TargetPredictor
+
+DT = 1 / 30
+
+
+def test_filter_learns_a_constant_velocity():
+    motion = ConstantVelocityFilter((0, 0))
+    for i in range(1, 60):
+        motion.predict(DT)
+        motion.update((300 * i * DT, -150 * i * DT))
+    assert motion.velocity == pytest.approx((300, -150), abs=5)
+    state = motion.state.copy()
+    assert motion.position_at(0.1) == pytest.approx(motion.position + motion.velocity * 0.1)
+    # predicting ahead doesn't change the estimate
+    assert np.array_equal(motion.state, state)
+
+
+def test_predictor_coasts_then_drops_a_lost_target():
+    predictor = TargetPredictor(max_coast=0.1)
+    ids, measured = np.array([1]), np.array([True])
+    for i in range(30):
+        filters = predictor.update(ids, measured, np.array([[10 * i, 0]]), i * DT)
+    assert filters[1].coasting == 0
+
+    position = filters[1].position.copy()
+    filters = predictor.update(ids, np.array([False]), np.zeros((1, 2)), 30 * DT)
+    assert filters[1].coasting == 1
+    # the estimate moved on with the target's velocity
+    assert filters[1].position[0] > position[0]
+
+    for i in range(31, 35):
+        filters = predictor.update(ids, np.array([False]), np.zeros((1, 2)), i * DT)
+    assert 1 not in filters
+
+
+def test_predictor_forgets_removed_targets():
+    predictor = TargetPredictor()
+    predictor.update(np.array([1, 2]), np.array([True, True]), np.zeros((2, 2)), 0.0)
+    filters = predictor.update(np.array([2]), np.array([True]), np.zeros((1, 2)), DT)
+    assert list(filters) == [2]
+
+
+def test_lost_target_without_an_estimate_gets_none():
+    predictor = TargetPredictor()
+    assert predictor.update(np.array([1]), np.array([False]), np.zeros((1, 2)), 0.0) == {}
@@ -0,0 +1,64 @@
+import pytest
+
+from socket_server import HEADER_LENGTH, FramedReader
+
+
+def frame(payload):
+    return f"{len(payload):<{HEADER_LENGTH}}".encode('utf-8') + payload
+
+
+def feed(reader, data):
+    # receives data as recv_into() would, in as many reads as the free buffer space requires
+    while data:
+        buffer = reader.get_buffer()
+        n = min(len(buffer), len(data))
+        buffer[:n] = data[:n]
+        reader.buffer_updated(n)
+        data = data[n:]
+
+
+def received(reader):
+    return [bytes(message['data']) for message in reader.messages()]
+
+
+def test_coalesced_messages():
+    reader = FramedReader()
+    payloads = [b'a', b'', b'bc' * 50, b'd']
+    feed(reader, b''.join(frame(payload) for payload in payloads))
+    assert received(reader) == payloads
+
+
+def test_fragmented_messages():
+    reader = FramedReader()
+    stream = frame(b'first message') + frame(b'second')
+    messages = []
+    for i in range(len(stream)):
+        feed(reader, stream[i:i + 1])
+        messages += received(reader)
+    assert messages == [b'first message', b'second']
+
+
+def test_message_larger_than_the_buffer():
+    reader = FramedReader(buffer_size=16)
+    payload = bytes(range(256)) * 8
+    stream = frame(payload) + frame(b'after')
+    messages = []
+    for i in range(0, len(stream), 7):
+        feed(reader, stream[i:i + 7])
+        messages += received(reader)
+    assert messages == [payload, b'after']
+
+
+def test_messages_are_views():
+    reader = FramedReader()
+    feed(reader, frame(b'xyz'))
+    message = next(reader.messages())
+    assert isinstance(message['data'], memoryview)
+    assert int(bytes(message['header'])) == 3
+
+
+def test_bad_header():
+    reader = FramedReader()
+    feed(reader, b'not a length header')
+    with pytest.raises(ValueError):
+        received(reader)
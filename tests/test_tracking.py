@@ -0,0 +1,202 @@
+import concurrent.futures
+
+import numpy as np
+import pytest
+
+from synthetic_scene import SyntheticScene
+from tracking import TRACKER_TYPES, EnsembleTracker, FrameBudget, MultiTracker, box_iou, create_tracker, \
+    degradation_levels, tracker_available
+
+FRAME = np.zeros((120, 160, 3), dtype=np.uint8)
+
+
+class FixedTracker:
+    # a stand-in for an OpenCV tracker that reports a fixed result
+    def __init__(self, ok=True, bbox=(10, 10, 20, 20)):
+        self.ok = ok
+        self.bbox = bbox
+
+    def init(self, frame, bbox):
+        return None
+
+    def update(self, frame):
+        return self.ok, self.bbox
+
+
+@pytest.fixture
+def executor():
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        yield pool
+
+
+def ensemble(members, executor, **kwargs):
+    tracker = EnsembleTracker(members, executor, report_interval=0, reseed_after=1000, **kwargs)
+    tracker.init(FRAME, (10, 10, 20, 20))
+    return tracker
+
+
+def test_box_iou():
+    assert box_iou((0, 0, 10, 10), (0, 0, 10, 10)) == 1.0
+    assert box_iou((0, 0, 10, 10), (20, 20, 10, 10)) == 0.0
+    assert box_iou((0, 0, 10, 10), (5, 0, 10, 10)) == pytest.approx(50 / 150)
+
+
+def test_agreeing_members_are_fused_with_full_confidence(executor):
+    tracker = ensemble({'a': FixedTracker(bbox=(10, 10, 20, 20)), 'b': FixedTracker(bbox=(12, 10, 20, 20)),
+                        'c': FixedTracker(bbox=(14, 10, 20, 20))}, executor)
+    ok, bbox = tracker.update(FRAME)
+    assert ok
+    assert bbox == pytest.approx((12, 10, 20, 20))
+    assert tracker.confidence == pytest.approx(1.0)
+
+
+def test_outlier_is_left_out_of_the_fused_box(executor):
+    tracker = ensemble({'a': FixedTracker(bbox=(10, 10, 20, 20)), 'b': FixedTracker(bbox=(10, 10, 20, 20)),
+                        'c': FixedTracker(bbox=(100, 80, 20, 20))}, executor)
+    ok, bbox = tracker.update(FRAME)
+    assert ok
+    assert bbox == pytest.approx((10, 10, 20, 20))
+    assert tracker.confidence == pytest.approx(2 / 3)
+    # the outlier's reliability drops, so it counts for less from now on
+    assert tracker.reliability['c'] < tracker.reliability['a']
+
+
+def test_low_confidence_reports_failure(executor):
+    tracker = ensemble({'a': FixedTracker(), 'b': FixedTracker(ok=False), 'c': FixedTracker(ok=False)}, executor)
+    # only the least reliable member still tracks
+    tracker.reliability.update({'a': 0.1, 'b': 1.0, 'c': 1.0})
+    ok, bbox = tracker.update(FRAME)
+    assert not ok
+    assert tracker.confidence < tracker.min_confidence
+    assert bbox == pytest.approx((10, 10, 20, 20))
+
+
+def test_single_reliable_member_still_tracks(executor):
+    tracker = ensemble({'a': FixedTracker(), 'b': FixedTracker(ok=False), 'c': FixedTracker(ok=False)}, executor)
+    ok, _ = tracker.update(FRAME)
+    assert ok
+    assert tracker.confidence == pytest.approx(1 / 3, abs=1e-3)
+
+
+def test_no_member_succeeds(executor):
+    tracker = ensemble({'a': FixedTracker(ok=False), 'b': FixedTracker(ok=False)}, executor)
+    assert tracker.update(FRAME) == (False, (0, 0, 0, 0))
+    assert tracker.confidence == 0.0
+
+
+LEVELS = [('CSRT', 1.0), ('CSRT', 0.5), ('KCF', 0.5)]
+
+
+def budget(**kwargs):
+    # a 10 ms budget: 20 ms frames miss it, 2 ms frames are under the 5 ms headroom
+    return FrameBudget(0.010, LEVELS, window=10, miss_limit=3, hold=5, **kwargs)
+
+
+def run(frame_budget, cost, frames):
+    # the level changes while 'frames' frames of the given cost are recorded
+    changes = [frame_budget.update(cost) for _ in range(frames)]
+    return [change[:2] for change in changes if change]
+
+
+def test_degradation_levels():
+    assert degradation_levels('CSRT', 1.0, ['CSRT', 'KCF', 'MIL']) == [('CSRT', 1.0), ('CSRT', 0.5), ('KCF', 0.5),
+                                                                      ('KCF', 0.25)]
+    assert degradation_levels('KCF', 0.5, ['KCF'], min_scale=0.25) == [('KCF', 0.5), ('KCF', 0.25)]
+
+
+def test_budget_steps_down_on_misses():
+    frame_budget = budget()
+    assert run(frame_budget, 0.020, 3) == [('CSRT', 0.5)]
+    assert run(frame_budget, 0.020, 3) == [('KCF', 0.5)]
+    # the cheapest level is kept however slow the frames are
+    assert run(frame_budget, 0.020, 10) == []
+    assert frame_budget.level == 2
+
+
+def test_budget_holds_between_thresholds():
+    frame_budget = budget()
+    run(frame_budget, 0.020, 3)
+    # under budget but above the headroom: neither a miss nor calm
+    assert run(frame_budget, 0.008, 50) == []
+    assert frame_budget.level == 1
+
+
+def test_budget_steps_up_when_calm():
+    frame_budget = budget()
+    run(frame_budget, 0.020, 6)
+    assert run(frame_budget, 0.002, 4) == []
+    assert run(frame_budget, 0.002, 1) == [('CSRT', 0.5)]
+    assert run(frame_budget, 0.002, 5) == [('CSRT', 1.0)]
+
+
+def test_failed_step_up_doubles_the_hold():
+    frame_budget = budget()
+    run(frame_budget, 0.020, 3)
+    run(frame_budget, 0.002, 5)
+    assert frame_budget.level == 0
+    # the step up is undone at once, so the next attempt waits twice as long
+    assert run(frame_budget, 0.020, 3) == [('CSRT', 0.5)]
+    assert frame_budget.holds[0] == 10
+    assert run(frame_budget, 0.002, 9) == []
+    assert run(frame_budget, 0.002, 1) == [('CSRT', 1.0)]
+
+
+def test_budget_reset():
+    frame_budget = budget()
+    run(frame_budget, 0.020, 6)
+    frame_budget.reset([('KCF', 1.0), ('KCF', 0.5)])
+    assert frame_budget.level == 0 and frame_budget.holds == [5, 5]
+    assert run(frame_budget, 0.020, 3) == [('KCF', 0.5)]
+
+
+def track(targets, scene, frames):
+    # the IoU of the primary target with the ground truth on each frame
+    ious = []
+    for index in frames:
+        frame, truth = scene.render(index)
+        _, ok, bboxes, _ = targets.update(frame)
+        ious.append(box_iou(bboxes[0], truth) if ok[0] else 0.0)
+    return ious
+
+
+def wait_for_switch(targets):
+    for target in targets.targets.values():
+        target.pending[1].result()
+
+
+def test_switch_starts_where_the_target_is():
+    # the tracker type and scale a budget step changes: the new tracker must not go back to the original selection
+    scene = SyntheticScene(speed=4.0)
+    targets = MultiTracker(tracker_types=['CSRT', 'KCF'])
+    targets.add(*scene.render(0), 'CSRT')
+    assert min(track(targets, scene, range(1, 60))) > 0.7
+    targets.scale = 0.5
+    targets.restart(None, 'KCF')
+    wait_for_switch(targets)
+    assert min(track(targets, scene, range(60, 100))) > 0.5
+    target = targets.targets[1]
+    assert target.roi != tuple(scene.render(0)[1])
+    targets.close()
+
+
+def test_tracking_scale_change_keeps_the_target():
+    # what set_tracking_scale does: the same tracker type, restarted at another scale
+    scene = SyntheticScene(motion='circle', speed=3.0)
+    targets = MultiTracker(tracker_types=['KCF'])
+    targets.add(*scene.render(0), 'KCF')
+    assert min(track(targets, scene, range(1, 50))) > 0.7
+    targets.scale = 0.5
+    targets.restart()
+    wait_for_switch(targets)
+    assert min(track(targets, scene, range(50, 90))) > 0.5
+    assert targets.targets[1].tracker.scale == 0.5
+    targets.close()
+
+
+def test_create_tracker_without_the_type():
+    assert create_tracker('NO-SUCH-TRACKER') is None
+    # types this OpenCV build lacks are None rather than an AttributeError
+    for tracker_type in TRACKER_TYPES:
+        if not tracker_available(tracker_type):
+            assert create_tracker(tracker_type) is None
+    assert create_tracker('KCF') is not None
@@ -0,0 +1,70 @@
+import time
+
+from displacement_protocol import DisplacementEncoder
+from udp_channel import RESTART_WINDOW, DatagramServer
+
+SENDER = ('127.0.0.1', 40000)
+
+
+def server(max_age=0.0):
+    return DatagramServer('127.0.0.1', 0, None, max_age)
+
+
+def datagram(seq, timestamp=None):
+    encoder = DisplacementEncoder()
+    encoder.seq = (seq - 1) & 0xFFFFFFFF
+    return encoder.encode(True, 0, 0, 640, 480, timestamp)
+
+
+def accepted(channel, seqs, sender=SENDER):
+    return [seq for seq in seqs if channel._accept(memoryview(datagram(seq)), sender)]
+
+
+def test_in_order_and_lost():
+    channel = server()
+    assert accepted(channel, [1, 2, 3, 6]) == [1, 2, 3, 6]
+    assert channel.lost == 2
+
+
+def test_duplicates_and_reordered_are_dropped():
+    channel = server()
+    assert accepted(channel, [1, 3, 3, 2, 4]) == [1, 3, 4]
+    assert (channel.duplicates, channel.reordered, channel.lost) == (1, 1, 1)
+
+
+def test_sequence_wraparound():
+    channel = server()
+    assert accepted(channel, [0xFFFFFFFE, 0xFFFFFFFF, 0, 1]) == [0xFFFFFFFE, 0xFFFFFFFF, 0, 1]
+    # a late datagram from before the wrap is still recognised as old
+    assert accepted(channel, [0xFFFFFFFF]) == []
+    assert channel.reordered == 1 and channel.lost == 0
+
+
+def test_restarted_sender():
+    channel = server()
+    accepted(channel, [5000])
+    # a jump back of more than RESTART_WINDOW is a new sequence, not a late datagram
+    assert accepted(channel, [5000 - RESTART_WINDOW, 1, 2]) == [1, 2]
+    assert channel.reordered == 1
+
+
+def test_new_sender_restarts_the_sequence():
+    channel = server()
+    accepted(channel, [100])
+    assert accepted(channel, [1], sender=('127.0.0.1', 40001)) == [1]
+
+
+def test_stale_datagrams():
+    channel = server(max_age=0.5)
+    assert channel._accept(memoryview(datagram(1, time.time())), SENDER)
+    assert not channel._accept(memoryview(datagram(2, time.time() - 1.0)), SENDER)
+    assert channel.stale == 1
+    # a stale datagram still advances the sequence, so nothing older gets through after it
+    assert not channel._accept(memoryview(datagram(2, time.time())), SENDER)
+
+
+def test_malformed():
+    channel = server()
+    assert not channel._accept(memoryview(b'PD'), SENDER)
+    assert not channel._accept(memoryview(bytes(64)), SENDER)
+    assert channel.malformed == 2
@@ -0,0 +1,614 @@
+"""
+Tracker construction and the wrappers ppn_server.Streamer runs its trackers through.
+"""
+import threading
+import time
+import collections
+import concurrent.futures
+import cv2
+import numpy as np
+
+from displacement_protocol import MAX_TARGET_ID
+from latency import LatencyMonitor
+
+(major_ver, minor_ver, subminor_ver) = cv2.__version__.split('.')
+
+# tracker type -> name of its cv2 constructor; which of them exist depends on the OpenCV build
+TRACKER_CONSTRUCTORS = {
+    'BOOSTING': 'TrackerBoosting_create',
+    'MIL': 'TrackerMIL_create',
+    'KCF': 'TrackerKCF_create',
+    'TLD': 'TrackerTLD_create',
+    'MEDIANFLOW': 'TrackerMedianFlow_create',
+    'GOTURN': 'TrackerGOTURN_create',
+    'MOSSE': 'TrackerMOSSE_create',
+    'CSRT': 'TrackerCSRT_create',
+}
+
+# every type create_tracker() knows
+TRACKER_TYPES = list(TRACKER_CONSTRUCTORS)
+
+# pseudo tracker type: an EnsembleTracker of the TrackerPool's ensemble members
+ENSEMBLE = 'ENSEMBLE'
+ENSEMBLE_MEMBERS = ('KCF', 'CSRT', 'MIL')
+
+# tracker types FrameBudget steps down through, most expensive first (update cost per frame as measured with
+# bench_trackers.py; types not listed are only run at lower scales)
+DEGRADATION_ORDER = (ENSEMBLE, 'MIL', 'CSRT', 'KCF')
+
+
+def tracker_available(tracker_type):
+    # whether the OpenCV build has this tracker type (creating it may still fail, e.g. GOTURN without its model files)
+    if (int(major_ver), int(minor_ver)) < (3, 3):
+        return tracker_type in TRACKER_TYPES
+    return tracker_type in TRACKER_CONSTRUCTORS and hasattr(cv2, TRACKER_CONSTRUCTORS[tracker_type])
+
+
+def available_tracker_types():
+    return [tracker_type for tracker_type in TRACKER_TYPES if tracker_available(tracker_type)]
+
+
+def create_tracker(tracker_type):
+    # returns None for an unknown type, or one the OpenCV build lacks
+    if not tracker_available(tracker_type):
+        return None
+    if (int(major_ver), int(minor_ver)) < (3, 3):
+        return cv2.Tracker_create(tracker_type)
+    return getattr(cv2, TRACKER_CONSTRUCTORS[tracker_type])()
+
+
+class ScaledTracker:
+    """
+    Runs an OpenCV tracker on a downscaled (and optionally grayscale) copy of each frame.
+    init() and update() take and return bounding boxes in full-resolution frame coordinates.
+    """
+    def __init__(self, tracker, scale=1.0, grayscale=False):
+        if not 0 < scale <= 1:
+            raise ValueError("tracking scale must be in (0, 1], got {}".format(scale))
+        self.tracker = tracker
+        self.scale = scale
+        self.grayscale = grayscale
+
+    def prepare(self, frame):
+        if self.scale != 1:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        if self.grayscale and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return frame
+
+    def init(self, frame, bbox):
+        x, y, w, h = (int(round(v * self.scale)) for v in bbox)
+        return self.tracker.init(self.prepare(frame), (x, y, max(w, 1), max(h, 1)))
+
+    def update(self, frame):
+        ok, bbox = self.tracker.update(self.prepare(frame))
+        if ok and self.scale != 1:
+            bbox = tuple(v / self.scale for v in bbox)
+        return ok, bbox
+
+
+def box_iou(a, b):
+    # intersection over union of two (x, y, w, h) boxes
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    intersection = max(x1 - x0, 0) * max(y1 - y0, 0)
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class EnsembleTracker:
+    """
+    Several OpenCV trackers updated concurrently on the same frame, fused into one bounding box. It has the init() /
+    update() interface of an OpenCV tracker, so it runs inside a ScaledTracker like any other.
+
+    OpenCV releases the GIL in update(), so the members run in parallel on 'executor'. Fusion: among the members that
+    report success, the one with the most support (its reliability times one plus its IoU with every other box) is
+    the anchor; the members overlapping it by at least 'agreement' IoU are averaged, weighted by reliability.
+    Reliability is a moving average (rate 'smoothing') of each member's IoU with the fused box, so members that
+    often disagree count less. A member that has failed or disagreed for 'reseed_after' frames in a row is re-seeded
+    from the fused box in the background and sits out until it is ready.
+
+    The confidence of a fused box is the share of the members' total reliability behind it. Below min_confidence the
+    update reports failure, as a single tracker would, even though some member succeeded.
+
+    The update time of every member, of the slowest member, of the whole ensemble and the difference between the last
+    two (the cost of running an ensemble over its slowest member) are reported through a LatencyMonitor.
+    """
+    def __init__(self, members, executor, agreement=0.3, smoothing=0.1, reseed_after=3, min_confidence=0.3,
+                 report_interval=10.0):
+        self.members = dict(members)
+        self.executor = executor
+        self.agreement = agreement
+        self.smoothing = smoothing
+        self.reseed_after = reseed_after
+        self.min_confidence = min_confidence
+        self.reliability = dict.fromkeys(self.members, 1.0)
+        self.misses = dict.fromkeys(self.members, 0)
+        self.reseeding = {}  # member -> Future of its re-initialization
+        self.confidence = 0.0  # share of the total reliability behind the last fused box
+        self.latency = LatencyMonitor('ensemble ' + '+'.join(self.members), report_interval)
+
+    def init(self, frame, bbox):
+        results = list(self.executor.map(lambda name: self.members[name].init(frame, bbox), self.members))
+        # OpenCV 4.5 trackers return None from init
+        return all(result is None or result for result in results)
+
+    def _update_member(self, name, frame):
+        start = time.perf_counter()
+        ok, bbox = self.members[name].update(frame)
+        return ok, tuple(bbox), time.perf_counter() - start
+
+    def _reseed(self, name, frame, bbox):
+        tracker = create_tracker(name)
+        tracker.init(frame, tuple(int(round(v)) for v in bbox))
+        self.members[name] = tracker
+
+    def _fuse(self, boxes):
+        if not boxes:
+            self.confidence = 0.0
+            return None
+        support = {name: self.reliability[name] * (1 + sum(box_iou(box, other) for other_name, other in boxes.items()
+                                                           if other_name != name))
+                   for name, box in boxes.items()}
+        anchor = boxes[max(support, key=support.get)]
+        inliers = [name for name, box in boxes.items() if box_iou(box, anchor) >= self.agreement]
+        weights = np.array([self.reliability[name] for name in inliers]) + 1e-6
+        self.confidence = weights.sum() / (sum(self.reliability.values()) + 1e-6)
+        return tuple(np.average([boxes[name] for name in inliers], axis=0, weights=weights))
+
+    def update(self, frame):
+        start = time.perf_counter()
+        for name, future in list(self.reseeding.items()):
+            if future.done():
+                del self.reseeding[name]
+                if future.exception():
+                    print("ensemble: re-seeding {} failed: {}".format(name, future.exception()))
+        futures = {name: self.executor.submit(self._update_member, name, frame)
+                   for name in self.members if name not in self.reseeding}
+        results = {name: future.result() for name, future in futures.items()}
+        elapsed = time.perf_counter() - start
+
+        boxes = {name: bbox for name, (ok, bbox, _) in results.items() if ok}
+        fused = self._fuse(boxes)
+        for name in results:
+            overlap = box_iou(boxes[name], fused) if fused and name in boxes else 0.0
+            self.reliability[name] += self.smoothing * (overlap - self.reliability[name])
+            self.misses[name] = 0 if overlap >= self.agreement else self.misses[name] + 1
+            if fused and self.misses[name] >= self.reseed_after:
+                self.misses[name] = 0
+                # the frame may be drawn on once update() returns, so the re-seed gets its own copy
+                self.reseeding[name] = self.executor.submit(self._reseed, name, frame.copy(), fused)
+
+        if results:
+            slowest = max(cost for _, _, cost in results.values())
+            for name, (_, _, cost) in results.items():
+                self.latency.record('member ' + name, cost)
+            self.latency.record('slowest member', slowest)
+            self.latency.record('ensemble', elapsed)
+            self.latency.record('added over slowest', elapsed - slowest)
+        return fused is not None and self.confidence >= self.min_confidence, fused if fused else (0, 0, 0, 0)
+
+
+class TrackerPool:
+    """
+    Keeps 'spares' constructed trackers of each type ready, and initializes trackers in the background.
+
+    take() hands out a ready instance (constructing one only if none is left) and has a background thread build its
+    replacement. start() takes a tracker and initializes it on the background thread, returning a Future of the
+    ScaledTracker, so a tracker switch never stalls the streaming thread.
+
+    The ENSEMBLE type builds an EnsembleTracker of ensemble_members; their updates share one thread pool.
+    """
+    def __init__(self, spares=1, ensemble_members=ENSEMBLE_MEMBERS):
+        self.spares = spares
+        self.ensemble_members = tuple(ensemble_members)
+        self._ready = {}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='tracker-pool')
+        self._ensemble_executor = None
+
+    def _refill(self, tracker_type):
+        while True:
+            with self._lock:
+                if len(self._ready.get(tracker_type, [])) >= self.spares:
+                    return
+            tracker = create_tracker(tracker_type)
+            if tracker is None:
+                return
+            with self._lock:
+                self._ready.setdefault(tracker_type, []).append(tracker)
+
+    def prewarm(self, tracker_types):
+        if ENSEMBLE in tracker_types:
+            tracker_types = set(tracker_types) | set(self.ensemble_members)
+        for tracker_type in tracker_types:
+            if tracker_type != ENSEMBLE:
+                self._executor.submit(self._refill, tracker_type)
+
+    def take(self, tracker_type):
+        with self._lock:
+            ready = self._ready.get(tracker_type)
+            tracker = ready.pop() if ready else None
+        if tracker is None:
+            tracker = create_tracker(tracker_type)
+        self._executor.submit(self._refill, tracker_type)
+        return tracker
+
+    def take_ensemble(self):
+        if self._ensemble_executor is None:
+            # one more worker than members, so a member being re-seeded never delays the others
+            self._ensemble_executor = concurrent.futures.ThreadPoolExecutor(len(self.ensemble_members) + 1,
+                                                                            thread_name_prefix='ensemble')
+        return EnsembleTracker({name: self.take(name) for name in self.ensemble_members}, self._ensemble_executor)
+
+    def create(self, tracker_type, frame, bbox, scale=1.0, grayscale=False):
+        # a ScaledTracker initialized on frame and bbox, on the calling thread
+        tracker = self.take_ensemble() if tracker_type == ENSEMBLE else self.take(tracker_type)
+        tracker = ScaledTracker(tracker, scale, grayscale)
+        tracker.init(frame, bbox)
+        return tracker
+
+    def start(self, tracker_type, frame, bbox, scale=1.0, grayscale=False):
+        return self._executor.submit(self.create, tracker_type, frame, bbox, scale, grayscale)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        if self._ensemble_executor:
+            self._ensemble_executor.shutdown(wait=False)
+
+
+def selection_size(roi_frame, roi):
+    # number of rows in the selected region; 0 for an empty selection
+    return len(roi_frame[int(roi[1]):int(roi[1] + roi[3]), int(roi[0]):int(roi[0] + roi[2])])
+
+
+def clip_bbox(bbox, frame_shape):
+    # integer (x, y, w, h) clipped to the frame; w or h is 0 if nothing is left
+    frame_height, frame_width = frame_shape[:2]
+    x0, y0 = max(int(bbox[0]), 0), max(int(bbox[1]), 0)
+    x1, y1 = min(int(bbox[0] + bbox[2]), frame_width), min(int(bbox[1] + bbox[3]), frame_height)
+    return x0, y0, max(x1 - x0, 0), max(y1 - y0, 0)
+
+
+class Reacquirer:
+    """
+    Recovers a lost target by template matching.
+
+    While the target is tracked, remember() keeps a copy of its last good appearance. Once tracking fails, each
+    search() matches that template in a window around the last known position: coarse to fine over an image pyramid,
+    with the window growing by 'growth' after every unsuccessful search, up to the whole frame. A search stops as soon
+    as the deadline passes, so recovery never costs more than the frame budget; it then continues on the next frame.
+    """
+    def __init__(self, threshold=0.7, window=2.0, growth=1.5, min_template_size=8):
+        self.threshold = threshold
+        self.initial_window = window
+        self.growth = growth
+        self.min_template_size = min_template_size
+        self.window = window
+        self.bbox = None
+        self.patch = None
+        self.pyramid = None
+        self.score = 0.0
+
+    def remember(self, frame, bbox):
+        x, y, w, h = clip_bbox(bbox, frame.shape)
+        if w and h:
+            self.patch = frame[y:y + h, x:x + w].copy()
+            self.bbox = (x, y, w, h)
+            self.pyramid = None
+            self.window = self.initial_window
+
+    def _template_pyramid(self):
+        # grayscale templates for each level, halving the size until it would drop below min_template_size. Levels are
+        # resized the same way as the search image in _match(), so both see the same filtering.
+        template = self.patch if self.patch.ndim == 2 else cv2.cvtColor(self.patch, cv2.COLOR_BGR2GRAY)
+        pyramid = [template]
+        while min(template.shape[:2]) * 0.5 ** len(pyramid) >= self.min_template_size:
+            scale = 0.5 ** len(pyramid)
+            pyramid.append(cv2.resize(template, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA))
+        return pyramid
+
+    def _match(self, gray, region, level):
+        # best match of the template of the given pyramid level within region (full-resolution x, y, w, h)
+        x, y, w, h = region
+        scale = 0.5 ** level
+        template = self.pyramid[level]
+        image = gray[y:y + h, x:x + w]
+        if level:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        if image.shape[0] < template.shape[0] or image.shape[1] < template.shape[1]:
+            return None, 0.0
+        result = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, location = cv2.minMaxLoc(result)
+        return (x + location[0] / scale, y + location[1] / scale), score
+
+    def search(self, frame, deadline):
+        """
+        Returns the recovered bounding box, or None if the target was not found (or the deadline passed).
+        """
+        if self.patch is None:
+            return None
+        if self.pyramid is None:
+            self.pyramid = self._template_pyramid()
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        x, y, w, h = self.bbox
+        window = (x + w / 2 - w * self.window / 2, y + h / 2 - h * self.window / 2, w * self.window, h * self.window)
+        region = clip_bbox(window, gray.shape)
+        location, score = None, 0.0
+        for level in range(len(self.pyramid) - 1, -1, -1):
+            if time.perf_counter() > deadline:
+                return None
+            if location is not None:
+                # refine around the coarser match, allowing for two pixels of error at the previous level
+                margin = 2 ** (level + 2)
+                region = clip_bbox((location[0] - margin, location[1] - margin, w + 2 * margin, h + 2 * margin),
+                                   gray.shape)
+            location, score = self._match(gray, region, level)
+            if location is None:
+                break
+
+        self.score = score
+        if location is not None and score >= self.threshold:
+            return int(location[0]), int(location[1]), w, h
+        self.window = min(self.window * self.growth, max(gray.shape[1] / w, gray.shape[0] / h) * 2)
+        return None
+
+
+class Target:
+    """
+    One tracked object: its tracker and the frame and box (roi_frame, roi) its tracker was last initialized on,
+    which are cached so the tracker can be re-created (e.g. with another type or scale) without a new selection.
+
+    switch() prepares a replacement tracker in the background while the current one keeps running; the streaming
+    thread swaps it in with swap_pending() once it is ready. The replacement starts where the target is now, and
+    becomes the cached selection once it has taken over.
+    """
+    def __init__(self, target_id, tracker_type, roi_frame, roi, pool, reacquirer=None):
+        self.target_id = target_id
+        self.tracker_type = tracker_type
+        self.roi_frame = roi_frame
+        self.roi = tuple(roi)
+        self.pool = pool
+        self.tracker = None
+        self.pending = None  # (tracker_type, Future of the replacement tracker, its roi_frame, its roi)
+        self.ok = False
+        self.bbox = self.roi
+        self.cost = 0.0  # seconds spent in the last update
+        self.reacquirer = reacquirer
+        self.reacquired = 0  # number of automatic recoveries
+
+    def start(self, scale=1.0, grayscale=False):
+        self.tracker = self.pool.create(self.tracker_type, self.roi_frame, self.roi, scale, grayscale)
+        self.pending = None
+        self.ok = True
+        self.bbox = self.roi
+        if self.reacquirer:
+            self.reacquirer.remember(self.roi_frame, self.roi)
+
+    def switch(self, frame=None, tracker_type=None, scale=1.0, grayscale=False):
+        # Starts initializing a new tracker on the frame at the target's current box, or on the cached selection
+        # without a frame or while the target is lost. A switch still in progress is superseded.
+        tracker_type = tracker_type or self.tracker_type
+        self._start_pending(tracker_type, frame.copy() if frame is not None and self.ok else self.roi_frame,
+                            self.bbox if frame is not None and self.ok else self.roi, scale, grayscale)
+
+    def _start_pending(self, tracker_type, roi_frame, roi, scale, grayscale):
+        roi = tuple(roi)
+        self.pending = (tracker_type, self.pool.start(tracker_type, roi_frame, roi, scale, grayscale), roi_frame, roi)
+
+    def swap_pending(self):
+        # replaces the tracker once the background initialization has finished; returns True if it did
+        if self.pending is None or not self.pending[1].done():
+            return False
+        tracker_type, future, roi_frame, roi = self.pending
+        self.pending = None
+        try:
+            self.tracker = future.result()
+        except Exception as ex:
+            print("target #{}: could not start a {} tracker: {}".format(self.target_id, tracker_type, ex))
+            return False
+        self.tracker_type = tracker_type
+        self.roi_frame, self.roi = roi_frame, roi
+        if self.reacquirer:
+            self.reacquirer.remember(self.roi_frame, self.roi)
+        return True
+
+    def reacquire(self, frame, deadline, scale=1.0, grayscale=False):
+        # Searches for the lost target and starts a new tracker where it was found. The tracker is initialized in the
+        # background like a switch (a CSRT init alone can take longer than the frame budget), so the target stays
+        # lost until swap_pending() puts it in place.
+        bbox = self.reacquirer.search(frame, deadline)
+        if bbox is not None:
+            self._start_pending(self.tracker_type, frame.copy(), bbox, scale, grayscale)
+            self.bbox = bbox
+            self.reacquired += 1
+            print("target #{} re-acquired (score {:.2f})".format(self.target_id, self.reacquirer.score))
+        return bbox is not None
+
+
+class MultiTracker:
+    """
+    Tracks any number of targets in the same frame, each with its own tracker type. Targets keep their insertion
+    order; the first one is the primary target, whose displacement drives the single-target consumers.
+
+    If reacquire_threshold is set, lost targets are searched for with a Reacquirer (see update()). Trackers come
+    from a TrackerPool; tracker_types are constructed ahead of time.
+    """
+    def __init__(self, scale=1.0, grayscale=False, reacquire_threshold=None, tracker_types=(),
+                 ensemble_members=ENSEMBLE_MEMBERS):
+        self.scale = scale
+        self.grayscale = grayscale
+        self.reacquire_threshold = reacquire_threshold
+        self.targets = {}
+        self._next_id = 1
+        self.pool = TrackerPool(ensemble_members=ensemble_members)
+        self.pool.prewarm(tracker_types)
+        self.frame = None  # the frame of the last update(), where restart() starts the new trackers
+
+    def __len__(self):
+        return len(self.targets)
+
+    @property
+    def pending(self):
+        # True while any target's tracker switch is still initializing
+        return any(target.pending for target in self.targets.values())
+
+    def add(self, roi_frame, roi, tracker_type):
+        # returns the new target id, or None if the selection is empty
+        if selection_size(roi_frame, roi) == 0:
+            return None
+        reacquirer = Reacquirer(self.reacquire_threshold) if self.reacquire_threshold else None
+        target = Target(self._next_id, tracker_type, roi_frame, roi, self.pool, reacquirer)
+        target.start(self.scale, self.grayscale)
+        self.targets[target.target_id] = target
+        # ids are u2 in the displacement messages, so they wrap around, skipping the ones still in use
+        self._next_id = self._next_id % MAX_TARGET_ID + 1
+        while self._next_id in self.targets:
+            self._next_id = self._next_id % MAX_TARGET_ID + 1
+        return target.target_id
+
+    def remove(self, target_id):
+        return self.targets.pop(target_id, None) is not None
+
+    def clear(self):
+        self.targets.clear()
+        self.frame = None
+
+    def close(self):
+        self.pool.close()
+
+    def restart(self, target_id=None, tracker_type=None):
+        # Re-creates the tracker of one target (or all of them), optionally with a new type, where the last update()
+        # found it (see Target.switch). The new trackers are initialized in the background and take over in update()
+        # once ready.
+        targets = self.targets.values() if target_id is None else [self.targets[target_id]]
+        for target in targets:
+            target.switch(self.frame, tracker_type, self.scale, self.grayscale)
+
+    def update(self, frame, deadline=None):
+        """
+        Updates every tracker on the frame. Returns NumPy arrays: target ids (N,), ok flags (N,),
+        bounding boxes (N, 4) in full-resolution coordinates and per-target update costs in seconds (N,).
+
+        Targets whose tracker fails are searched for until the deadline (a time.perf_counter() value), which bounds
+        the recovery work per frame; without a deadline no search is made. A target that is found gets a new tracker,
+        initialized in the background, and is tracked again once it has taken over.
+        """
+        self.frame = frame
+        count = len(self.targets)
+        ids = np.empty(count, dtype=np.int64)
+        ok = np.zeros(count, dtype=bool)
+        bboxes = np.zeros((count, 4))
+        costs = np.zeros(count)
+        for i, target in enumerate(self.targets.values()):
+            target.swap_pending()
+            start = time.perf_counter()
+            target.ok, bbox = target.tracker.update(frame)
+            if target.ok:
+                target.bbox = tuple(bbox)
+                if target.reacquirer:
+                    target.reacquirer.remember(frame, target.bbox)
+            elif target.reacquirer and deadline is not None and target.pending is None:
+                target.reacquire(frame, deadline, self.scale, self.grayscale)
+            target.cost = time.perf_counter() - start
+            ids[i] = target.target_id
+            ok[i] = target.ok
+            bboxes[i] = target.bbox
+            costs[i] = target.cost
+        return ids, ok, bboxes, costs
+
+
+def degradation_levels(tracker_type, scale, tracker_types, min_scale=0.25):
+    """
+    The (tracker_type, scale) levels a FrameBudget steps through, starting with the chosen tracker and scale. The
+    trackers are the chosen one and those from DEGRADATION_ORDER that are offered and cheaper, the scales the chosen
+    scale halved down to min_scale. Each step halves the scale or moves to the next cheaper tracker, alternately, and
+    never undoes the other: every level is expected to cost less than the one before.
+    """
+    types = [tracker_type]
+    if tracker_type in DEGRADATION_ORDER:
+        types += [t for t in DEGRADATION_ORDER[DEGRADATION_ORDER.index(tracker_type) + 1:] if t in tracker_types]
+    scales = [scale]
+    while scales[-1] / 2 >= min_scale:
+        scales.append(scales[-1] / 2)
+    levels = [(tracker_type, scale)]
+    t = s = 0
+    while t < len(types) - 1 or s < len(scales) - 1:
+        if s < len(scales) - 1 and (s <= t or t == len(types) - 1):
+            s += 1
+        else:
+            t += 1
+        levels.append((types[t], scales[s]))
+    return levels
+
+
+class FrameBudget:
+    """
+    Keeps the per-frame tracking cost within 'budget' seconds by stepping through 'levels' (see degradation_levels()),
+    from level 0, the chosen tracker and scale, to the cheapest.
+
+    update() is called with each frame's tracking cost. It steps down a level once 'miss_limit' of the last 'window'
+    frames went over budget, and steps up once 'hold' frames in a row cost less than headroom * budget. The gap
+    between the two thresholds is the hysteresis: the level above costs more than the current one, so a cost just
+    under budget is not enough to step up. A step up that is undone before 'hold' frames have passed doubles the hold
+    for that step (up to max_hold frames), so a level that can't be sustained is retried less and less often.
+    """
+    def __init__(self, budget, levels, window=30, miss_limit=10, headroom=0.5, hold=90, max_hold=2880):
+        self.budget = budget
+        self.window = window
+        self.miss_limit = miss_limit
+        self.headroom = headroom
+        self.hold = hold
+        self.max_hold = max_hold
+        self.reset(levels)
+
+    def reset(self, levels):
+        self.levels = list(levels)
+        self.level = 0
+        self.holds = [self.hold] * len(self.levels)  # frames under headroom needed to step up to each level
+        self._begin_level(stepped_up=False)
+
+    def _begin_level(self, stepped_up):
+        self.misses = collections.deque(maxlen=self.window)
+        self.calm = 0
+        self.frames_at_level = 0
+        self.stepped_up = stepped_up
+
+    def update(self, cost):
+        """
+        Records the tracking cost (seconds) of a frame. Returns (tracker_type, scale, reason) when the level changes,
+        otherwise None.
+        """
+        self.frames_at_level += 1
+        self.misses.append(cost > self.budget)
+        self.calm = self.calm + 1 if cost < self.headroom * self.budget else 0
+
+        if sum(self.misses) >= self.miss_limit and self.level < len(self.levels) - 1:
+            if self.stepped_up and self.frames_at_level < self.holds[self.level]:
+                self.holds[self.level] = min(2 * self.holds[self.level], self.max_hold)
+            reason = "{} of the last {} frames over the {:.0f} ms budget".format(sum(self.misses), len(self.misses),
+                                                                                 1000 * self.budget)
+            self.level += 1
+            self._begin_level(stepped_up=False)
+        elif self.level > 0 and self.calm >= self.holds[self.level - 1]:
+            reason = "{} frames under {:.0f} ms".format(self.calm, 1000 * self.headroom * self.budget)
+            self.level -= 1
+            self._begin_level(stepped_up=True)
+        else:
+            return None
+        tracker_type, scale = self.levels[self.level]
+        return tracker_type, scale, reason
+
+
+def target_displacements(bboxes, frame_shape):
+    """
+    Vectorized displacement of each bounding box centre from the frame centre (the crosshair).
+    Returns (crosshair, centres, displacements): centres are (N, 2) pixel positions, displacements (N, 2) with x
+    positive to the right and y positive upwards.
+    """
+    frame_height, frame_width = frame_shape[:2]
+    crosshair = np.array([int(frame_width / 2), int(frame_height / 2)])
+    centres = (bboxes[:, :2] + np.trunc(bboxes[:, 2:] / 2)).astype(int)
+    displacements = (centres - crosshair) * np.array([1, -1])
+    return crosshair, centres, displacements
@@ -0,0 +1,165 @@
+"""
+Optional UDP transport for the displacement stream (ppn_server --offset-transport udp, pid-tuner --udp).
+
+Over TCP a lost segment holds back every later displacement until it is retransmitted, so the controller acts on a
+burst of old offsets after a stall. A displacement is only worth its newest value, so over UDP each binary record of
+displacement_protocol is sent as one datagram, without the 10 byte length header, and nothing is retransmitted.
+
+The receiver uses the seq and timestamp fields every record starts with. Per sender it keeps the newest sequence
+number it delivered and drops any datagram that is not newer: duplicates and datagrams overtaken by a later one. A
+jump back of more than RESTART_WINDOW sequence numbers, or a new sender address, is taken as a restarted sender.
+Of the datagrams waiting in the socket only the newest is delivered, and with max_age set, datagrams whose capture
+time is more than max_age seconds old are dropped too (this needs the clocks of both machines synchronized).
+
+There is no connection, so the receiver gets no connect or disconnect events: the 'not tracking' record the server
+sends when it stops may be lost like any other datagram, and pid-tuner relies on --stale-input to stop.
+"""
+import select
+import socket
+import struct
+import threading
+import time
+
+from displacement_protocol import MAGIC
+
+# seq and timestamp, at the same offset in every binary record
+SEQ_TIMESTAMP = struct.Struct('<Id')
+SEQ_OFFSET = 4
+RESTART_WINDOW = 1024
+MAX_DATAGRAM = 65536
+
+
+class DatagramClient:
+    """
+    Sends displacement records as datagrams. It has the methods of SocketClient that ppn_server uses, so either can
+    carry the displacement stream.
+    """
+    def __init__(self, ip="127.0.0.1", port=1234):
+        self.ip = ip
+        self.port = port
+        self.client_socket = None
+
+    def connect(self, error_callback):
+        # connecting a UDP socket only sets the destination, so this fails only for a bad address
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.client_socket.connect((self.ip, self.port))
+        except Exception as e:
+            error_callback('Connection error: {}'.format(str(e)))
+            return False
+        return True
+
+    def send(self, msg):
+        try:
+            self.client_socket.send(msg)
+        except OSError:
+            # e.g. ECONNREFUSED after an ICMP port unreachable while the receiver isn't running; the datagram is lost
+            pass
+
+    def stop_listening(self):
+        pass
+
+
+class DatagramServer:
+    """
+    Receives displacement datagrams on ip:port and passes the newest valid one to
+    message_callback(sender_address, {'header': None, 'data': datagram}), as socket_server does for its messages.
+    The datagram is a memoryview into a buffer that is reused, so the callback must decode it before returning.
+
+    Counters, over all senders:
+     - received: datagrams read from the socket
+     - delivered: datagrams passed to message_callback
+     - lost: sequence numbers skipped between delivered datagrams (a late arrival among them is also counted as
+       reordered)
+     - reordered: datagrams older than one already delivered
+     - duplicates: datagrams with the sequence number of the newest one
+     - stale: datagrams older than max_age seconds
+     - superseded: valid datagrams dropped because a newer one was waiting behind them
+     - malformed: datagrams that aren't binary displacement records
+    """
+    def __init__(self, ip, port, message_callback, max_age=0.0):
+        self.ip = ip
+        self.port = port
+        self.message_callback = message_callback
+        self.max_age = max_age
+        self.sender = None
+        self.last_seq = None
+        self.received = self.delivered = self.lost = self.reordered = 0
+        self.duplicates = self.stale = self.superseded = self.malformed = 0
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _accept(self, data, sender):
+        # True if the datagram is newer than the last one accepted from this sender
+        if len(data) < SEQ_OFFSET + SEQ_TIMESTAMP.size or data[0] != MAGIC[0] or data[1] != MAGIC[1]:
+            self.malformed += 1
+            return False
+        seq, timestamp = SEQ_TIMESTAMP.unpack_from(data, SEQ_OFFSET)
+        if sender != self.sender or self.last_seq is None:
+            if self.sender is not None and sender != self.sender:
+                print(__name__, "displacement sender changed to {}:{}".format(*sender))
+            self.sender = sender
+        else:
+            # sequence numbers wrap around at 2^32
+            ahead = (seq - self.last_seq) & 0xFFFFFFFF
+            if ahead == 0:
+                self.duplicates += 1
+                return False
+            if ahead >= 0x80000000:
+                if 0x100000000 - ahead <= RESTART_WINDOW:
+                    self.reordered += 1
+                    return False
+                print(__name__, "displacement sequence restarted at", seq)
+            else:
+                self.lost += ahead - 1
+        self.last_seq = seq
+        if self.max_age > 0 and time.time() - timestamp > self.max_age:
+            self.stale += 1
+            return False
+        return True
+
+    def serve(self):
+        """
+        Receives until stop() is called; runs in the caller's thread.
+        """
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((self.ip, self.port))
+        server_socket.setblocking(False)
+        print(__name__, "listening for displacement datagrams on {}:{}".format(self.ip, self.port))
+        # the newest accepted datagram is kept in 'newest' while the socket is drained into 'incoming'
+        incoming, newest = bytearray(MAX_DATAGRAM), bytearray(MAX_DATAGRAM)
+        try:
+            while not self._stop_event.is_set():
+                readable, _, _ = select.select([server_socket], [], [], 0.5)
+                if not readable:
+                    continue
+                newest_length = 0
+                while True:
+                    try:
+                        length, sender = server_socket.recvfrom_into(incoming)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except ConnectionError:
+                        # an ICMP error for an earlier datagram sent from this socket; nothing was received
+                        continue
+                    self.received += 1
+                    if self._accept(memoryview(incoming)[:length], sender):
+                        if newest_length:
+                            self.superseded += 1
+                        incoming, newest = newest, incoming
+                        newest_length, newest_sender = length, sender
+                if newest_length:
+                    self.delivered += 1
+                    self.message_callback(newest_sender, {'header': None,
+                                                          'data': memoryview(newest)[:newest_length]})
+        finally:
+            server_socket.close()
+        print(__name__, "done listening")
+
+    def text(self):
+        return ("displacement datagrams: {} received, {} delivered, {} lost, {} reordered, {} duplicates, {} stale, "
+                "{} superseded, {} malformed".format(self.received, self.delivered, self.lost, self.reordered,
+                                                     self.duplicates, self.stale, self.superseded, self.malformed))
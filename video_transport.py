@@ -0,0 +1,190 @@
+"""
+Helpers for the imagezmq video stream between ppn_server and ppn_client.
+
+The stream runs either as REQ/REP, where every frame waits for the viewer's reply, or as PUB/SUB, where the server
+publishes without waiting and a slow viewer simply misses frames.
+
+Frames are sent either as raw BGR arrays ('raw') or as JPEG buffers ('jpg'). In JPEG mode the quality is adjusted
+on the fly from the measured send time and link bandwidth; in PUB/SUB mode, where a send returns as soon as the
+frame is queued, from the delivery time revealed by the viewer's frame_ack messages instead. Both ends keep
+TransportStats, which periodically print the bytes per frame and the encode/decode cost. The viewer receives on a
+background thread (FrameReceiver), so its UI never blocks on the network.
+"""
+import time
+import cv2
+import numpy as np
+import zmq
+
+from frame_pipeline import DropOldestBuffer, StageWorker
+
+TRANSPORT_MODES = ['raw', 'jpg']
+VIDEO_MODES = ['reqrep', 'pubsub']
+
+
+class AdaptiveJpegQuality:
+    """
+    Chooses the JPEG quality for the next frame.
+
+    target_send_time is the time budget for sending one frame (seconds). update() takes the time a frame took to send,
+    or to be delivered when the send itself doesn't wait for the link (PUB/SUB). When the smoothed time exceeds the
+    budget, the quality is lowered by 'step'. When the frames are comfortably smaller than what the measured
+    bandwidth can carry within the budget, the quality is raised by one, so recovery is gradual.
+    """
+    def __init__(self, quality=80, min_quality=30, max_quality=95, target_send_time=1 / 30, step=5, smoothing=0.2):
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.quality = min(max(quality, min_quality), max_quality)
+        self.target_send_time = target_send_time
+        self.step = step
+        self.smoothing = smoothing
+        self.send_time = None
+        self.bandwidth = None  # bytes per second
+
+    def _smooth(self, previous, value):
+        if previous is None:
+            return value
+        return previous + self.smoothing * (value - previous)
+
+    def update(self, send_time, nbytes):
+        self.send_time = self._smooth(self.send_time, send_time)
+        if send_time > 0:
+            self.bandwidth = self._smooth(self.bandwidth, nbytes / send_time)
+
+        if self.send_time > self.target_send_time:
+            self.quality = max(self.min_quality, self.quality - self.step)
+        elif self.bandwidth and nbytes < 0.7 * self.bandwidth * self.target_send_time:
+            self.quality = min(self.max_quality, self.quality + 1)
+        return self.quality
+
+
+class TransportStats:
+    """
+    Accumulates per-frame transport figures and prints a summary every report_interval seconds.
+    codec_time is the encode (sender) or decode (receiver) time, transfer_time the time spent in send/recv.
+    """
+    def __init__(self, label, report_interval=5.0):
+        self.label = label
+        self.report_interval = report_interval
+        self._reset(time.monotonic())
+
+    def _reset(self, now):
+        self.frames = 0
+        self.bytes = 0
+        self.codec_time = 0.0
+        self.transfer_time = 0.0
+        self.started = now
+
+    def record(self, nbytes, codec_time=0.0, transfer_time=0.0, **extra):
+        self.frames += 1
+        self.bytes += nbytes
+        self.codec_time += codec_time
+        self.transfer_time += transfer_time
+        now = time.monotonic()
+        if now - self.started >= self.report_interval:
+            self.report(now, **extra)
+            self._reset(now)
+
+    def report(self, now, **extra):
+        elapsed = now - self.started
+        if not self.frames or elapsed <= 0:
+            return
+        summary = "{}: {:.1f} fps, {:.1f} KB/frame, {:.2f} MB/s, codec {:.2f} ms/frame, transfer {:.2f} ms/frame".format(
+            self.label, self.frames / elapsed, self.bytes / self.frames / 1024, self.bytes / elapsed / 1e6,
+            1000 * self.codec_time / self.frames, 1000 * self.transfer_time / self.frames)
+        for key, value in extra.items():
+            summary += ", {} {}".format(key, value)
+        print(summary)
+
+
+def encode_jpg(frame, quality):
+    ret_code, jpg_buffer = cv2.imencode(".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)])
+    if not ret_code:
+        raise ValueError("JPEG encoding failed")
+    return jpg_buffer
+
+
+def recv_frame(image_hub):
+    """
+    Receives one frame from an imagezmq.ImageHub, whichever way it was sent (send_image or send_jpg).
+    Returns (msg, frame, nbytes, decode_time, arrived), where arrived is the time.perf_counter() at which the frame's
+    first part was received. The caller is responsible for image_hub.send_reply() in REQ/REP mode.
+    """
+    md = image_hub.zmq_socket.recv_json()
+    arrived = time.perf_counter()
+    payload = image_hub.zmq_socket.recv(copy=False)
+    nbytes = len(payload.buffer)
+    start = time.perf_counter()
+    if 'dtype' in md:
+        frame = np.frombuffer(payload.buffer, dtype=md['dtype']).reshape(md['shape'])
+    else:
+        frame = cv2.imdecode(np.frombuffer(payload.buffer, dtype='uint8'), cv2.IMREAD_COLOR)
+    return md['msg'], frame, nbytes, time.perf_counter() - start, arrived
+
+
+class FrameReceiver:
+    """
+    Receives and decodes frames from an imagezmq.ImageHub on a background thread into a latest-frame slot, so a
+    blocking receive never stalls the consumer (the viewer's UI thread). In REQ/REP mode ('reply') each frame is
+    acknowledged as soon as it has arrived; on_receive(msg) is called on the receiving thread for every frame.
+
+    take() returns the newest frame not taken yet as (msg, frame, decode_time, received), where received is its
+    time.perf_counter() on arrival. Frames replaced in the slot before they were taken count as dropped, frames that
+    waited in the slot longer than 'late_after' seconds as late.
+
+    With a LatencyMonitor, every frame records its 'receive' stage (reading the frame off the socket and, in REQ/REP
+    mode, acknowledging it; decoding is timed separately) and, for frames that carry their capture time, the
+    'age at receipt', which covers the server's stages and the network transfer.
+    """
+    def __init__(self, image_hub, reply=True, on_receive=None, stats=None, late_after=0.02, latency=None):
+        self.image_hub = image_hub
+        self.reply = reply
+        self.on_receive = on_receive
+        self.stats = stats
+        self.latency = latency
+        self.late_after = late_after
+        self.received = 0
+        self.late = 0
+        self.slot = DropOldestBuffer(maxlen=1)
+        # the receive timeout lets the thread notice stop()
+        self.image_hub.zmq_socket.setsockopt(zmq.RCVTIMEO, 500)
+        self._worker = StageWorker('frame-receiver', self._receive_step)
+
+    @property
+    def dropped(self):
+        return self.slot.dropped
+
+    def start(self):
+        self._worker.start()
+        return self
+
+    def stop(self):
+        self._worker.stop()
+        self.slot.close()
+
+    def _receive_step(self):
+        start = time.perf_counter()
+        try:
+            msg, frame, nbytes, decode_time, arrived = recv_frame(self.image_hub)
+        except zmq.Again:
+            return
+        if self.reply:
+            self.image_hub.send_reply(b'OK')
+        received = time.perf_counter()
+        if self.latency:
+            self.latency.record('receive', received - arrived - decode_time)
+            if isinstance(msg, dict) and 'capture_time' in msg:
+                self.latency.record('age at receipt', time.time() - msg['capture_time'])
+        self.received += 1
+        if self.on_receive:
+            self.on_receive(msg)
+        if self.stats:
+            self.stats.record(nbytes, decode_time, received - start - decode_time, dropped=self.dropped,
+                              late=self.late)
+        self.slot.put((msg, frame, decode_time, received))
+
+    def take(self):
+        # None if no new frame has arrived since the last take()
+        item = self.slot.get_latest(timeout=0)
+        if item is not None and time.perf_counter() - item[3] > self.late_after:
+            self.late += 1
+        return item